@@ -0,0 +1,87 @@
+# bench/codec_bench.py
+"""
+Microbenchmark of the JSON codec backends (chatspot/codec.py) on the work
+the message path does per envelope:
+
+- decode:   parse an inbound `message` frame
+- encode:   encode the envelope (with its seq) for storage and fan-out
+- text:     encode a control frame as str for send_text
+- roundtrip: decode + assign seq + encode, i.e. one stored message
+
+Envelopes look like real ones: base64 iv and ciphertext, sender and
+conversation ids, a timestamp and a client message id. Only the backends
+installed here are measured.
+
+    PYTHONPATH=. python bench/codec_bench.py [--sizes 64,512,4096] [--number 20000]
+"""
+import argparse
+import base64
+import os
+import timeit
+
+from chatspot import codec
+
+
+def make_frame(ciphertext_bytes: int, i: int = 0) -> bytes:
+    envelope = {
+        "conversationId": "room-%d" % (i % 100),
+        "senderId": "user-%d" % (i % 1000),
+        "iv": base64.b64encode(os.urandom(12)).decode("ascii"),
+        "ciphertext": base64.b64encode(os.urandom(ciphertext_bytes)).decode("ascii"),
+        "sentAt": 1700000000000 + i,
+        "clientMsgId": "%032x" % i,
+    }
+    return codec.get_codec("json").encode({"action": "message", "envelope": envelope})
+
+
+def bench(backend: codec.Codec, frame: bytes, number: int) -> dict:
+    decode, encode, encode_text = backend.decode, backend.encode, backend.encode_text
+    text = frame.decode("utf-8")
+    envelope = decode(frame)["envelope"]
+    envelope["seq"] = 1
+    control = {"action": "reset", "conversationId": "room-1", "firstSeq": 1, "lastSeq": 12345}
+
+    def roundtrip():
+        env = decode(text)["envelope"]
+        env["seq"] = 2
+        encode(env)
+
+    cases = {
+        "decode": lambda: decode(text),
+        "encode": lambda: encode(envelope),
+        "text": lambda: encode_text(control),
+        "roundtrip": roundtrip,
+    }
+    results = {}
+    for case, fn in cases.items():
+        best = min(timeit.repeat(fn, number=number, repeat=5))
+        results[case] = best / number * 1e9
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="64,512,4096", help="ciphertext sizes in bytes, comma-separated")
+    parser.add_argument("--number", type=int, default=20000, help="calls per timing run")
+    args = parser.parse_args()
+
+    backends = [codec.get_codec(name) for name in codec.available()]
+    print("backends: %s (active: %s)" % (", ".join(b.name for b in backends), codec.name))
+    print("%-8s %-8s %10s %10s %10s %10s" % ("size", "codec", "decode", "encode", "text", "roundtrip"))
+    for size in (int(s) for s in args.sizes.split(",")):
+        frame = make_frame(size)
+        results = {backend.name: bench(backend, frame, args.number) for backend in backends}
+        for backend_name, r in results.items():
+            print("%-8d %-8s %8.0fns %8.0fns %8.0fns %8.0fns" % (
+                size, backend_name, r["decode"], r["encode"], r["text"], r["roundtrip"],
+            ))
+        baseline = results["json"]
+        for backend_name, r in results.items():
+            if backend_name != "json":
+                print("%-8d %-8s %9.1fx %9.1fx %9.1fx %9.1fx  (vs json)" % (
+                    size, backend_name, *(baseline[case] / r[case] for case in ("decode", "encode", "text", "roundtrip")),
+                ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+# bench/fanout_alloc_bench.py
+"""
+Memory allocated by one fan-out, measured with tracemalloc.
+
+One conversation with N queued-mode subscribers; each fan-out appends an
+envelope and delivers it through FanoutEngine to every subscriber, and the
+writer tasks drain their queues into stand-in sockets. Reported per
+fan-out: the peak of traced memory above what was allocated before it
+(frames, queue entries, writer wake-ups, send coroutines), per recipient,
+and the time taken without tracing.
+
+- shared:        one Frame per encoding, handed to every queue (the
+                 server's message path)
+- per-recipient: the frame encoded again for every subscriber, the way a
+                 frame that is built per connection costs
+
+The stand-in sockets keep nothing and copy nothing, so the ASGI server's
+own encoding of text frames is not counted.
+
+    PYTHONPATH=. python bench/fanout_alloc_bench.py [--subscribers 1000] [--size 1024] [--binary 0.5]
+"""
+import argparse
+import asyncio
+import base64
+import gc
+import os
+import time
+import tracemalloc
+
+from chatspot import binary, codec
+from chatspot.connection import Connection
+from chatspot.fanout import FanoutEngine
+from chatspot.frame import Frame
+from chatspot.history import ConversationHistory, message_frame
+
+
+class _Socket:
+    def __init__(self, counter: list):
+        self.counter = counter
+
+    async def send_text(self, text: str) -> None:
+        self.counter[0] += 1
+
+    async def send_bytes(self, data: bytes) -> None:
+        self.counter[0] += 1
+
+
+async def run(mode: str, subscribers: int, size: int, binary_share: float, rounds: int) -> dict:
+    sent = [0]
+    conns = [Connection(_Socket(sent), queued=True) for _ in range(subscribers)]
+    for i, conn in enumerate(conns):
+        conn.binary = i < subscribers * binary_share
+        conn.start()
+    engine = FanoutEngine("queued")
+    history = ConversationHistory("room-1")
+    envelope = {
+        "conversationId": "room-1",
+        "senderId": "user-1",
+        "iv": base64.b64encode(os.urandom(12)).decode("ascii"),
+        "ciphertext": base64.b64encode(os.urandom(size)).decode("ascii"),
+    }
+
+    async def fan_out() -> None:
+        env = dict(envelope)
+        record = history.append(env)
+        if mode == "shared":
+            frame = None
+            if any(c.binary for c in conns):
+                frame = Frame(binary.encode_message(record.seq, "room-1", "user-1", record.iv, record.ciphertext, env), binary=True)
+            await engine.broadcast(conns, message_frame(record), conv="room-1", seq=record.seq, binary=frame)
+        else:
+            for conn in conns:
+                if conn.binary:
+                    conn.enqueue(binary.encode_message(record.seq, "room-1", "user-1", record.iv, record.ciphertext, env))
+                else:
+                    conn.enqueue(codec.encode_text({"action": "message", "envelope": env}), "message")
+        while sent[0] < subscribers:
+            await asyncio.sleep(0)
+        sent[0] = 0
+
+    for _ in range(3):
+        await fan_out()
+    started = time.perf_counter()
+    for _ in range(rounds):
+        await fan_out()
+    elapsed = (time.perf_counter() - started) / rounds
+
+    gc.collect()
+    tracemalloc.start()
+    peaks = []
+    for _ in range(rounds):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        await fan_out()
+        peaks.append(tracemalloc.get_traced_memory()[1] - before)
+    tracemalloc.stop()
+    for conn in conns:
+        await conn.close()
+    peak = sorted(peaks)[len(peaks) // 2]
+    return {"peak": peak, "per_recipient": peak / subscribers, "ms": elapsed * 1000}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--subscribers", type=int, default=1000, help="subscribers of the conversation")
+    parser.add_argument("--size", type=int, default=1024, help="ciphertext size in bytes")
+    parser.add_argument("--binary", type=float, default=0.0, help="share of subscribers using binary frames")
+    parser.add_argument("--rounds", type=int, default=20, help="fan-outs measured per mode")
+    args = parser.parse_args()
+
+    print("%d subscribers, %d-byte ciphertext, %.0f%% binary" % (args.subscribers, args.size, args.binary * 100))
+    print("%-14s %12s %14s %10s" % ("mode", "peak bytes", "per recipient", "time"))
+    for mode in ("shared", "per-recipient"):
+        r = asyncio.run(run(mode, args.subscribers, args.size, args.binary, args.rounds))
+        print("%-14s %12d %14.1f %8.2fms" % (mode, r["peak"], r["per_recipient"], r["ms"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+# bench/fanout_sweep_bench.py
+"""
+Fan-out latency against room size, per fan-out mode, with slow consumers.
+
+For each mode (queued, concurrent, serial), room size and slow-consumer
+share, one conversation gets `--messages` messages, spaced `--spacing`
+microseconds per subscriber apart (so a healthy room keeps up at every
+size, and what builds up is the slow consumers' doing). Each is handled the
+way the conversation's actor handles it: the raw `message` frame is
+decoded, the envelope appended to the conversation's history, its frame
+built and fanned out through FanoutEngine, and only then is the next frame
+taken. Reported is the time from a frame arriving to the last healthy
+subscriber receiving it, so a fan-out that holds up the ones behind it
+shows in their latency too.
+
+Subscribers are in-process stand-in sockets, so room sizes up to 10k fit
+on one machine and only the server's side is timed (bench/load_bench.py
+covers the network). A slow consumer's socket never completes a send, like
+a client that stopped reading once its TCP buffers are full. As in the
+server, connections a fan-out reports as failed are evicted from the room,
+so the blocking is over once they have been found:
+
+- serial:     each slow consumer holds up everyone after it for a whole
+              `--send-timeout`
+- concurrent: slow consumers tie up workers, up to `--send-timeout` each
+- queued:     nothing waits on a send; a slow consumer's own queue fills
+              and its writer gives up after `--send-timeout`
+
+The default `--send-timeout` is much shorter than the server's
+(CHATSPOT_FANOUT_SEND_TIMEOUT) to keep runs short; serial head-of-line
+blocking scales with it.
+
+    PYTHONPATH=. python bench/fanout_sweep_bench.py [--sizes 1,10,100,1000,10000] \\
+        [--slow 0,0.01] [--modes queued,concurrent,serial] [--output sweep.json]
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import time
+from typing import List, Optional
+
+from chatspot import protocol
+from chatspot.connection import Connection
+from chatspot.fanout import FanoutEngine, MODES
+from chatspot.history import ConversationHistory, message_frame
+
+
+class Room:
+    """
+    Counts receipts of the message in flight by healthy subscribers.
+    """
+
+    def __init__(self, healthy: int):
+        self.healthy = healthy
+        self.received = 0
+        self.done = asyncio.Event()
+        self.last: Optional[float] = None
+
+    def expect(self) -> None:
+        self.received = 0
+        self.last = None
+        self.done.clear()
+
+    def receipt(self) -> None:
+        self.received += 1
+        if self.received == self.healthy:
+            self.last = time.perf_counter()
+            self.done.set()
+
+
+class _Socket:
+    def __init__(self, room: Room):
+        self.room = room
+
+    async def send_text(self, text: str) -> None:
+        self.room.receipt()
+
+    async def send_bytes(self, data: bytes) -> None:
+        self.room.receipt()
+
+    async def close(self, code: int = 1000) -> None:
+        pass
+
+
+class _StalledSocket(_Socket):
+    async def send_text(self, text: str) -> None:
+        await asyncio.Event().wait()
+
+    send_bytes = send_text
+
+
+def make_frame(size: int, i: int) -> str:
+    return json.dumps({
+        "action": "message",
+        "envelope": {
+            "conversationId": "room-1",
+            "senderId": "user-1",
+            "iv": base64.b64encode(os.urandom(12)).decode("ascii"),
+            "ciphertext": base64.b64encode(os.urandom(size)).decode("ascii"),
+            "clientMsgId": "%032x" % i,
+        },
+    })
+
+
+async def run(
+    mode: str, subscribers: int, slow_share: float, messages: int, interval: float, size: int, send_timeout: float,
+) -> dict:
+    slow = int(round(subscribers * slow_share))
+    room = Room(subscribers - slow)
+    engine = FanoutEngine(mode, send_timeout=send_timeout)
+    conns: List[Connection] = []
+    # stalled sockets spread through the room, as they would be in join order
+    stalled = set(range(0, subscribers, subscribers // slow)[:slow]) if slow else set()
+    for i in range(subscribers):
+        ws = _StalledSocket(room) if i in stalled else _Socket(room)
+        conn = Connection(ws, queued=engine.queued, send_timeout=send_timeout)
+        conn.start()
+        conns.append(conn)
+    members = set(conns)
+    history = ConversationHistory("room-1")
+    frames = [make_frame(size, i) for i in range(messages)]
+
+    latencies = []
+    evicted = 0
+    started = time.perf_counter()
+    for i, raw in enumerate(frames):
+        arrived = started + i * interval
+        delay = arrived - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        room.expect()
+        msg = protocol.decode(raw)
+        record = history.append(msg.envelope)
+        dead = await engine.broadcast(members, message_frame(record), conv="room-1", seq=record.seq)
+        for conn in dead:
+            members.discard(conn)
+        evicted += len(dead)
+        if room.healthy:
+            await room.done.wait()
+            latencies.append(room.last - arrived)
+
+    for conn in conns:
+        await conn.close()
+    return {
+        "mode": mode,
+        "subscribers": subscribers,
+        "slow": slow,
+        "firstMs": round(latencies[0] * 1000, 3) if latencies else None,
+        "p50Ms": _ms(latencies, 0.5),
+        "p99Ms": _ms(latencies, 0.99),
+        "maxMs": round(max(latencies) * 1000, 3) if latencies else None,
+        "evicted": evicted,
+    }
+
+
+def _ms(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(q * len(values)))] * 1000, 3)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1,10,100,1000,10000", help="subscribers per room, comma-separated")
+    parser.add_argument("--slow", default="0,0.01", help="shares of subscribers that stop reading, comma-separated")
+    parser.add_argument("--modes", default=",".join(MODES), help="fan-out modes, comma-separated")
+    parser.add_argument("--messages", type=int, default=20, help="messages fanned out per run")
+    parser.add_argument(
+        "--spacing", type=float, default=50.0, help="microseconds per subscriber between arriving messages",
+    )
+    parser.add_argument("--size", type=int, default=256, help="ciphertext size in bytes")
+    parser.add_argument("--send-timeout", type=float, default=0.1, help="seconds before a stalled send is abandoned")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = []
+    print("%-11s %11s %6s %10s %10s %10s %10s %8s" % (
+        "mode", "subscribers", "slow", "first", "p50", "p99", "max", "evicted",
+    ))
+    for mode in args.modes.split(","):
+        for slow_share in (float(s) for s in args.slow.split(",")):
+            for subscribers in (int(s) for s in args.sizes.split(",")):
+                r = asyncio.run(run(
+                    mode, subscribers, slow_share, args.messages, max(0.001, args.spacing * subscribers / 1e6), args.size, args.send_timeout,
+                ))
+                results.append(r)
+                print("%-11s %11d %6d %10s %10s %10s %10s %8d" % (
+                    mode, subscribers, r["slow"], *(_fmt(r[k]) for k in ("firstMs", "p50Ms", "p99Ms", "maxMs")), r["evicted"],
+                ))
+    if args.output:
+        with open(args.output, "w") as out:
+            json.dump({"config": vars(args), "results": results}, out, indent=2)
+            out.write("\n")
+        print("results written to %s" % args.output)
+
+
+def _fmt(ms: Optional[float]) -> str:
+    return "-" if ms is None else "%.3fms" % ms
+
+
+if __name__ == "__main__":
+    main()
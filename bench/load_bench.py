@@ -0,0 +1,318 @@
+# bench/load_bench.py
+"""
+WebSocket load generator: N clients over M conversations against a running
+server, speaking the real protocol.
+
+Client i joins conversation i % M: it connects, sends `identify`, then
+`subscribe`, and counts as joined when the `history` reply arrives. Once all
+have joined, `--senders` of them (spread over the conversations) each send
+`message` frames at `--rate` per second for `--duration` seconds, with
+`--size` bytes of ciphertext; everyone keeps reading. Each envelope carries
+the time it was due to be sent, so delivery latency includes any time the
+sender fell behind schedule rather than hiding it. The first `--warmup`
+seconds of sending are not counted.
+
+Reported, and written as JSON with `--output` for comparing runs across
+commits:
+
+- throughput: messages sent and envelopes delivered per second, and the
+  share of the expected deliveries (sent x subscribers) that arrived
+- delivery latency percentiles, from due time to receipt
+- join latency percentiles, from connect to the `history` reply
+- server RSS (start, peak, end), sampled from /proc while the run lasts,
+  when the server is started with `--spawn` or its pid is given
+- the load generator's own CPU time; near `--duration` it, not the server,
+  is the bottleneck
+
+    python bench/load_bench.py --spawn [--clients 1000] [--conversations 100] \\
+        [--senders 100] [--rate 10] [--size 256] [--duration 10] [--output run.json]
+
+Many clients need a raised open-file limit (`ulimit -n`) on both ends.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import platform
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import websockets
+
+ROOT = Path(__file__).resolve().parent.parent
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+class Client:
+    def __init__(self, index: int, conv: str, batch: bool):
+        self.index = index
+        self.conv = conv
+        self.batch = batch
+        self.ws = None
+        self.join_latency: Optional[float] = None
+        self.latencies: List[float] = []
+        self.sent = 0
+        self.received = 0
+
+    async def connect(self, url: str) -> None:
+        started = time.perf_counter()
+        self.ws = await websockets.connect(url, max_size=None, compression=None, open_timeout=30)
+        await self.ws.send(json.dumps({"action": "identify", "userId": "load-%d" % self.index, "batch": self.batch}))
+        await self.ws.send(json.dumps({"action": "subscribe", "conversationId": self.conv}))
+        while True:
+            frame = json.loads(await self.ws.recv())
+            if frame.get("action") == "history":
+                break
+            if frame.get("action") == "overloaded":
+                raise SystemExit("subscribe rejected: the server is shedding load")
+        self.join_latency = time.perf_counter() - started
+
+    async def read(self, counting: "Window") -> None:
+        try:
+            async for raw in self.ws:
+                now = time.perf_counter()
+                frame = json.loads(raw)
+                action = frame.get("action")
+                if action == "message":
+                    envelopes = (frame["envelope"],)
+                elif action == "batch":
+                    envelopes = frame["envelopes"]
+                else:
+                    continue
+                for envelope in envelopes:
+                    due = envelope.get("dueAt")
+                    if due is not None and counting.start <= due < counting.end:
+                        self.received += 1
+                        self.latencies.append(now - due)
+        except websockets.ConnectionClosed:
+            pass
+
+    async def send(self, rate: float, size: int, counting: "Window", offset: float) -> None:
+        ciphertext = base64.b64encode(os.urandom(size)).decode("ascii")
+        iv = base64.b64encode(os.urandom(12)).decode("ascii")
+        prefix = '{"action":"message","envelope":{"conversationId":%s,"senderId":"load-%d","iv":"%s","ciphertext":"%s","dueAt":' % (
+            json.dumps(self.conv), self.index, iv, ciphertext,
+        )
+        interval = 1.0 / rate
+        due = counting.begin + offset * interval
+        while due < counting.end:
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                await self.ws.send("%s%r}}" % (prefix, due))
+            except websockets.ConnectionClosed:
+                return
+            if due >= counting.start:
+                self.sent += 1
+            due += interval
+
+
+class Window:
+    """
+    Sending runs from `begin` to `end`; envelopes due from `start` on count.
+    """
+
+    def __init__(self, begin: float, warmup: float, duration: float):
+        self.begin = begin
+        self.start = begin + warmup
+        self.end = self.start + duration
+
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    """
+    Nearest-rank percentiles of `values` in milliseconds.
+    """
+    if not values:
+        return {**{"p%g" % p: None for p in PERCENTILES}, "max": None}
+    values = sorted(values)
+    result = {}
+    for p in PERCENTILES:
+        rank = min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))
+        result["p%g" % p] = round(values[rank] * 1000, 3)
+    result["max"] = round(values[-1] * 1000, 3)
+    return result
+
+
+def rss_bytes(pid: int) -> Optional[int]:
+    try:
+        with open("/proc/%d/status" % pid) as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+async def sample_rss(pid: int, samples: List[int], interval: float = 0.5) -> None:
+    while True:
+        rss = rss_bytes(pid)
+        if rss is not None:
+            samples.append(rss)
+        await asyncio.sleep(interval)
+
+
+def spawn_server(port: int) -> subprocess.Popen:
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=str(ROOT),
+    )
+    deadline = time.monotonic() + 20
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return server
+        except OSError:
+            if server.poll() is not None:
+                raise SystemExit("server exited with status %d" % server.returncode)
+            time.sleep(0.1)
+    server.terminate()
+    raise SystemExit("server did not start listening on port %d" % port)
+
+
+def commit() -> Optional[str]:
+    try:
+        out = subprocess.run(
+            ["git", "describe", "--always", "--dirty"], cwd=str(ROOT), capture_output=True, text=True, timeout=5,
+        )
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return out.stdout.strip() or None
+
+
+async def run(args, server_pid: Optional[int]) -> dict:
+    clients = [Client(i, "load-%d" % (i % args.conversations), args.batch) for i in range(args.clients)]
+    rss: List[int] = []
+    sampler = asyncio.create_task(sample_rss(server_pid, rss)) if server_pid else None
+
+    # join, at most `--connect-concurrency` handshakes in flight
+    gate = asyncio.Semaphore(args.connect_concurrency)
+
+    async def join(client: Client) -> None:
+        async with gate:
+            await client.connect(args.url)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(join(c) for c in clients))
+    join_seconds = time.perf_counter() - started
+
+    window = Window(time.perf_counter() + 0.5, args.warmup, args.duration)
+    readers = [asyncio.create_task(c.read(window)) for c in clients]
+    # senders spread over the conversations, their sends spread over the interval
+    step = max(1, args.clients // max(1, args.senders))
+    senders = clients[::step][: args.senders]
+    cpu = resource.getrusage(resource.RUSAGE_SELF)
+    await asyncio.gather(*(c.send(args.rate, args.size, window, i / len(senders)) for i, c in enumerate(senders)))
+    # let deliveries of the last messages arrive
+    await asyncio.sleep(args.drain)
+    used = resource.getrusage(resource.RUSAGE_SELF)
+
+    for client in clients:
+        await client.ws.close()
+    await asyncio.gather(*readers)
+    if sampler is not None:
+        sampler.cancel()
+
+    members: Dict[str, int] = {}
+    for client in clients:
+        members[client.conv] = members.get(client.conv, 0) + 1
+    sent = sum(c.sent for c in senders)
+    expected = sum(c.sent * members[c.conv] for c in senders)
+    received = sum(c.received for c in clients)
+    latencies = [x for c in clients for x in c.latencies]
+    return {
+        "sent": sent,
+        "delivered": received,
+        "expectedDeliveries": expected,
+        "deliveredShare": round(received / expected, 4) if expected else None,
+        "sentPerSecond": round(sent / args.duration, 1),
+        "deliveredPerSecond": round(received / args.duration, 1),
+        "deliveryLatencyMs": percentiles(latencies),
+        "joinLatencyMs": percentiles([c.join_latency for c in clients]),
+        "joinSeconds": round(join_seconds, 3),
+        "serverRssBytes": {"start": rss[0], "peak": max(rss), "end": rss[-1]} if rss else None,
+        "clientCpuSeconds": round(used.ru_utime + used.ru_stime - cpu.ru_utime - cpu.ru_stime, 3),
+    }
+
+
+def report(results: dict) -> None:
+    print("sent       %9d  (%.1f/s)" % (results["sent"], results["sentPerSecond"]))
+    print("delivered  %9d  (%.1f/s, %s of expected)" % (
+        results["delivered"], results["deliveredPerSecond"],
+        "%.2f%%" % (results["deliveredShare"] * 100) if results["deliveredShare"] is not None else "n/a",
+    ))
+    for name, key in (("delivery", "deliveryLatencyMs"), ("join", "joinLatencyMs")):
+        print("%-10s %s" % (name, "  ".join(
+            "%s %s" % (p, "%.2fms" % v if v is not None else "-") for p, v in results[key].items()
+        )))
+    rss = results["serverRssBytes"]
+    if rss is not None:
+        print("server RSS start %.1f MB, peak %.1f MB, end %.1f MB" % (
+            rss["start"] / 2 ** 20, rss["peak"] / 2 ** 20, rss["end"] / 2 ** 20,
+        ))
+    print("client CPU %.2fs" % results["clientCpuSeconds"])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default=None, help="server WebSocket URL (default ws://127.0.0.1:PORT/ws)")
+    parser.add_argument("--port", type=int, default=8000, help="port of the local server")
+    parser.add_argument("--spawn", action="store_true", help="start the server (uvicorn main:app) for the run")
+    parser.add_argument("--server-pid", type=int, help="pid of a running server, for RSS sampling")
+    parser.add_argument("--clients", type=int, default=1000, help="WebSocket clients")
+    parser.add_argument("--conversations", type=int, default=100, help="conversations the clients are spread over")
+    parser.add_argument("--senders", type=int, default=100, help="clients that send messages")
+    parser.add_argument("--rate", type=float, default=10.0, help="messages per second per sender")
+    parser.add_argument("--size", type=int, default=256, help="ciphertext size in bytes")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of sending that are counted")
+    parser.add_argument("--warmup", type=float, default=2.0, help="seconds of sending before counting starts")
+    parser.add_argument("--drain", type=float, default=2.0, help="seconds to wait for deliveries after sending")
+    parser.add_argument("--batch", action="store_true", help="identify with `batch: true`")
+    parser.add_argument("--connect-concurrency", type=int, default=100, help="handshakes in flight while joining")
+    parser.add_argument("--label", help="free-form label stored with the results")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+    if args.url is None:
+        args.url = "ws://127.0.0.1:%d/ws" % args.port
+    if args.senders > args.clients:
+        parser.error("--senders cannot exceed --clients")
+
+    started_at = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+    server = spawn_server(args.port) if args.spawn else None
+    try:
+        server_pid = server.pid if server is not None else args.server_pid
+        results = asyncio.run(run(args, server_pid))
+    finally:
+        if server is not None:
+            server.send_signal(signal.SIGINT)
+            try:
+                server.wait(10)
+            except subprocess.TimeoutExpired:
+                server.kill()
+
+    report(results)
+    if args.output:
+        document = {
+            "label": args.label,
+            "commit": commit(),
+            "startedAt": started_at,
+            "host": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+            "config": {k: v for k, v in vars(args).items() if k not in ("output", "label")},
+            "results": results,
+        }
+        with open(args.output, "w") as out:
+            json.dump(document, out, indent=2)
+            out.write("\n")
+        print("results written to %s" % args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,3 @@
+"""
+Server-side building blocks for the Chatspot WebSocket backend (see main.py).
+"""
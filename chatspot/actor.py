@@ -0,0 +1,116 @@
+# chatspot/actor.py
+"""
+One actor per active conversation: a task draining a mailbox.
+
+Everything posted for a conversation is handled by its actor one item at a
+time, in the order posted, so numbering, appending and fan-out of one
+message finish before the next one starts -- every subscriber sees the
+conversation in the same order, whoever sent what concurrently and however
+fan-out awaits. Conversations still run independently of each other.
+
+An actor is started by the first post to its conversation and exits once
+its mailbox has been empty for `idle` seconds, so only conversations with
+recent traffic cost a task. A full mailbox (`max_mailbox` items) makes the
+poster wait, which pushes back on the connections sending to a busy
+conversation instead of queueing without bound.
+"""
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from . import config, metrics
+
+logger = logging.getLogger(__name__)
+
+active = metrics.gauge("chatspot_actors", "Conversation actors running")
+reaped = metrics.counter("chatspot_actors_reaped_total", "Conversation actors stopped after being idle")
+mailbox_full = metrics.counter("chatspot_actor_mailbox_full_total", "Posts that waited for room in a full mailbox")
+
+# (conversation, item) -> None
+ActorHandler = Callable[[str, Any], Awaitable[None]]
+
+
+class _Actor:
+    __slots__ = ("conv", "mailbox", "task")
+
+    def __init__(self, conv: str, max_mailbox: int):
+        self.conv = conv
+        self.mailbox: asyncio.Queue = asyncio.Queue(max_mailbox)
+        self.task: Optional[asyncio.Task] = None
+
+
+class ActorPool:
+    def __init__(self, idle: float = config.ACTOR_IDLE_MS / 1000, max_mailbox: int = config.ACTOR_MAILBOX):
+        self.idle = idle
+        self.max_mailbox = max_mailbox
+        self._handler: Optional[ActorHandler] = None
+        self._actors: Dict[str, _Actor] = {}
+
+    def start(self, handler: ActorHandler) -> None:
+        """
+        `handler(conv, item)` handles each item posted, in its actor.
+        """
+        self._handler = handler
+
+    async def post(self, conv: str, item: Any) -> None:
+        """
+        Hand `item` to the actor of `conv`, starting it if need be. Returns
+        without waiting unless the mailbox is full.
+        """
+        actor = self._actors.get(conv)
+        if actor is None:
+            actor = self._actors[conv] = _Actor(conv, self.max_mailbox)
+            actor.task = asyncio.create_task(self._run(actor))
+            active.set(len(self._actors))
+        try:
+            actor.mailbox.put_nowait(item)
+        except asyncio.QueueFull:
+            mailbox_full.inc()
+            await actor.mailbox.put(item)
+
+    def __len__(self) -> int:
+        return len(self._actors)
+
+    async def drain(self) -> None:
+        """
+        Wait until everything posted so far has been handled.
+        """
+        await asyncio.gather(*(actor.mailbox.join() for actor in list(self._actors.values())))
+
+    async def close(self) -> None:
+        """
+        Handle what is still in the mailboxes, then stop every actor.
+        """
+        await self.drain()
+        actors = list(self._actors.values())
+        self._actors.clear()
+        active.set(0)
+        for actor in actors:
+            actor.task.cancel()
+        await asyncio.gather(*(actor.task for actor in actors), return_exceptions=True)
+
+    async def _run(self, actor: _Actor) -> None:
+        mailbox = actor.mailbox
+        while True:
+            try:
+                item = mailbox.get_nowait()
+            except asyncio.QueueEmpty:
+                try:
+                    item = await asyncio.wait_for(mailbox.get(), self.idle)
+                except asyncio.TimeoutError:
+                    # nothing can have been posted since the wait ran out:
+                    # leaving now, without awaiting, loses nothing
+                    if mailbox.empty() and self._actors.get(actor.conv) is actor:
+                        del self._actors[actor.conv]
+                        active.set(len(self._actors))
+                        reaped.inc()
+                        return
+                    continue
+            try:
+                await self._handler(actor.conv, item)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("handling a message of %r failed", actor.conv)
+            finally:
+                mailbox.task_done()
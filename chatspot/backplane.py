@@ -0,0 +1,331 @@
+# chatspot/backplane.py
+"""
+Backplane: how several worker processes share `message` events.
+
+With a backplane a worker does not number or deliver the messages its
+clients send. It publishes each envelope, encoded without a `seq`, and the
+backplane numbers it per conversation and hands the event -- conversation,
+seq, encoded envelope with its seq -- back to every worker, the publisher
+included, in seq order. Each worker appends the event to its own history
+and fans it out to its own subscribers only. The publisher's copy is
+flagged `origin`: where the workers share one store (`shared_store`), only
+the publisher persists it and the others just `observe` it; where each has
+a store of its own, every worker persists every event it holds.
+
+A publish carries the publisher's `last_seq` for the conversation, and the
+backplane numbers after the larger of that and its own counter; a broker
+that restarts, or histories recovered from the store, never go backwards.
+
+A backplane may deliver only the conversations a worker `watch`es (those
+with local subscribers). The publisher still gets its own events for the
+others, with `keep` false: it persists them but does not hold or deliver
+them.
+
+Implementations:
+
+- LocalBackplane: workers in one process sharing a LocalHub (tests)
+- UnixBackplane:  a connection to the broker (broker.py) over a Unix
+                  domain socket, for worker processes on one host
+- RedisBackplane: Redis pub/sub (redis_backplane.py), for several nodes
+"""
+import asyncio
+import logging
+import struct
+from collections import deque
+from typing import AsyncIterator, Awaitable, Callable, Deque, Dict, List, Optional, Tuple, Union
+
+from . import config, metrics
+from .history import add_seq
+
+logger = logging.getLogger(__name__)
+
+published = metrics.counter("chatspot_backplane_published_total", "Envelopes published to the backplane")
+received = metrics.counter("chatspot_backplane_events_total", "Events received from the backplane")
+lost = metrics.counter("chatspot_backplane_lost_total", "Envelopes that could not be published (no broker)")
+
+# (conversation id, seq, encoded envelope, published by this worker,
+# held and delivered by this worker)
+Handler = Callable[[str, int, bytes, bool, bool], Awaitable[None]]
+
+
+class Backplane:
+    # the workers it connects run on one host and share one store
+    shared_store = True
+
+    def __init__(self) -> None:
+        self._handler: Optional[Handler] = None
+        # events, and futures resolved once the events before them are handled
+        self._events: Deque[Union[Tuple[str, int, bytes, bool, bool], asyncio.Future]] = deque()
+        self._wakeup = asyncio.Event()
+        self._pump: Optional[asyncio.Task] = None
+
+    async def start(self, handler: Handler) -> None:
+        """
+        Start delivering events to `handler`, one at a time, in order.
+        """
+        self._handler = handler
+        if self._pump is None:
+            self._pump = asyncio.create_task(self._run())
+
+    def publish(self, conv: str, encoded: bytes, last_seq: int) -> None:
+        """
+        Hand an envelope (encoded without `seq`) to the backplane. Never
+        blocks; the event comes back through the handler.
+        """
+        raise NotImplementedError
+
+    async def watch(self, conv: str, last_seq: int) -> None:
+        """
+        This worker has subscribers to `conv`, whose history it holds up to
+        `last_seq`. Returns once events after `last_seq` that the backplane
+        still has have been handled.
+        """
+
+    def unwatch(self, conv: str) -> None:
+        """
+        The last local subscriber of `conv` has left.
+        """
+
+    async def close(self) -> None:
+        if self._pump is not None:
+            self._pump.cancel()
+            try:
+                await self._pump
+            except asyncio.CancelledError:
+                pass
+            self._pump = None
+
+    def _deliver(self, conv: str, seq: int, encoded: bytes, origin: bool, keep: bool = True) -> None:
+        received.inc()
+        self._events.append((conv, seq, encoded, origin, keep))
+        self._wakeup.set()
+
+    async def _barrier(self) -> None:
+        # wait until everything delivered so far has been handled
+        done = asyncio.get_running_loop().create_future()
+        self._events.append(done)
+        self._wakeup.set()
+        await done
+
+    async def _run(self) -> None:
+        while True:
+            if not self._events:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            event = self._events.popleft()
+            if isinstance(event, asyncio.Future):
+                if not event.done():
+                    event.set_result(None)
+                continue
+            try:
+                await self._handler(*event)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("handling backplane event for %r failed", event[0])
+
+
+class LocalHub:
+    """
+    The broker of LocalBackplanes in one process.
+    """
+
+    def __init__(self) -> None:
+        self.members: List["LocalBackplane"] = []
+        self._seqs: Dict[str, int] = {}
+
+    def publish(self, sender: "LocalBackplane", conv: str, encoded: bytes, last_seq: int) -> None:
+        seq = max(self._seqs.get(conv, 0), last_seq) + 1
+        self._seqs[conv] = seq
+        event = add_seq(encoded, seq)
+        for member in self.members:
+            member._deliver(conv, seq, event, member is sender)
+
+
+class LocalBackplane(Backplane):
+    def __init__(self, hub: LocalHub):
+        super().__init__()
+        self.hub = hub
+        hub.members.append(self)
+
+    def publish(self, conv: str, encoded: bytes, last_seq: int) -> None:
+        published.inc()
+        self.hub.publish(self, conv, encoded, last_seq)
+
+    async def close(self) -> None:
+        if self in self.hub.members:
+            self.hub.members.remove(self)
+        await super().close()
+
+
+# -- Unix socket protocol ---------------------------------------------------
+#
+# Every frame is <u32 length><u8 kind><body>, little-endian (sharding.py
+# frames its own kinds the same way):
+#   PUBLISH (worker -> broker): <u64 last_seq><u16 conv length> conv encoded
+#   EVENT   (broker -> worker): <u8 origin><u64 seq><u16 conv length> conv encoded
+
+PUBLISH = 1
+EVENT = 2
+
+_FRAME = struct.Struct("<IB")
+_PUBLISH = struct.Struct("<QH")
+_EVENT = struct.Struct("<BQH")
+
+
+def pack_frame(kind: int, *parts: bytes) -> bytes:
+    """
+    A frame of `kind` whose body is `parts` concatenated.
+    """
+    return b"".join((_FRAME.pack(1 + sum(len(p) for p in parts), kind),) + parts)
+
+
+def pack_publish(conv: bytes, encoded: bytes, last_seq: int) -> bytes:
+    return pack_frame(PUBLISH, _PUBLISH.pack(last_seq, len(conv)), conv, encoded)
+
+
+def unpack_publish(body: bytes) -> Tuple[bytes, bytes, int]:
+    last_seq, conv_len = _PUBLISH.unpack_from(body)
+    start = _PUBLISH.size
+    return body[start:start + conv_len], body[start + conv_len:], last_seq
+
+
+def pack_event(conv: bytes, seq: int, encoded: bytes, origin: bool) -> bytes:
+    return pack_frame(EVENT, _EVENT.pack(origin, seq, len(conv)), conv, encoded)
+
+
+def unpack_event(body: bytes) -> Tuple[str, int, bytes, bool]:
+    origin, seq, conv_len = _EVENT.unpack_from(body)
+    start = _EVENT.size
+    return body[start:start + conv_len].decode("utf-8"), seq, body[start + conv_len:], bool(origin)
+
+
+async def read_frames(reader: asyncio.StreamReader) -> AsyncIterator[Tuple[int, bytes]]:
+    """
+    (kind, body) of every frame until the peer closes.
+    """
+    while True:
+        try:
+            head = await reader.readexactly(_FRAME.size)
+        except asyncio.IncompleteReadError:
+            return
+        length, kind = _FRAME.unpack(head)
+        try:
+            body = await reader.readexactly(length - 1)
+        except asyncio.IncompleteReadError:
+            return
+        yield kind, body
+
+
+class Outbox:
+    """
+    Coalesces the frames written to a stream during one event loop pass
+    into a single write.
+    """
+
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+        self._chunks: List[bytes] = []
+        # bytes in `_chunks`
+        self._bytes = 0
+
+    def write(self, data: bytes) -> None:
+        if not self._chunks:
+            asyncio.get_running_loop().call_soon(self._flush)
+        self._chunks.append(data)
+        self._bytes += len(data)
+
+    @property
+    def buffered(self) -> int:
+        return self.writer.transport.get_write_buffer_size() + self._bytes
+
+    def _flush(self) -> None:
+        chunks, self._chunks = self._chunks, []
+        self._bytes = 0
+        if not self.writer.is_closing():
+            self.writer.write(b"".join(chunks))
+
+
+class UnixBackplane(Backplane):
+    """
+    Client of the broker at `path`; reconnects if the broker goes away.
+    Envelopes published while it is unreachable are lost (and counted).
+    """
+
+    def __init__(self, path: str, retry: float = 0.5):
+        super().__init__()
+        self.path = path
+        self.retry = retry
+        self._outbox: Optional[Outbox] = None
+        self._connection: Optional[asyncio.Task] = None
+        self._connected = asyncio.Event()
+
+    async def start(self, handler: Handler, timeout: float = 5.0) -> None:
+        await super().start(handler)
+        if self._connection is None:
+            self._connection = asyncio.create_task(self._connect_loop())
+        try:
+            await asyncio.wait_for(self._connected.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("no backplane broker at %s yet; still trying", self.path)
+
+    def publish(self, conv: str, encoded: bytes, last_seq: int) -> None:
+        if self._outbox is None:
+            lost.inc()
+            return
+        published.inc()
+        self._outbox.write(pack_publish(conv.encode("utf-8"), encoded, last_seq))
+
+    async def close(self) -> None:
+        if self._connection is not None:
+            self._connection.cancel()
+            try:
+                await self._connection
+            except asyncio.CancelledError:
+                pass
+            self._connection = None
+        await super().close()
+
+    async def _connect_loop(self) -> None:
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path)
+            except OSError:
+                await asyncio.sleep(self.retry)
+                continue
+            logger.info("connected to backplane broker at %s", self.path)
+            self._outbox = Outbox(writer)
+            self._connected.set()
+            try:
+                async for kind, body in read_frames(reader):
+                    if kind == EVENT:
+                        self._deliver(*unpack_event(body))
+            finally:
+                self._outbox = None
+                self._connected.clear()
+                writer.close()
+            logger.warning("lost backplane broker at %s; reconnecting", self.path)
+            await asyncio.sleep(self.retry)
+
+
+def open_backplane(kind: str = config.BACKPLANE) -> Optional[Backplane]:
+    """
+    The backplane selected by CHATSPOT_BACKPLANE, or None for a single
+    worker.
+    """
+    if kind == "none":
+        return None
+    if kind == "unix":
+        return UnixBackplane(config.BACKPLANE_PATH)
+    if kind == "local":
+        return LocalBackplane(LOCAL_HUB)
+    if kind == "redis":
+        from .redis_backplane import RedisBackplane
+
+        return RedisBackplane(config.REDIS_URL, backlog=config.REDIS_BACKLOG, gap=config.BACKPLANE_GAP_MS / 1000)
+    raise ValueError("unknown backplane %r (expected none, unix, redis or local)" % kind)
+
+
+# shared by every LocalBackplane opened through open_backplane("local")
+LOCAL_HUB = LocalHub()
@@ -0,0 +1,146 @@
+# chatspot/binary.py
+"""
+Binary WebSocket framing for envelopes, for clients that asked for it at
+`identify` (`"binary": true`).
+
+A binary `message` frame is a fixed little-endian header followed by the
+variable-length parts, in this order:
+
+    u8  kind              1 = message
+    u8  flags             which optional parts are present (FLAG_*)
+    u64 seq               0 from clients; the server patches in the seq
+    u16 conversation id length
+    u16 sender id length
+    u16 iv length
+    u32 ciphertext length
+    u32 extra length
+    conversation id (UTF-8), sender id (UTF-8), iv, ciphertext,
+    extra: compact JSON object with the envelope's remaining fields
+
+iv and ciphertext travel as raw bytes, not base64. Only `message` frames
+are binary; everything else (including history) stays JSON text.
+
+A binary frame from a client is forwarded to binary subscribers as is,
+with only its seq filled in. Envelopes stored from either kind of frame
+are the same JSON envelopes, so JSON clients see no difference.
+"""
+import base64
+import struct
+from typing import Optional
+
+from . import codec
+
+KIND_MESSAGE = 1
+
+FLAG_SENDER = 0x01
+FLAG_IV = 0x02
+FLAG_CIPHERTEXT = 0x04
+
+HEADER = struct.Struct("<BBQHHHII")
+# offset of the seq field, for patching it into a received frame
+SEQ_OFFSET = 2
+_SEQ = struct.Struct("<Q")
+
+# envelope fields the header and raw parts can carry
+_CARRIED = ("conversationId", "seq", "senderId", "iv", "ciphertext")
+
+
+class MalformedFrame(ValueError):
+    pass
+
+
+def decode_message(data: bytes) -> dict:
+    """
+    Parse a binary `message` frame from a client into the equivalent JSON
+    envelope. Raises MalformedFrame.
+    """
+    if len(data) < HEADER.size:
+        raise MalformedFrame("short header")
+    kind, flags, _, conv_len, sender_len, iv_len, ct_len, extra_len = HEADER.unpack_from(data)
+    if kind != KIND_MESSAGE:
+        raise MalformedFrame("unknown kind %d" % kind)
+    if HEADER.size + conv_len + sender_len + iv_len + ct_len + extra_len != len(data) or not conv_len:
+        raise MalformedFrame("lengths do not add up")
+    pos = HEADER.size
+    try:
+        conv = data[pos:pos + conv_len].decode("utf-8")
+        pos += conv_len
+        sender = data[pos:pos + sender_len].decode("utf-8")
+        pos += sender_len
+    except UnicodeDecodeError:
+        raise MalformedFrame("ids are not UTF-8") from None
+    envelope = {}
+    extra_at = pos + iv_len + ct_len
+    if extra_len:
+        try:
+            envelope = codec.decode(data[extra_at:])
+        except codec.DecodeError:
+            raise MalformedFrame("extra is not JSON") from None
+        if type(envelope) is not dict:
+            raise MalformedFrame("extra is not an object")
+    envelope["conversationId"] = conv
+    if flags & FLAG_SENDER:
+        envelope["senderId"] = sender
+    with memoryview(data) as view:
+        if flags & FLAG_IV:
+            envelope["iv"] = str(base64.b64encode(view[pos:pos + iv_len]), "ascii")
+        pos += iv_len
+        if flags & FLAG_CIPHERTEXT:
+            envelope["ciphertext"] = str(base64.b64encode(view[pos:extra_at]), "ascii")
+    return envelope
+
+
+def with_seq(data: bytes, seq: int) -> bytes:
+    """
+    A client's binary frame with the server-assigned seq filled in -- what
+    binary subscribers receive. The rest is copied once, untouched.
+    """
+    with memoryview(data) as view:
+        return b"".join((view[:SEQ_OFFSET], _SEQ.pack(seq), view[SEQ_OFFSET + _SEQ.size:]))
+
+
+def encode_message(
+    seq: int,
+    conversation_id: str,
+    sender_id,
+    iv: Optional[bytes],
+    ciphertext: Optional[bytes],
+    envelope: dict,
+) -> Optional[bytes]:
+    """
+    Binary `message` frame for a stored envelope. `iv` / `ciphertext` are
+    the raw bytes, or None when the envelope's values are not base64, in
+    which case they travel in `extra` as they are (so does a non-string
+    sender id). None if a part is too long for its header field.
+    """
+    flags = 0
+    conv = conversation_id.encode("utf-8")
+    sender = b""
+    if type(sender_id) is str:
+        sender = sender_id.encode("utf-8")
+        flags |= FLAG_SENDER
+    if iv is not None:
+        flags |= FLAG_IV
+    if ciphertext is not None:
+        flags |= FLAG_CIPHERTEXT
+    extra = {k: v for k, v in envelope.items() if k not in _CARRIED}
+    if not flags & FLAG_SENDER and "senderId" in envelope:
+        extra["senderId"] = envelope["senderId"]
+    if iv is None and "iv" in envelope:
+        extra["iv"] = envelope["iv"]
+    if ciphertext is None and "ciphertext" in envelope:
+        extra["ciphertext"] = envelope["ciphertext"]
+    extra_bytes = codec.encode(extra) if extra else b""
+    iv = iv or b""
+    ciphertext = ciphertext or b""
+    if max(len(conv), len(sender), len(iv)) > 0xFFFF or max(len(ciphertext), len(extra_bytes)) > 0xFFFFFFFF:
+        return None
+    return b"".join((
+        HEADER.pack(KIND_MESSAGE, flags, seq, len(conv), len(sender), len(iv), len(ciphertext), len(extra_bytes)),
+        conv,
+        sender,
+        iv,
+        ciphertext,
+        extra_bytes,
+    ))
+
@@ -0,0 +1,108 @@
+# chatspot/broker.py
+"""
+Backplane broker for worker processes on one host (see backplane.py).
+
+Workers connect over a Unix domain socket and publish envelopes; the
+broker numbers each one per conversation and sends the event to every
+connected worker, coalescing what it writes to a worker in one loop pass
+into a single write. It keeps nothing but the per-conversation counters.
+A worker whose unsent events exceed `max_buffer` bytes is disconnected
+rather than letting the broker's memory grow; it reconnects and resumes
+from whatever it missed being only in the store.
+
+    python -m chatspot.broker [--path /tmp/chatspot-backplane.sock]
+"""
+import argparse
+import asyncio
+import logging
+import os
+from typing import Dict, Optional, Set
+
+from . import config
+from .backplane import PUBLISH, Outbox, pack_event, read_frames, unpack_publish
+from .history import add_seq
+
+logger = logging.getLogger(__name__)
+
+
+class Broker:
+    def __init__(self, path: str = config.BACKPLANE_PATH, max_buffer: int = config.BACKPLANE_MAX_BUFFER):
+        self.path = path
+        self.max_buffer = max_buffer
+        self._seqs: Dict[bytes, int] = {}
+        self._workers: Set[Outbox] = set()
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self) -> None:
+        if os.path.exists(self.path):
+            try:
+                _, writer = await asyncio.open_unix_connection(self.path)
+            except OSError:
+                # left behind by a broker that is gone
+                os.unlink(self.path)
+            else:
+                writer.close()
+                raise RuntimeError("a broker is already listening on %s" % self.path)
+        self._server = await asyncio.start_unix_server(self._serve, self.path)
+        logger.info("backplane broker listening on %s", self.path)
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        for outbox in list(self._workers):
+            outbox.writer.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        outbox = Outbox(writer)
+        self._workers.add(outbox)
+        logger.info("worker connected (%d total)", len(self._workers))
+        try:
+            async for kind, body in read_frames(reader):
+                if kind == PUBLISH:
+                    self._publish(outbox, body)
+        finally:
+            self._workers.discard(outbox)
+            writer.close()
+            logger.info("worker disconnected (%d left)", len(self._workers))
+
+    def _publish(self, sender: Outbox, body: bytes) -> None:
+        conv, encoded, last_seq = unpack_publish(body)
+        seq = max(self._seqs.get(conv, 0), last_seq) + 1
+        self._seqs[conv] = seq
+        encoded = add_seq(encoded, seq)
+        event = pack_event(conv, seq, encoded, False)
+        for outbox in list(self._workers):
+            if outbox.buffered > self.max_buffer:
+                logger.warning("disconnecting a worker that is %d bytes behind", outbox.buffered)
+                self._workers.discard(outbox)
+                outbox.writer.close()
+                continue
+            outbox.write(pack_event(conv, seq, encoded, True) if outbox is sender else event)
+
+
+async def serve(path: str) -> None:
+    broker = Broker(path)
+    await broker.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await broker.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Chatspot backplane broker")
+    parser.add_argument("--path", default=config.BACKPLANE_PATH, help="Unix socket to listen on")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    try:
+        asyncio.run(serve(args.path))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+# chatspot/codec.py
+"""
+The JSON codec every frame goes through.
+
+Backends, chosen by CHATSPOT_JSON_CODEC ("auto" takes the first one that
+is installed, in this order):
+
+- orjson:  orjson.loads / orjson.dumps
+- msgspec: msgspec.json.Decoder / msgspec.json.Encoder
+- json:    the standard library (always available)
+
+Whatever the backend, `decode` accepts str or bytes, `encode` returns
+compact UTF-8 bytes (what is stored and what a binary frame would carry)
+and `encode_text` returns the same document as str for `send_text`; each
+backend produces that directly rather than encoding and decoding again.
+The active backend's functions are bound at module level, so a call costs
+no more than calling the library itself.
+"""
+import json
+from typing import Any, Callable, Dict, List, Tuple, Type
+
+from . import config
+
+BACKENDS = ("orjson", "msgspec", "json")
+
+
+class Codec:
+    __slots__ = ("name", "decode", "encode", "encode_text", "errors")
+
+    def __init__(
+        self,
+        name: str,
+        decode: Callable[[Any], Any],
+        encode: Callable[[Any], bytes],
+        encode_text: Callable[[Any], str],
+        errors: Tuple[Type[BaseException], ...],
+    ):
+        self.name = name
+        self.decode = decode
+        self.encode = encode
+        self.encode_text = encode_text
+        # what `decode` raises for malformed input
+        self.errors = errors
+
+
+def _orjson() -> Codec:
+    import orjson
+
+    dumps = orjson.dumps
+    return Codec("orjson", orjson.loads, dumps, lambda obj: dumps(obj).decode("utf-8"), (orjson.JSONDecodeError,))
+
+
+def _msgspec() -> Codec:
+    import msgspec
+
+    decoder = msgspec.json.Decoder()
+    encode = msgspec.json.Encoder().encode
+    return Codec(
+        "msgspec",
+        decoder.decode,
+        encode,
+        lambda obj: encode(obj).decode("utf-8"),
+        (msgspec.DecodeError, UnicodeDecodeError),
+    )
+
+
+def _stdlib() -> Codec:
+    # compact and UTF-8, like the other backends
+    dumps = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False).encode
+    return Codec(
+        "json",
+        json.loads,
+        lambda obj: dumps(obj).encode("utf-8"),
+        dumps,
+        (ValueError,),
+    )
+
+
+_FACTORIES: Dict[str, Callable[[], Codec]] = {"orjson": _orjson, "msgspec": _msgspec, "json": _stdlib}
+
+
+def get_codec(name: str = "auto") -> Codec:
+    """
+    The named backend, or with "auto" the first installed one.
+    Raises ImportError if a named backend is not installed.
+    """
+    if name == "auto":
+        for candidate in BACKENDS:
+            try:
+                return _FACTORIES[candidate]()
+            except ImportError:
+                continue
+    if name not in _FACTORIES:
+        raise ValueError("unknown JSON codec %r (expected auto or one of %s)" % (name, ", ".join(BACKENDS)))
+    return _FACTORIES[name]()
+
+
+def available() -> List[str]:
+    """
+    Names of the backends that can be loaded here.
+    """
+    names = []
+    for name in BACKENDS:
+        try:
+            _FACTORIES[name]()
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+
+active = get_codec(config.JSON_CODEC)
+name = active.name
+decode = active.decode
+encode = active.encode
+encode_text = active.encode_text
+DecodeError = active.errors
@@ -0,0 +1,164 @@
+# chatspot/config.py
+"""
+Runtime settings, read once from environment variables at import time.
+
+The defaults run one worker process with no external services (memory
+store, no backplane, no sharding), like the original prototype, but these
+change what a client sees:
+
+- `subscribe` is answered with the newest HISTORY_INITIAL_TAIL (100)
+  envelopes, not the whole history; older ones are paged with `history`
+- memory keeps HISTORY_MAX_RECORDS / HISTORY_MAX_BYTES per conversation
+  and HISTORY_MEMORY_BUDGET in all; with the memory store what is dropped
+  is gone
+- FANOUT_MODE is "queued": a client that does not keep up loses frames or
+  is disconnected (OUTBOUND_*), and a send stalled for FANOUT_SEND_TIMEOUT
+  drops the connection, instead of every send being awaited in turn
+- load shedding is on (LAG_*: 100 / 250 / 500 ms)
+- inbound frames over MAX_FRAME_BYTES are ignored
+
+FANOUT_MODE=serial, FANOUT_SEND_TIMEOUT=0 and 0 for the HISTORY_MAX_* /
+HISTORY_MEMORY_BUDGET caps and the LAG_* thresholds turn all but the first
+and last of these off.
+"""
+import os
+
+
+def _env_str(name: str, default: str) -> str:
+    return os.environ.get(name, default)
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.environ.get(name)
+    if value is None or value == "":
+        return default
+    return int(value)
+
+
+def _env_float(name: str, default: float) -> float:
+    value = os.environ.get(name)
+    if value is None or value == "":
+        return default
+    return float(value)
+
+
+# JSON codec: "auto" (orjson, else msgspec, else the standard library),
+# "orjson", "msgspec" or "json"
+JSON_CODEC = _env_str("CHATSPOT_JSON_CODEC", "auto")
+# inbound frames longer than this are dropped without being parsed
+MAX_FRAME_BYTES = _env_int("CHATSPOT_MAX_FRAME_BYTES", 1024 * 1024)
+
+# fan-out of `message` frames to the subscribers of a conversation
+# mode: "queued" (hand frames to each connection's writer task),
+# "concurrent" (send to all sockets at once) or "serial" (one after another)
+FANOUT_MODE = _env_str("CHATSPOT_FANOUT_MODE", "queued")
+# maximum number of sends in flight for a single fan-out
+FANOUT_CONCURRENCY = _env_int("CHATSPOT_FANOUT_CONCURRENCY", 256)
+# seconds a single send may take before the socket is considered dead
+FANOUT_SEND_TIMEOUT = _env_float("CHATSPOT_FANOUT_SEND_TIMEOUT", 5.0)
+
+# per-conversation actors (see actor.py): an actor with nothing to do for
+# this long is stopped
+ACTOR_IDLE_MS = _env_int("CHATSPOT_ACTOR_IDLE_MS", 30000)
+# messages waiting for a conversation's actor before senders have to wait
+ACTOR_MAILBOX = _env_int("CHATSPOT_ACTOR_MAILBOX", 1024)
+
+# load shedding on event-loop lag (see overload.py): how often the lag is
+# sampled, and the average lag at which each stage starts (0 = never)
+LAG_INTERVAL_MS = _env_int("CHATSPOT_LAG_INTERVAL_MS", 100)
+LAG_DEFER_HISTORY_MS = _env_int("CHATSPOT_LAG_DEFER_HISTORY_MS", 100)
+LAG_REJECT_SUBSCRIBE_MS = _env_int("CHATSPOT_LAG_REJECT_SUBSCRIBE_MS", 250)
+LAG_REFUSE_CONNECT_MS = _env_int("CHATSPOT_LAG_REFUSE_CONNECT_MS", 500)
+# longest a deferred `history` request waits
+LAG_DEFER_MAX_MS = _env_int("CHATSPOT_LAG_DEFER_MAX_MS", 2000)
+# retry hint given to rejected subscriptions and refused connections
+LAG_RETRY_AFTER_MS = _env_int("CHATSPOT_LAG_RETRY_AFTER_MS", 5000)
+
+# per-connection outbound queue (used when FANOUT_MODE is "queued")
+OUTBOUND_QUEUE_FRAMES = _env_int("CHATSPOT_OUTBOUND_QUEUE_FRAMES", 1024)
+OUTBOUND_QUEUE_BYTES = _env_int("CHATSPOT_OUTBOUND_QUEUE_BYTES", 8 * 1024 * 1024)
+# what to do when a frame of a given class does not fit into a full queue:
+# "drop-oldest", "drop-newest" or "disconnect"
+OUTBOUND_POLICIES = {
+    "message": _env_str("CHATSPOT_OUTBOUND_POLICY_MESSAGE", "drop-oldest"),
+    "history": _env_str("CHATSPOT_OUTBOUND_POLICY_HISTORY", "disconnect"),
+    "control": _env_str("CHATSPOT_OUTBOUND_POLICY_CONTROL", "disconnect"),
+}
+# `batch` frames, for connections that ask for them at identify (queued
+# mode): queued `message` frames are merged into one, up to this many
+# envelopes / envelope bytes ...
+BATCH_MAX_FRAMES = _env_int("CHATSPOT_BATCH_MAX_FRAMES", 64)
+BATCH_MAX_BYTES = _env_int("CHATSPOT_BATCH_MAX_BYTES", 256 * 1024)
+# ... after waiting this long for more to be queued (0 = merge only what is
+# already waiting, adding no latency)
+BATCH_WINDOW_MS = _env_int("CHATSPOT_BATCH_WINDOW_MS", 0)
+
+# history
+# envelopes sent with the `history` reply to `subscribe`
+HISTORY_INITIAL_TAIL = _env_int("CHATSPOT_HISTORY_INITIAL_TAIL", 100)
+# largest page a `history` request may ask for
+HISTORY_PAGE_MAX = _env_int("CHATSPOT_HISTORY_PAGE_MAX", 500)
+# a `subscribe` with `sinceSeq` further behind than this gets a reset
+# instead of the gap
+HISTORY_RESUME_MAX = _env_int("CHATSPOT_HISTORY_RESUME_MAX", 5000)
+# in-memory retention per conversation: the newest HISTORY_MAX_RECORDS
+# envelopes, at most HISTORY_MAX_BYTES encoded bytes (0 = no cap); older ones
+# are only in the durable store
+HISTORY_MAX_RECORDS = _env_int("CHATSPOT_HISTORY_MAX_RECORDS", 10000)
+HISTORY_MAX_BYTES = _env_int("CHATSPOT_HISTORY_MAX_BYTES", 16 * 1024 * 1024)
+# encoded bytes held by all conversations together; the least recently
+# active conversations are evicted first (0 = no budget)
+HISTORY_MEMORY_BUDGET = _env_int("CHATSPOT_HISTORY_MEMORY_BUDGET", 256 * 1024 * 1024)
+
+# durable storage behind the in-memory history
+# "memory" (nothing survives a restart), "log" (segment log in LOG_DIR) or
+# "sqlite" (SQLITE_PATH); defaults to "log" when LOG_DIR is set
+LOG_DIR = _env_str("CHATSPOT_LOG_DIR", "")
+STORE = _env_str("CHATSPOT_STORE", "log" if LOG_DIR else "memory")
+# "always" (sync every commit), "interval" or "os"
+STORE_FSYNC = _env_str("CHATSPOT_STORE_FSYNC", "interval")
+# write-behind group commit: envelopes are committed in one batch once the
+# oldest is this old (the durability window) ...
+STORE_COMMIT_WINDOW_MS = _env_int("CHATSPOT_STORE_COMMIT_WINDOW_MS", 10)
+# ... or once this many envelopes / bytes are waiting
+STORE_COMMIT_MAX_RECORDS = _env_int("CHATSPOT_STORE_COMMIT_MAX_RECORDS", 2048)
+STORE_COMMIT_MAX_BYTES = _env_int("CHATSPOT_STORE_COMMIT_MAX_BYTES", 4 * 1024 * 1024)
+# envelopes per conversation loaded back into memory at startup
+STORE_RECOVER_RECENT = _env_int("CHATSPOT_STORE_RECOVER_RECENT", 1000)
+
+# segment log (STORE=log)
+LOG_SHARDS = _env_int("CHATSPOT_LOG_SHARDS", 16)
+LOG_SEGMENT_BYTES = _env_int("CHATSPOT_LOG_SEGMENT_BYTES", 64 * 1024 * 1024)
+LOG_FSYNC_INTERVAL_MS = _env_int("CHATSPOT_LOG_FSYNC_INTERVAL_MS", 100)
+
+# SQLite (STORE=sqlite)
+SQLITE_PATH = _env_str("CHATSPOT_SQLITE_PATH", "chatspot.db")
+# threads serving reads; writes always go through a single thread
+SQLITE_READERS = _env_int("CHATSPOT_SQLITE_READERS", 2)
+
+# sharing messages between worker processes (see backplane.py):
+# "none" (one worker), "unix" (broker on BACKPLANE_PATH, one host), "redis"
+# (Redis at REDIS_URL, several nodes) or "local" (in-process, for tests).
+# "unix" workers must share the store (STORE=sqlite at one SQLITE_PATH, or
+# memory): only the worker a message was sent to persists it. "redis" nodes
+# each persist every message they hold to a store of their own
+BACKPLANE = _env_str("CHATSPOT_BACKPLANE", "none")
+BACKPLANE_PATH = _env_str("CHATSPOT_BACKPLANE_PATH", "/tmp/chatspot-backplane.sock")
+# the broker disconnects a worker this many bytes behind
+BACKPLANE_MAX_BUFFER = _env_int("CHATSPOT_BACKPLANE_MAX_BUFFER", 64 * 1024 * 1024)
+# how long a missing seq holds back later ones before it is given up on
+BACKPLANE_GAP_MS = _env_int("CHATSPOT_BACKPLANE_GAP_MS", 1000)
+# redis://host:port/db or unix:///path/to/socket
+REDIS_URL = _env_str("CHATSPOT_REDIS_URL", "redis://127.0.0.1:6379/0")
+# newest envelopes Redis keeps per conversation for nodes that start
+# watching it (0 = none)
+REDIS_BACKLOG = _env_int("CHATSPOT_REDIS_BACKLOG", 1000)
+
+# conversation sharding across the worker processes of one host (see
+# sharding.py), instead of a backplane: the directory holding each worker's
+# slot lock and socket; empty = off
+SHARD_DIR = _env_str("CHATSPOT_SHARD_DIR", "")
+# points per worker on the hash ring
+SHARD_VNODES = _env_int("CHATSPOT_SHARD_VNODES", 64)
+# how often workers look for others joining or leaving
+SHARD_REFRESH_MS = _env_int("CHATSPOT_SHARD_REFRESH_MS", 1000)
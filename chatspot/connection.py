@@ -0,0 +1,376 @@
+# chatspot/connection.py
+"""
+Per-socket state for an accepted WebSocket.
+
+In queued mode every outbound frame goes through a bounded queue that a
+dedicated writer task drains, so the read loop that produced a frame never
+waits on the socket that consumes it. When a queue is full the policy for the
+incoming frame's class decides what gives:
+
+- drop-oldest: discard the oldest queued frame of the same class
+- drop-newest: discard the incoming frame
+- disconnect:  treat the client as a slow consumer and close it
+
+While the history for a conversation is being sent, live frames for that
+conversation are held back (see `begin_handoff`) and released afterwards in
+seq order, minus any the history already contained. Held frames count
+against the queue's limits; past them they are dropped, and
+`finish_handoff` tells the caller to catch the client up from the history
+instead.
+
+A connection that asked for `batch` frames at identify gets the `message`
+frames waiting in its queue merged into one `{"action": "batch",
+"envelopes": [...]}` frame -- one WebSocket frame, one write and one client
+dispatch for what would have been many. Only consecutive JSON `message`
+frames are merged, so the order of everything sent is unchanged.
+
+Frames are queued as Frame objects (frame.py), shared with every other
+connection the same frame goes to; a str payload is sent as text, bytes as
+binary (see binary.py).
+"""
+import asyncio
+import itertools
+import logging
+from collections import deque
+from typing import Deque, Dict, Optional, Set, Tuple, Union
+
+from fastapi import WebSocket
+
+from . import config, metrics
+from .frame import Frame
+
+logger = logging.getLogger(__name__)
+
+batch_frames = metrics.counter("chatspot_batch_frames_total", "`batch` frames sent")
+batched_messages = metrics.counter("chatspot_batched_messages_total", "`message` frames merged into `batch` frames")
+sent_frames = metrics.labeled_counter("chatspot_frames_sent_total", "Outbound frames written, by class", "class")
+sent_bytes = metrics.labeled_counter(
+    "chatspot_frames_sent_bytes_total", "Outbound frame bytes written, by class (characters for text frames)", "class"
+)
+
+DROP_OLDEST = "drop-oldest"
+DROP_NEWEST = "drop-newest"
+DISCONNECT = "disconnect"
+POLICIES = (DROP_OLDEST, DROP_NEWEST, DISCONNECT)
+
+# a text (str) or binary (bytes) WebSocket frame, or a shared Frame
+Payload = Union[str, bytes, Frame]
+
+# close code sent to clients that cannot keep up (RFC 6455 "try again later")
+SLOW_CONSUMER_CLOSE_CODE = 1013
+
+_ids = itertools.count(1)
+# strong references to fire-and-forget socket close tasks
+_closing: Set[asyncio.Task] = set()
+
+
+class Connection:
+    def __init__(
+        self,
+        ws: WebSocket,
+        queued: bool = True,
+        max_frames: int = config.OUTBOUND_QUEUE_FRAMES,
+        max_bytes: int = config.OUTBOUND_QUEUE_BYTES,
+        policies: Optional[Dict[str, str]] = None,
+        send_timeout: float = config.FANOUT_SEND_TIMEOUT,
+        batch_max_frames: int = config.BATCH_MAX_FRAMES,
+        batch_max_bytes: int = config.BATCH_MAX_BYTES,
+        batch_window: float = config.BATCH_WINDOW_MS / 1000,
+    ):
+        policies = dict(config.OUTBOUND_POLICIES if policies is None else policies)
+        for frame_class, policy in policies.items():
+            if policy not in POLICIES:
+                raise ValueError("unknown outbound policy %r for %r frames" % (policy, frame_class))
+        self.id = next(_ids)
+        self.ws = ws
+        self.user_id: Optional[str] = None
+        # wants `message` frames in the binary format (negotiated at identify)
+        self.binary = False
+        # wants queued `message` frames merged into `batch` frames (identify)
+        self.batch = False
+        self.batch_max_frames = batch_max_frames
+        self.batch_max_bytes = batch_max_bytes
+        self.batch_window = batch_window
+        self.queued = queued
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.policies = policies
+        self.send_timeout = send_timeout
+        self.closed = False
+
+        self._queue: Deque[Frame] = deque()
+        self._queue_bytes = 0
+        self._wakeup = asyncio.Event()
+        self._writer: Optional[asyncio.Task] = None
+        # conversation -> live (seq, frame) pairs held back during its history
+        # send; None once they overflowed and were dropped
+        self._handoffs: Dict[str, Optional[Deque[Tuple[int, Frame]]]] = {}
+        self._held_frames = 0
+        self._held_bytes = 0
+
+        self.sent = 0
+        self.batched = 0
+        self.dropped: Dict[str, int] = {}
+        self.max_depth = 0
+
+    def start(self) -> None:
+        if self.queued and self._writer is None:
+            self._writer = asyncio.create_task(self._write_loop())
+
+    async def send(self, payload: Payload, frame_class: str = "control") -> bool:
+        """
+        Queue `payload` (queued mode) or write it straight to the socket.
+        Returns False if the frame was not accepted.
+        """
+        if self.queued:
+            return self.enqueue(payload, frame_class)
+        if self.closed:
+            return False
+        await self._send_frame(Frame.of(payload, frame_class))
+        self.sent += 1
+        return True
+
+    def enqueue(self, payload: Payload, frame_class: str = "message") -> bool:
+        """
+        Non-blocking hand-off to the writer task. Applies the backpressure
+        policy for the frame's class (`frame_class` unless `payload` is a
+        Frame) when the queue is full.
+        """
+        if self.closed:
+            return False
+        frame = Frame.of(payload, frame_class)
+        frame_class = frame.frame_class
+        size = len(frame)
+        if self._is_full(size):
+            policy = self.policies.get(frame_class, DISCONNECT)
+            if policy == DROP_NEWEST:
+                self._count_drop(frame_class)
+                return False
+            if policy == DROP_OLDEST:
+                while self._is_full(size) and self._drop_oldest(frame_class):
+                    pass
+                if self._is_full(size):
+                    # nothing of this class left to make room with
+                    self._count_drop(frame_class)
+                    return False
+            else:
+                self.disconnect_slow_consumer()
+                return False
+        self._queue.append(frame)
+        self._queue_bytes += size
+        if len(self._queue) > self.max_depth:
+            self.max_depth = len(self._queue)
+        self._wakeup.set()
+        return True
+
+    def begin_handoff(self, conv: str) -> None:
+        """
+        Start holding back live frames for `conv`. Call before the history
+        snapshot is taken, without awaiting in between.
+        """
+        self._handoffs.setdefault(conv, deque())
+
+    def hold(self, conv: str, seq: int, frame: Frame) -> bool:
+        """
+        Buffer a live frame if `conv` is mid-handoff. Returns True if held
+        (or dropped because the held frames overflowed).
+        """
+        if not self._handoffs or conv not in self._handoffs:
+            return False
+        held = self._handoffs[conv]
+        if held is None:
+            return True
+        size = len(frame)
+        if self._holds_too_much(size):
+            # the client is caught up from the history once it has been sent
+            self._discard_held(held)
+            self._handoffs[conv] = None
+            self._count_drop("handoff")
+            return True
+        held.append((seq, frame))
+        self._held_frames += 1
+        self._held_bytes += size
+        return True
+
+    async def finish_handoff(self, conv: str, last_seq: int) -> bool:
+        """
+        Release the frames held for `conv` after its history (which ended at
+        `last_seq`) has been sent. Frames arriving during the release are
+        still held, so they cannot overtake the ones before them. Returns
+        False if frames after `last_seq` overflowed and were dropped; the
+        caller then has to send them from the history.
+        """
+        if conv not in self._handoffs:
+            return True
+        held = self._handoffs[conv]
+        try:
+            while held:
+                seq, frame = held.popleft()
+                self._held_frames -= 1
+                self._held_bytes -= len(frame)
+                if seq <= last_seq:
+                    # already part of the history snapshot
+                    continue
+                last_seq = seq
+                await self.send(frame, "message")
+            # the release may have been cut short by an overflow
+            return self._handoffs.get(conv) is not None
+        finally:
+            self.abort_handoff(conv)
+
+    def abort_handoff(self, conv: str) -> None:
+        """
+        Stop holding back frames for `conv` and discard those held, when
+        its history could not be sent after all.
+        """
+        held = self._handoffs.pop(conv, None)
+        if held:
+            self._discard_held(held)
+
+    def disconnect_slow_consumer(self) -> None:
+        if self.closed:
+            return
+        logger.info("disconnecting slow consumer %s (queue depth %d)", self.id, len(self._queue))
+        self._count_drop("disconnect")
+        self._close(SLOW_CONSUMER_CLOSE_CODE)
+
+    async def close(self) -> None:
+        """
+        Stop the writer task. Frames still queued are discarded.
+        """
+        self.closed = True
+        self._clear()
+        self._handoffs.clear()
+        self._held_frames = 0
+        self._held_bytes = 0
+        if self._writer is not None and self._writer is not asyncio.current_task():
+            self._writer.cancel()
+            try:
+                await self._writer
+            except (asyncio.CancelledError, Exception):
+                pass
+        self._writer = None
+
+    def stats(self) -> dict:
+        return {
+            "id": self.id,
+            "userId": self.user_id,
+            "binary": self.binary,
+            "queueDepth": len(self._queue),
+            "queueBytes": self._queue_bytes,
+            "maxQueueDepth": self.max_depth,
+            "sent": self.sent,
+            "batched": self.batched,
+            "dropped": dict(self.dropped),
+        }
+
+    @property
+    def depth(self) -> int:
+        return len(self._queue)
+
+    def _is_full(self, size: int) -> bool:
+        if not self._queue:
+            # a single oversized frame is still allowed through an empty queue
+            return False
+        return len(self._queue) >= self.max_frames or self._queue_bytes + size > self.max_bytes
+
+    def _holds_too_much(self, size: int) -> bool:
+        if not self._held_frames and not self._queue:
+            return False
+        return (
+            len(self._queue) + self._held_frames >= self.max_frames
+            or self._queue_bytes + self._held_bytes + size > self.max_bytes
+        )
+
+    def _discard_held(self, held: Deque[Tuple[int, Frame]]) -> None:
+        while held:
+            _, frame = held.popleft()
+            self._held_frames -= 1
+            self._held_bytes -= len(frame)
+
+    def _drop_oldest(self, frame_class: str) -> bool:
+        for i, frame in enumerate(self._queue):
+            if frame.frame_class == frame_class:
+                del self._queue[i]
+                self._queue_bytes -= len(frame)
+                self._count_drop(frame_class)
+                return True
+        return False
+
+    def _count_drop(self, frame_class: str) -> None:
+        self.dropped[frame_class] = self.dropped.get(frame_class, 0) + 1
+
+    def _clear(self) -> None:
+        self._queue.clear()
+        self._queue_bytes = 0
+
+    def _close(self, code: int) -> None:
+        self.closed = True
+        self._clear()
+        # wake the writer so it notices `closed`, and close the socket from a
+        # separate task; the read loop then sees the disconnect and cleans up
+        self._wakeup.set()
+        task = asyncio.create_task(self._close_socket(code))
+        _closing.add(task)
+        task.add_done_callback(_closing.discard)
+
+    async def _close_socket(self, code: int) -> None:
+        try:
+            await asyncio.wait_for(self.ws.close(code=code), 1.0)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.debug("close of connection %s failed", self.id, exc_info=True)
+
+    def _send_frame(self, frame: Frame):
+        sent_frames.labels(frame.frame_class).inc()
+        sent_bytes.labels(frame.frame_class).inc(len(frame))
+        if frame.binary:
+            return self.ws.send_bytes(frame.data)
+        return self.ws.send_text(frame.text)
+
+    async def _coalesce(self, first: Frame) -> Frame:
+        # `first` and the `message` frames queued right behind it, as one
+        # `batch` frame if there are any
+        if self.batch_window > 0 and len(self._queue) < self.batch_max_frames - 1:
+            await asyncio.sleep(self.batch_window)
+        queue = self._queue
+        envelopes = [first.envelope]
+        size = len(first.envelope)
+        while queue and len(envelopes) < self.batch_max_frames:
+            frame = queue[0]
+            if frame.envelope is None or size + len(frame.envelope) > self.batch_max_bytes:
+                break
+            queue.popleft()
+            self._queue_bytes -= len(frame)
+            envelopes.append(frame.envelope)
+            size += len(frame.envelope)
+        if len(envelopes) == 1:
+            return first
+        self.batched += len(envelopes)
+        batch_frames.inc()
+        batched_messages.inc(len(envelopes))
+        return Frame.batch(envelopes)
+
+    async def _write_loop(self) -> None:
+        while not self.closed:
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            frame = self._queue.popleft()
+            self._queue_bytes -= len(frame)
+            if self.batch and frame.envelope is not None:
+                frame = await self._coalesce(frame)
+            try:
+                if self.send_timeout > 0:
+                    await asyncio.wait_for(self._send_frame(frame), self.send_timeout)
+                else:
+                    await self._send_frame(frame)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # dead or stalled past the timeout; nothing more can be sent
+                self._close(SLOW_CONSUMER_CLOSE_CODE)
+                return
+            self.sent += 1
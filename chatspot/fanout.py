@@ -0,0 +1,173 @@
+# chatspot/fanout.py
+"""
+Fan-out of one encoded frame to every subscriber of a conversation.
+
+The engine never lets a single slow or dead socket hold up delivery to the
+rest of the room. In "queued" mode the frame is handed to each connection's
+outbound queue without awaiting anything. In "concurrent" mode sends run at
+once (bounded by `concurrency`) and each one is cut off after `send_timeout`
+seconds. Connections that fail, time out or are disconnected by their queue
+policy are returned to the caller so they can be evicted.
+
+A `message` may come in two encodings: the JSON text frame and, for
+connections that negotiated it, the binary frame (binary.py). Each is one
+Frame (frame.py) shared by every connection that gets it; each connection
+gets the one it asked for.
+"""
+import asyncio
+import logging
+import time
+from typing import Collection, Iterable, Iterator, List, Optional
+
+from fastapi import WebSocket
+
+from . import config, metrics
+from .connection import Connection
+from .frame import Frame
+
+logger = logging.getLogger(__name__)
+
+MODES = ("queued", "concurrent", "serial")
+
+fanout_seconds = metrics.histogram(
+    "chatspot_fanout_seconds", "Time to hand one frame to every subscriber (queued) or send it to them all"
+)
+fanout_recipients = metrics.histogram(
+    "chatspot_fanout_recipients", "Subscribers of the conversation per fan-out", metrics.SIZE_BUCKETS
+)
+
+
+class FanoutEngine:
+    def __init__(
+        self,
+        mode: str = config.FANOUT_MODE,
+        concurrency: int = config.FANOUT_CONCURRENCY,
+        send_timeout: float = config.FANOUT_SEND_TIMEOUT,
+    ):
+        if mode not in MODES:
+            raise ValueError("unknown fan-out mode %r (expected one of %s)" % (mode, ", ".join(MODES)))
+        if concurrency < 1:
+            raise ValueError("fan-out concurrency must be >= 1")
+        self.mode = mode
+        self.concurrency = concurrency
+        self.send_timeout = send_timeout
+
+    @property
+    def queued(self) -> bool:
+        return self.mode == "queued"
+
+    async def broadcast(
+        self,
+        targets: Collection[Connection],
+        payload: Frame,
+        conv: Optional[str] = None,
+        seq: Optional[int] = None,
+        binary: Optional[Frame] = None,
+    ) -> List[Connection]:
+        """
+        Send `payload` to every connection in `targets` (`binary` instead to
+        binary connections, if given). When `conv` and `seq` are given,
+        connections still receiving the history of `conv` hold the frame
+        back instead (see Connection.begin_handoff).
+        Returns the connections whose send raised, timed out or was refused.
+        """
+        started = time.perf_counter()
+        fanout_recipients.observe(len(targets))
+        try:
+            return await self._broadcast(targets, payload, binary, conv, seq)
+        finally:
+            fanout_seconds.observe(time.perf_counter() - started)
+
+    async def _broadcast(
+        self,
+        targets: Collection[Connection],
+        payload: Frame,
+        binary: Optional[Frame],
+        conv: Optional[str],
+        seq: Optional[int],
+    ) -> List[Connection]:
+        if self.queued:
+            return self._enqueue(targets, payload, binary, conv, seq)
+        if conv is not None:
+            targets = [c for c in targets if not c.hold(conv, seq, _pick(c, payload, binary))]
+        else:
+            targets = list(targets)
+        if not targets:
+            return []
+        if self.mode == "serial":
+            return await self._serial(targets, payload, binary)
+        return await self._concurrent(targets, payload, binary)
+
+    def _enqueue(
+        self,
+        targets: Iterable[Connection],
+        payload: Frame,
+        binary: Optional[Frame],
+        conv: Optional[str],
+        seq: Optional[int],
+    ) -> List[Connection]:
+        failed = []
+        for conn in targets:
+            frame = _pick(conn, payload, binary)
+            if conv is not None and conn.hold(conv, seq, frame):
+                continue
+            # a full queue either drops a frame or closes the connection,
+            # depending on the policy for the frame's class
+            conn.enqueue(frame)
+            if conn.closed:
+                failed.append(conn)
+        return failed
+
+    async def _send(self, conn: Connection, payload: Frame) -> bool:
+        try:
+            if self.send_timeout > 0:
+                await asyncio.wait_for(conn.send(payload, "message"), self.send_timeout)
+            else:
+                await conn.send(payload, "message")
+            return True
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # connection likely dead or too slow; caller evicts it
+            return False
+
+    async def _serial(self, targets: List[Connection], payload: Frame, binary: Optional[Frame]) -> List[Connection]:
+        failed = []
+        for conn in targets:
+            if not await self._send(conn, _pick(conn, payload, binary)):
+                failed.append(conn)
+        return failed
+
+    async def _concurrent(self, targets: List[Connection], payload: Frame, binary: Optional[Frame]) -> List[Connection]:
+        if len(targets) == 1:
+            return await self._serial(targets, payload, binary)
+
+        failed: List[Connection] = []
+        pending: Iterator[Connection] = iter(targets)
+
+        # a fixed pool of workers pulls from one shared iterator, so a room of
+        # 10k sockets costs `concurrency` tasks rather than 10k
+        async def worker() -> None:
+            for conn in pending:
+                if not await self._send(conn, _pick(conn, payload, binary)):
+                    failed.append(conn)
+
+        workers = min(self.concurrency, len(targets))
+        await asyncio.gather(*(worker() for _ in range(workers)))
+        return failed
+
+
+def _pick(conn: Connection, payload: Frame, binary: Optional[Frame]) -> Frame:
+    return binary if binary is not None and conn.binary else payload
+
+
+async def close_quietly(ws: WebSocket, code: int = 1011, timeout: float = 1.0) -> None:
+    """
+    Best-effort close of an evicted socket; never raises.
+    """
+    try:
+        await asyncio.wait_for(ws.close(code=code), timeout)
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        logger.debug("close of evicted socket failed", exc_info=True)
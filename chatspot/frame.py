@@ -0,0 +1,73 @@
+# chatspot/frame.py
+"""
+Outbound WebSocket frames, encoded once and shared.
+
+A fan-out builds one Frame per encoding (JSON text, and binary if any
+subscriber negotiated it) and hands the same object to every recipient's
+outbound queue; nothing is encoded, decoded or copied per recipient. A
+Frame also carries its class (message, history, control), so a queue holds
+the frames themselves rather than a (class, payload) pair per entry.
+
+A text frame may be built from its str or from its UTF-8 bytes (e.g. a
+slice of stored envelopes); the other form is made the first time it is
+asked for and kept. The ASGI server still encodes the str of a text frame
+for each socket it writes it to; binary frames go out as they are.
+"""
+from typing import List, Optional, Union
+
+
+class Frame:
+    __slots__ = ("frame_class", "binary", "envelope", "_data", "_text")
+
+    def __init__(
+        self,
+        payload: Union[str, bytes],
+        frame_class: str = "message",
+        binary: bool = False,
+        envelope: Optional[bytes] = None,
+    ):
+        self.frame_class = frame_class
+        # sent as a binary WebSocket frame (bytes only) rather than text
+        self.binary = binary
+        # the encoded envelope of a JSON `message` frame, for merging it
+        # into a `batch` frame
+        self.envelope = envelope
+        self._data: Optional[bytes] = None
+        self._text: Optional[str] = None
+        if type(payload) is str:
+            self._text = payload
+        else:
+            self._data = payload
+
+    @classmethod
+    def of(cls, payload: Union["Frame", str, bytes], frame_class: str) -> "Frame":
+        """
+        `payload` as a Frame: str is sent as text, bytes as binary.
+        """
+        if type(payload) is Frame:
+            return payload
+        return cls(payload, frame_class, binary=type(payload) is not str)
+
+    @property
+    def data(self) -> bytes:
+        if self._data is None:
+            self._data = self._text.encode("utf-8")
+        return self._data
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = self._data.decode("utf-8")
+        return self._text
+
+    @classmethod
+    def batch(cls, envelopes: List[bytes]) -> "Frame":
+        """
+        One `batch` frame carrying the envelopes of several `message` frames.
+        """
+        return cls(b'{"action":"batch","envelopes":[%s]}' % b",".join(envelopes))
+
+    def __len__(self) -> int:
+        # what the outbound queue caps count: encoded bytes when known,
+        # characters (the same for ASCII JSON) otherwise
+        return len(self._data) if self._data is not None else len(self._text)
@@ -0,0 +1,496 @@
+# chatspot/history.py
+"""
+In-memory conversation history with pre-serialized envelopes.
+
+Every stored envelope gets a per-conversation sequence number (`seq`,
+starting at 1) and is encoded once, when it is stored. Each conversation
+keeps nothing but the comma-joined encoding of its history, extended on
+every append, plus the offset of every record in it -- no per-message
+objects. A `history` frame for any range of records is then a single slice
+of that buffer, never a re-encoding of the envelopes.
+
+Memory is bounded. Each conversation keeps only its newest
+HISTORY_MAX_RECORDS envelopes / HISTORY_MAX_BYTES encoded bytes, dropping
+from the front like a ring buffer, and a `HistoryBudget` caps the bytes held
+by all conversations together by evicting the least recently active ones.
+What is dropped stays readable from the durable store, if one is configured.
+"""
+import base64
+import binascii
+import sys
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+from . import codec, config, metrics
+from .frame import Frame
+
+held_bytes = metrics.gauge("chatspot_history_bytes", "Encoded envelope bytes held in memory by all conversations")
+dropped_records = metrics.counter(
+    "chatspot_history_dropped_records_total", "Envelopes dropped from memory by the retention caps or the memory budget"
+)
+
+
+# iv / ciphertext of a StoredEnvelope not decoded yet
+_UNDECODED = object()
+
+
+class StoredEnvelope:
+    """
+    An envelope as the message path handles it: its seq, the interned
+    conversation and sender ids, iv and ciphertext as raw bytes (None if
+    missing or not base64), and the exact encoding that goes out on the
+    wire. Histories keep only the encoding, so these are not retained.
+    iv and ciphertext are base64-decoded from the envelope the first time
+    they are asked for -- only binary frames need them.
+    """
+
+    __slots__ = ("seq", "conversation_id", "sender_id", "encoded", "_envelope", "_iv", "_ciphertext")
+
+    def __init__(
+        self,
+        seq: int,
+        conversation_id,
+        sender_id,
+        iv: Optional[bytes],
+        ciphertext: Optional[bytes],
+        encoded: bytes,
+        envelope: Optional[dict] = None,
+    ):
+        self.seq = seq
+        self.conversation_id = conversation_id
+        self.sender_id = sender_id
+        self.encoded = encoded
+        self._envelope = envelope
+        self._iv = iv
+        self._ciphertext = ciphertext
+
+    @classmethod
+    def from_envelope(cls, seq: int, envelope: dict, encoded: bytes) -> "StoredEnvelope":
+        return cls(
+            seq,
+            intern_id(envelope.get("conversationId")),
+            intern_id(envelope.get("senderId")),
+            _UNDECODED,
+            _UNDECODED,
+            encoded,
+            envelope,
+        )
+
+    @property
+    def iv(self) -> Optional[bytes]:
+        if self._iv is _UNDECODED:
+            self._iv = _raw(self._envelope.get("iv"))
+        return self._iv
+
+    @property
+    def ciphertext(self) -> Optional[bytes]:
+        if self._ciphertext is _UNDECODED:
+            self._ciphertext = _raw(self._envelope.get("ciphertext"))
+        return self._ciphertext
+
+
+def intern_id(value):
+    """
+    Conversation and sender ids repeat across millions of envelopes and
+    every registry; interning keeps one copy of each.
+    """
+    return sys.intern(value) if type(value) is str else value
+
+
+def _raw(value) -> Optional[bytes]:
+    if type(value) is not str:
+        return None
+    try:
+        return base64.b64decode(value, validate=True)
+    except (binascii.Error, ValueError):
+        return None
+
+
+def encode_envelope(envelope: dict) -> bytes:
+    return codec.encode(envelope)
+
+
+def add_seq(encoded: bytes, seq: int) -> bytes:
+    """
+    The encoding of a (non-empty) envelope object encoded without a `seq`,
+    with `"seq": seq` added as its last field.
+    """
+    return b"%s,\"seq\":%d}" % (encoded[:encoded.rindex(b"}")], seq)
+
+
+class ConversationHistory:
+    """
+    The newest envelopes of one conversation, held as columns rather than
+    per-message objects: the comma-joined encodings in one bytearray and
+    the start offset of each in an array('Q'). Records hold consecutive
+    seqs, so a record's seq is its position plus the seq of the first one.
+    """
+
+    def __init__(
+        self,
+        conversation_id: str,
+        max_records: int = config.HISTORY_MAX_RECORDS,
+        max_bytes: int = config.HISTORY_MAX_BYTES,
+        budget: Optional["HistoryBudget"] = None,
+    ):
+        self.conversation_id = intern_id(conversation_id)
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.budget = budget
+        self.last_seq = 0
+        # b"<env0>,<env1>,..." -- the inside of the JSON history array
+        self._encoded = bytearray()
+        # start offset of each record in `_encoded`
+        self._starts = array("Q")
+        # seq of the record at `_starts[0]`
+        self._base_seq = 1
+        # records before `_head` have been dropped but not compacted away yet
+        self._head = 0
+        self._frame_prefix = '{"action":"history","conversationId":%s,"history":[' % codec.encode_text(conversation_id)
+        # last assembled tail frame: (last_seq, limit, frame)
+        self._tail_frame: Optional[Tuple[int, int, str]] = None
+
+    def append(self, envelope: dict) -> StoredEnvelope:
+        """
+        Assign the next sequence number to `envelope` and store it.
+        """
+        self.last_seq += 1
+        envelope["seq"] = self.last_seq
+        record = StoredEnvelope.from_envelope(self.last_seq, envelope, encode_envelope(envelope))
+        self._push(record.seq, record.encoded)
+        return record
+
+    def append_numbered(self, seq: int, encoded: bytes) -> StoredEnvelope:
+        """
+        Store an envelope numbered elsewhere (by the backplane); `encoded`
+        already contains its seq. The record carries only the encoding.
+        """
+        if seq != self.last_seq + 1 and len(self):
+            # records held must have consecutive seqs; what was missed is
+            # only in the store now, so start over from this one
+            self.clear()
+        self._push(seq, encoded)
+        self.last_seq = seq
+        return StoredEnvelope(seq, self.conversation_id, None, None, None, encoded)
+
+    def restore(self, records: List[Tuple[int, bytes]]) -> None:
+        """
+        Load already numbered (seq, encoded envelope) records, oldest first,
+        e.g. the tail of a conversation recovered from disk. Records held
+        must have consecutive seqs, so only the newest run of them is kept
+        (and what is held already only if the run follows it).
+        """
+        if not records:
+            return
+        start = len(records) - 1
+        while start and records[start - 1][0] == records[start][0] - 1:
+            start -= 1
+        if len(self) and records[start][0] != self.last_seq + 1:
+            self.clear()
+        for seq, encoded in records[start:]:
+            self._push(seq, encoded)
+            self.last_seq = seq
+
+    def _push(self, seq: int, encoded: bytes) -> None:
+        before = len(self._encoded)
+        if len(self._starts) > self._head:
+            self._encoded += b","
+        else:
+            self._base_seq = seq
+        self._starts.append(len(self._encoded))
+        self._encoded += encoded
+        # the new record and its separator; what the caps drop next is
+        # released by drop_oldest
+        added = len(self._encoded) - before
+        self._enforce_caps()
+        if self.budget is not None:
+            self.budget.charge(self, added)
+
+    def _enforce_caps(self) -> None:
+        # the newest record is always kept, even if it alone exceeds max_bytes
+        starts = self._starts
+        count = len(starts)
+        keep_from = self._head
+        if self.max_records and count - keep_from > self.max_records:
+            keep_from = count - self.max_records
+        if self.max_bytes and len(self._encoded) - starts[keep_from] > self.max_bytes:
+            keep_from = bisect_left(starts, len(self._encoded) - self.max_bytes, keep_from, count - 1)
+        if keep_from > self._head:
+            self.drop_oldest(keep_from - self._head)
+
+    def drop_oldest(self, count: int) -> None:
+        """
+        Forget the `count` oldest records held. `last_seq` is kept, so
+        numbering continues; the records stay in the durable store, if any.
+        """
+        count = min(count, len(self))
+        if count <= 0:
+            return
+        end = self._head + count
+        stop = self._starts[end] if end < len(self._starts) else len(self._encoded)
+        freed = stop - self._starts[self._head]
+        self._head = end
+        self._tail_frame = None
+        dropped_records.inc(count)
+        if self._head == len(self._starts):
+            self._encoded = bytearray()
+            self._starts = array("Q")
+            self._head = 0
+        elif self._head * 2 >= len(self._starts):
+            self._compact()
+        if self.budget is not None:
+            self.budget.release(self, freed)
+
+    def clear(self) -> None:
+        self.drop_oldest(len(self))
+
+    def _compact(self) -> None:
+        # cut the dropped prefix once it is at least half of the buffers, so
+        # dropping from the front stays O(1) amortized per record
+        head = self._head
+        base = self._starts[head]
+        del self._encoded[:base]
+        self._starts = array("Q", [start - base for start in self._starts[head:]])
+        self._base_seq += head
+        self._head = 0
+
+    def __len__(self) -> int:
+        return len(self._starts) - self._head
+
+    @property
+    def first_seq(self) -> int:
+        """
+        Sequence number of the oldest record held (last_seq + 1 if empty).
+        """
+        return self._base_seq + self._head if len(self) else self.last_seq + 1
+
+    def covers(self, since: int) -> bool:
+        """
+        Whether every record after seq `since` is still held, i.e. a client
+        that has seen up to `since` can catch up from memory alone.
+        """
+        return self.first_seq - 1 <= since <= self.last_seq
+
+    @property
+    def encoded_size(self) -> int:
+        """
+        Bytes of the records held, separators included (what the caps and
+        the budget count).
+        """
+        return len(self._encoded) - self._starts[self._head] if len(self) else 0
+
+    def held(self) -> List[Tuple[int, bytes]]:
+        """
+        (seq, encoded) of every record held, oldest first.
+        """
+        first = self.first_seq
+        with memoryview(self._encoded) as view:
+            return [
+                (first + i, bytes(view[self._starts[self._head + i]:self._end(self._head + i)]))
+                for i in range(len(self))
+            ]
+
+    def tail_frame(self, limit: int) -> str:
+        """
+        `history` frame with the newest `limit` records.
+        """
+        cached = self._tail_frame
+        if cached is not None and cached[0] == self.last_seq and cached[1] == limit:
+            return cached[2]
+        end = len(self)
+        start = max(0, end - limit)
+        frame = self._frame(start, end, has_more=start > 0)
+        self._tail_frame = (self.last_seq, limit, frame)
+        return frame
+
+    def before_frame(self, before: int, limit: int) -> str:
+        """
+        `history` frame with up to `limit` records older than seq `before`.
+        """
+        end = self._index(before)
+        start = max(0, end - limit)
+        return self._frame(start, end, has_more=start > 0)
+
+    def after_frame(self, after: int, limit: int) -> str:
+        """
+        `history` frame with up to `limit` records newer than seq `after`.
+        """
+        start = self._index(after + 1)
+        end = min(len(self), start + limit)
+        return self._frame(start, end, has_more=end < len(self))
+
+    def resume_frames(self, since: int, limit: int) -> List[str]:
+        """
+        Every record newer than seq `since`, as consecutive `history` frames
+        of at most `limit` records each.
+        """
+        start = self._index(since + 1)
+        total = len(self)
+        frames = []
+        while True:
+            end = min(total, start + limit)
+            frames.append(self._frame(start, end, has_more=end < total))
+            if end >= total:
+                return frames
+            start = end
+
+    def _index(self, seq: int) -> int:
+        # records hold consecutive seqs, so the position is plain arithmetic
+        return min(max(seq - self.first_seq, 0), len(self))
+
+    def _slice(self, start: int, end: int) -> str:
+        # positions are relative to the oldest record held
+        if start >= end:
+            return ""
+        start += self._head
+        end += self._head
+        # decode straight out of the buffer, without an intermediate bytes copy
+        with memoryview(self._encoded) as view, view[self._starts[start]:self._end(end - 1)] as part:
+            return str(part, "utf-8")
+
+    def _end(self, index: int) -> int:
+        # end offset of the record at `index` (absolute): the next start,
+        # less its "," separator
+        if index + 1 < len(self._starts):
+            return self._starts[index + 1] - 1
+        return len(self._encoded)
+
+    def _frame(self, start: int, end: int, has_more: bool) -> str:
+        return "".join((
+            self._frame_prefix,
+            self._slice(start, end),
+            '],"hasMore":true}' if has_more else '],"hasMore":false}',
+        ))
+
+
+class HistoryBudget:
+    """
+    Cap on the encoded bytes held by all conversations together.
+
+    Conversations are kept in order of their last append. When an append
+    takes the total over `max_bytes` (0: no cap), the least recently active
+    conversations lose their whole in-memory history until it fits again;
+    the conversation being appended to is never evicted by its own append.
+    The ConversationHistory objects stay, with their `last_seq`.
+    """
+
+    def __init__(self, max_bytes: int = config.HISTORY_MEMORY_BUDGET):
+        self.max_bytes = max_bytes
+        self.total = 0
+        # conversations holding records, least recently appended to first
+        self._lru: "OrderedDict[str, ConversationHistory]" = OrderedDict()
+
+    def charge(self, history: ConversationHistory, nbytes: int) -> None:
+        self.total += nbytes
+        held_bytes.set(self.total)
+        conv = history.conversation_id
+        if conv in self._lru:
+            self._lru.move_to_end(conv)
+        else:
+            self._lru[conv] = history
+        if self.max_bytes:
+            self._evict(keep=history)
+
+    def release(self, history: ConversationHistory, nbytes: int) -> None:
+        self.total -= nbytes
+        held_bytes.set(self.total)
+        if not len(history):
+            self._lru.pop(history.conversation_id, None)
+
+    def _evict(self, keep: ConversationHistory) -> None:
+        while self.total > self.max_bytes and self._lru:
+            _, victim = self._lru.popitem(last=False)
+            if victim is keep:
+                # the only conversation left; its own caps bound it
+                self._lru[keep.conversation_id] = keep
+                return
+            victim.clear()
+
+    def __len__(self) -> int:
+        return len(self._lru)
+
+
+def message_frame(record: StoredEnvelope) -> Frame:
+    """
+    The live `message` frame for a stored envelope, built from its encoding
+    and shared by every subscriber it is sent to.
+    """
+    return Frame(b'{"action":"message","envelope":%s}' % record.encoded, envelope=record.encoded)
+
+
+def records_frame(conversation_id: str, encoded: List[bytes], has_more: bool) -> str:
+    """
+    `history` frame for envelopes that are not held in memory (e.g. read
+    back from disk), joined from their stored encoding.
+    """
+    return "".join((
+        '{"action":"history","conversationId":%s,"history":[' % codec.encode_text(conversation_id),
+        b",".join(encoded).decode("utf-8"),
+        '],"hasMore":true}' if has_more else '],"hasMore":false}',
+    ))
+
+
+def paginate(conversation_id: str, records: List[Tuple[int, bytes]], limit: int, more_after: bool) -> List[str]:
+    """
+    Split (seq, encoded) records into `history` frames of at most `limit`
+    envelopes each; `hasMore` is set on all but the last unless
+    `more_after` says further envelopes follow anyway.
+    """
+    frames = []
+    for start in range(0, len(records), limit):
+        page = records[start:start + limit]
+        last = start + limit >= len(records)
+        frames.append(records_frame(conversation_id, [e for _, e in page], has_more=more_after or not last))
+    return frames
+
+
+def subscribe_frames(
+    conversation_id: str, history: Optional[ConversationHistory], since: Optional[int]
+) -> Tuple[List[str], int]:
+    """
+    The frames that answer a `subscribe`, built synchronously so they form a
+    consistent snapshot, and the last seq that snapshot covers. Live
+    messages with a higher seq must follow them.
+    """
+    if history is None:
+        frames = [empty_history_frame(conversation_id)]
+        if since:
+            frames.insert(0, reset_frame(conversation_id, 1, 0))
+        return frames, 0
+    if since is not None:
+        if resumable(history, since):
+            # resume: only the envelopes the client missed
+            return history.resume_frames(since, config.HISTORY_PAGE_MAX), history.last_seq
+        # the gap is no longer held (or the client is ahead of us): start over
+        return [
+            reset_frame(conversation_id, history.first_seq, history.last_seq),
+            history.tail_frame(config.HISTORY_INITIAL_TAIL),
+        ], history.last_seq
+    return [history.tail_frame(config.HISTORY_INITIAL_TAIL)], history.last_seq
+
+
+def resumable(history: ConversationHistory, since: int) -> bool:
+    """
+    Whether a client that has seen up to `since` can catch up from memory.
+    """
+    return history.covers(since) and history.last_seq - since <= config.HISTORY_RESUME_MAX
+
+
+def reset_frame(conversation_id: str, first_seq: int, last_seq: int) -> str:
+    """
+    Tells a resuming client that the envelopes after its `sinceSeq` are no
+    longer available; it should drop its local copy and start from the
+    `history` frame that follows.
+    """
+    return codec.encode_text({
+        "action": "reset",
+        "conversationId": conversation_id,
+        "firstSeq": first_seq,
+        "lastSeq": last_seq,
+    })
+
+
+def empty_history_frame(conversation_id: str) -> str:
+    return codec.encode_text({"action": "history", "conversationId": conversation_id, "history": [], "hasMore": False})
@@ -0,0 +1,183 @@
+# chatspot/metrics.py
+"""
+Minimal in-process metrics.
+
+Everything runs on the event loop thread, so plain attribute updates are
+enough -- no locks. Histograms have fixed bucket bounds chosen up front, so
+`observe` is a bisect and an increment. A counter with labels is a family
+of plain counters, one per label value, made on first use; hot paths keep
+the child they need rather than looking it up per event.
+
+`snapshot` is the JSON form served under `metrics` in /stats; `render` the
+Prometheus text exposition format served at /metrics.
+"""
+from bisect import bisect_left
+from typing import Callable, Dict, Optional, Sequence, Tuple, Union
+
+# seconds; from 100us to 10s
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+# counts; powers of two up to 64k
+SIZE_BUCKETS = tuple(2 ** i for i in range(17))
+
+
+class Counter:
+    __slots__ = ("name", "help", "value")
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount: Union[int, float] = 1) -> None:
+        self.value += amount
+
+    def snapshot(self) -> Union[int, float]:
+        return self.value
+
+
+class Gauge(Counter):
+    __slots__ = ("fn",)
+
+    def __init__(self, name: str, help: str, fn: Optional[Callable[[], Union[int, float]]] = None):
+        super().__init__(name, help)
+        # read at collection time instead of being set
+        self.fn = fn
+
+    def snapshot(self) -> Union[int, float]:
+        return self.fn() if self.fn is not None else self.value
+
+    def set(self, value: Union[int, float]) -> None:
+        self.value = value
+
+    def dec(self, amount: Union[int, float] = 1) -> None:
+        self.value -= amount
+
+
+class Histogram:
+    __slots__ = ("name", "help", "bounds", "counts", "sum", "count")
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float]):
+        self.name = name
+        self.help = help
+        self.bounds: Tuple[float, ...] = tuple(sorted(buckets))
+        # one slot per bound plus the +Inf overflow slot
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "buckets": {str(b): c for b, c in zip(self.bounds + ("+Inf",), self.counts)},
+        }
+
+
+class CounterFamily:
+    __slots__ = ("name", "help", "label", "children")
+
+    def __init__(self, name: str, help: str, label: str):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.children: Dict[str, Counter] = {}
+
+    def labels(self, value: str) -> Counter:
+        child = self.children.get(value)
+        if child is None:
+            child = self.children[value] = Counter(self.name, self.help)
+        return child
+
+    def snapshot(self) -> dict:
+        return {value: child.value for value, child in sorted(self.children.items())}
+
+
+Metric = Union[Counter, Gauge, Histogram, CounterFamily]
+_registry: Dict[str, Metric] = {}
+
+
+def _register(metric):
+    existing = _registry.get(metric.name)
+    if existing is not None:
+        if type(existing) is not type(metric):
+            raise ValueError("metric %r already registered as %s" % (metric.name, type(existing).__name__))
+        return existing
+    _registry[metric.name] = metric
+    return metric
+
+
+def counter(name: str, help: str) -> Counter:
+    return _register(Counter(name, help))
+
+
+def labeled_counter(name: str, help: str, label: str) -> CounterFamily:
+    """
+    Counters of `name` told apart by the value of `label`.
+    """
+    return _register(CounterFamily(name, help, label))
+
+
+def gauge(name: str, help: str, fn: Optional[Callable[[], Union[int, float]]] = None) -> Gauge:
+    """
+    A gauge that is set, or that reports `fn()` whenever it is collected.
+    """
+    return _register(Gauge(name, help, fn))
+
+
+def histogram(name: str, help: str, buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+    return _register(Histogram(name, help, buckets))
+
+
+def snapshot() -> dict:
+    return {name: metric.snapshot() for name, metric in sorted(_registry.items())}
+
+
+# the response adds "; charset=utf-8"
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+def render() -> str:
+    """
+    Every metric in the Prometheus text exposition format.
+    """
+    lines = []
+    for name, metric in sorted(_registry.items()):
+        kind = type(metric)
+        lines.append("# HELP %s %s" % (name, _escape_help(metric.help)))
+        if kind is Histogram:
+            lines.append("# TYPE %s histogram" % name)
+            cumulative = 0
+            for bound, count in zip(metric.bounds, metric.counts):
+                cumulative += count
+                lines.append('%s_bucket{le="%s"} %d' % (name, _number(bound), cumulative))
+            lines.append('%s_bucket{le="+Inf"} %d' % (name, metric.count))
+            lines.append("%s_sum %s" % (name, _number(metric.sum)))
+            lines.append("%s_count %d" % (name, metric.count))
+        elif kind is CounterFamily:
+            lines.append("# TYPE %s counter" % name)
+            for value, child in sorted(metric.children.items()):
+                lines.append('%s{%s="%s"} %s' % (name, metric.label, _escape_label(value), _number(child.value)))
+        else:
+            lines.append("# TYPE %s %s" % (name, "gauge" if kind is Gauge else "counter"))
+            lines.append("%s %s" % (name, _number(metric.snapshot())))
+    lines.append("")
+    return "\n".join(lines)
+
+
+def _number(value: Union[int, float]) -> str:
+    return str(value) if type(value) is int else repr(float(value))
+
+
+def _escape_help(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
@@ -0,0 +1,152 @@
+# chatspot/overload.py
+"""
+Event-loop lag monitor and staged load shedding.
+
+A task sleeps `interval` seconds at a time and measures how late it wakes
+up: how long a ready callback -- a frame read, a send completing -- waits
+for the loop. Every sample goes into a histogram; a moving average of them
+picks the shedding stage, each including the ones before it:
+
+1. DEFER_HISTORY:    `history` and `subscribe` requests wait, up to
+                     `defer_max` seconds, for the lag to drop below this
+                     stage; a `subscribe` waits before joining, so no live
+                     messages are held back for it meanwhile
+2. REJECT_SUBSCRIBE: `subscribe` is answered with an `overloaded` frame
+3. REFUSE_CONNECT:   new connections are closed with 1013 (try again
+                     later) and a retry hint
+
+Connections already established keep receiving their messages throughout;
+shedding only turns away new and optional work. The stage drops back as
+soon as the average is below its threshold again. A threshold of 0
+disables its stage.
+"""
+import asyncio
+import logging
+from typing import Optional, Sequence
+
+from . import codec, config, metrics
+
+logger = logging.getLogger(__name__)
+
+NORMAL, DEFER_HISTORY, REJECT_SUBSCRIBE, REFUSE_CONNECT = range(4)
+STAGES = ("normal", "defer-history", "reject-subscribe", "refuse-connect")
+
+# WebSocket close code "Try Again Later"
+TRY_AGAIN_LATER = 1013
+
+lag_seconds = metrics.histogram("chatspot_loop_lag_seconds", "How late the event loop ran the lag monitor's timer")
+stage_gauge = metrics.gauge(
+    "chatspot_shed_stage", "Load shedding stage (0 normal, 1 defer history, 2 reject subscribe, 3 refuse connect)"
+)
+deferred = metrics.counter("chatspot_shed_history_deferred_total", "`history` requests deferred by load shedding")
+rejected = metrics.counter("chatspot_shed_subscribes_rejected_total", "`subscribe` requests rejected by load shedding")
+refused = metrics.counter("chatspot_shed_connections_refused_total", "Connections refused by load shedding")
+
+
+class LagMonitor:
+    def __init__(
+        self,
+        interval: float = config.LAG_INTERVAL_MS / 1000,
+        thresholds: Sequence[float] = (
+            config.LAG_DEFER_HISTORY_MS / 1000,
+            config.LAG_REJECT_SUBSCRIBE_MS / 1000,
+            config.LAG_REFUSE_CONNECT_MS / 1000,
+        ),
+        defer_max: float = config.LAG_DEFER_MAX_MS / 1000,
+        retry_after: float = config.LAG_RETRY_AFTER_MS / 1000,
+        smoothing: float = 0.3,
+    ):
+        if len(thresholds) != REFUSE_CONNECT:
+            raise ValueError("expected %d lag thresholds" % REFUSE_CONNECT)
+        self.interval = interval
+        self.thresholds = tuple(thresholds)
+        self.defer_max = defer_max
+        # what shed clients are told to wait before trying again
+        self.retry_after = retry_after
+        self.smoothing = smoothing
+        # moving average of the lag samples, in seconds
+        self.lag = 0.0
+        self.stage = NORMAL
+        self._calm = asyncio.Event()
+        self._calm.set()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def rejects_subscribe(self) -> bool:
+        if self.stage < REJECT_SUBSCRIBE:
+            return False
+        rejected.inc()
+        return True
+
+    def refuses_connect(self) -> bool:
+        if self.stage < REFUSE_CONNECT:
+            return False
+        refused.inc()
+        return True
+
+    def overloaded_frame(self, request: str, conversation_id: str) -> str:
+        return codec.encode_text(
+            {
+                "action": "overloaded",
+                "request": request,
+                "conversationId": conversation_id,
+                "retryAfterMs": round(self.retry_after * 1000),
+            }
+        )
+
+    def refusal(self) -> str:
+        """
+        Close reason for a refused connection.
+        """
+        return "overloaded; retry after %dms" % round(self.retry_after * 1000)
+
+    async def defer_history(self) -> None:
+        """
+        Wait, up to `defer_max` seconds, until history is no longer shed.
+        """
+        if self.stage < DEFER_HISTORY:
+            return
+        deferred.inc()
+        try:
+            await asyncio.wait_for(self._calm.wait(), self.defer_max)
+        except asyncio.TimeoutError:
+            pass
+
+    def observe(self, lag: float) -> None:
+        lag_seconds.observe(lag)
+        self.lag += (lag - self.lag) * self.smoothing
+        stage = NORMAL
+        for i, threshold in enumerate(self.thresholds):
+            if threshold > 0 and self.lag >= threshold:
+                stage = i + 1
+        if stage == self.stage:
+            return
+        if stage > self.stage:
+            logger.warning("event loop lag %.0fms: shedding load (%s)", self.lag * 1000, STAGES[stage])
+        else:
+            logger.info("event loop lag %.0fms: %s", self.lag * 1000, STAGES[stage])
+        self.stage = stage
+        stage_gauge.set(stage)
+        if stage < DEFER_HISTORY:
+            self._calm.set()
+        else:
+            self._calm.clear()
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.observe(max(0.0, loop.time() - started - self.interval))
@@ -0,0 +1,205 @@
+# chatspot/protocol.py
+"""
+Typed client requests.
+
+Each action is a `Request` subclass listing its fields: attribute name,
+name on the wire, type, and whether it is required. `decode` turns a raw
+frame into an instance of one of them, or returns None -- the frame is
+then ignored -- if it is larger than MAX_FRAME_BYTES (checked before any
+parsing), is not JSON, names no known action, or has a field of the wrong
+type. Unknown fields are ignored.
+
+With msgspec installed (and CHATSPOT_JSON_CODEC "auto" or "msgspec") the
+frame is parsed and validated in a single pass straight into structs
+generated from the same field lists, with no intermediate dict. Otherwise
+the codec parses it and the fields are checked one by one. Either way the
+result has the attributes declared in FIELDS plus the class's ACTION.
+
+Binary frames (see binary.py) carry only `message`; `decode_binary` turns
+them into a `BinaryMessage`, which the same handler takes.
+
+Adding an action is a `@request` class here and a handler for its ACTION
+in main.py.
+"""
+from typing import Any, Dict, NamedTuple, Optional, Tuple, Type, Union
+
+from . import binary, codec, config, metrics
+
+oversized_frames = metrics.counter(
+    "chatspot_frames_oversized_total", "Inbound frames dropped for exceeding MAX_FRAME_BYTES"
+)
+invalid_frames = metrics.counter(
+    "chatspot_frames_invalid_total", "Inbound frames dropped as malformed, of unknown action or of the wrong shape"
+)
+received_frames = metrics.labeled_counter("chatspot_frames_received_total", "Inbound frames decoded, by action", "action")
+# the `message` child, counted per binary frame
+_received_binary = received_frames.labels("message")
+
+
+class Field(NamedTuple):
+    attr: str
+    key: str
+    kind: type
+    required: bool = False
+
+
+class Request:
+    __slots__ = ()
+    ACTION = ""
+    FIELDS: Tuple[Field, ...] = ()
+
+
+_requests: Dict[str, Type[Request]] = {}
+# one-pass struct decoder, built on first use; False when msgspec is not used
+_struct_decoder: Any = None
+# what `_struct_decoder` raises for frames that do not fit a schema
+_struct_errors: Tuple[Type[BaseException], ...] = ()
+
+
+def request(cls: Type[Request]) -> Type[Request]:
+    """
+    Register a Request subclass as the schema of its ACTION.
+    """
+    global _struct_decoder
+    _requests[cls.ACTION] = cls
+    _struct_decoder = None
+    return cls
+
+
+@request
+class Identify(Request):
+    __slots__ = ("user_id", "binary", "batch")
+    ACTION = "identify"
+    # binary: receive `message` frames in the binary format (binary.py)
+    # batch: receive queued `message` frames merged into `batch` frames
+    FIELDS = (Field("user_id", "userId", str), Field("binary", "binary", bool), Field("batch", "batch", bool))
+
+
+@request
+class Subscribe(Request):
+    __slots__ = ("conversation_id", "since_seq")
+    ACTION = "subscribe"
+    FIELDS = (Field("conversation_id", "conversationId", str, True), Field("since_seq", "sinceSeq", int))
+
+
+@request
+class History(Request):
+    __slots__ = ("conversation_id", "before", "after", "limit")
+    ACTION = "history"
+    FIELDS = (
+        Field("conversation_id", "conversationId", str, True),
+        Field("before", "before", int),
+        Field("after", "after", int),
+        Field("limit", "limit", int),
+    )
+
+
+@request
+class Message(Request):
+    __slots__ = ("envelope",)
+    ACTION = "message"
+    # the envelope is opaque apart from its conversationId, checked by the handler
+    FIELDS = (Field("envelope", "envelope", dict, True),)
+
+
+class BinaryMessage(Message):
+    """
+    A `message` that arrived as a binary frame; `frame` is that frame, to
+    be forwarded to binary subscribers. Not registered: it is not JSON.
+    """
+
+    __slots__ = ("frame",)
+
+
+def decode(raw: Union[str, bytes]) -> Optional[Request]:
+    """
+    The request in `raw`, or None if it is to be ignored.
+    """
+    if len(raw) > config.MAX_FRAME_BYTES:
+        oversized_frames.inc()
+        return None
+    decoder = _struct_decoder if _struct_decoder is not None else _build_decoder()
+    if decoder:
+        try:
+            msg = decoder.decode(raw)
+        except _struct_errors:
+            invalid_frames.inc()
+            return None
+    else:
+        try:
+            obj = codec.decode(raw)
+        except codec.DecodeError:
+            invalid_frames.inc()
+            return None
+        msg = _validate(obj)
+        if msg is None:
+            invalid_frames.inc()
+            return None
+    received_frames.labels(msg.ACTION).inc()
+    return msg
+
+
+def decode_binary(data: bytes) -> Optional[BinaryMessage]:
+    """
+    The `message` in binary frame `data`, or None if it is to be ignored.
+    """
+    if len(data) > config.MAX_FRAME_BYTES:
+        oversized_frames.inc()
+        return None
+    try:
+        envelope = binary.decode_message(data)
+    except binary.MalformedFrame:
+        invalid_frames.inc()
+        return None
+    msg = BinaryMessage.__new__(BinaryMessage)
+    msg.envelope = envelope
+    msg.frame = data
+    _received_binary.inc()
+    return msg
+
+
+def _validate(obj) -> Optional[Request]:
+    if type(obj) is not dict:
+        return None
+    action = obj.get("action")
+    cls = _requests.get(action) if type(action) is str else None
+    if cls is None:
+        return None
+    msg = cls.__new__(cls)
+    for field in cls.FIELDS:
+        value = obj.get(field.key)
+        if value is None:
+            if field.required:
+                return None
+        # exact type: JSON true is not an int here
+        elif type(value) is not field.kind:
+            return None
+        setattr(msg, field.attr, value)
+    return msg
+
+
+def _build_decoder():
+    global _struct_decoder, _struct_errors
+    _struct_decoder = False
+    if config.JSON_CODEC not in ("auto", "msgspec"):
+        return _struct_decoder
+    try:
+        import msgspec
+    except ImportError:
+        return _struct_decoder
+    structs = []
+    for action, cls in _requests.items():
+        fields = [(f.attr, f.kind) if f.required else (f.attr, Optional[f.kind], None) for f in cls.FIELDS]
+        structs.append(msgspec.defstruct(
+            cls.__name__,
+            fields,
+            module=__name__,
+            namespace={"ACTION": action, "FIELDS": cls.FIELDS},
+            tag_field="action",
+            tag=action,
+            rename={f.attr: f.key for f in cls.FIELDS},
+            kw_only=True,
+        ))
+    _struct_decoder = msgspec.json.Decoder(Union[tuple(structs)])
+    _struct_errors = (msgspec.DecodeError, UnicodeDecodeError)
+    return _struct_decoder
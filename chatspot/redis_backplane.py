@@ -0,0 +1,350 @@
+# chatspot/redis_backplane.py
+"""
+Backplane over Redis, for several nodes behind a load balancer.
+
+Per conversation Redis holds a counter (`chatspot:seq:<id>`), a pub/sub
+channel (`chatspot:msg:<id>`) and a backlog of the newest REDIS_BACKLOG
+envelopes, a sorted set scored by seq (`chatspot:log:<id>`).
+
+Publishing is pipelined in batches: everything published while the previous
+batch was in flight goes out as one write of `INCR`s -- plus a `SET NX` of
+the publisher's last seq the first time a connection numbers a
+conversation -- then, once the seqs are back, one write of the
+`ZADD`/`PUBLISH` pairs and a trim per conversation. A node hands its own
+envelopes to itself as soon as their seq is known and ignores their copies
+on the channel.
+
+Nodes do not share a store, so each persists every event it holds: its
+store has the conversations it has watched, from the first seq it got
+after any gap the backlog could not fill.
+
+A node subscribes only to the channels of conversations it `watch`es.
+Starting to watch one subscribes, then reads the backlog after the node's
+last seq, so nothing published in between is missed. Nodes number and
+publish concurrently, so events can arrive out of seq order; each watched
+conversation has a reorder buffer that holds events back until the seqs
+before them are in, or until BACKPLANE_GAP_MS has passed (a publisher died
+between INCR and PUBLISH), when the gap is skipped. After a reconnect every
+watched conversation catches up from the backlog the same way.
+
+Channel messages and backlog entries are `<node id> <seq> <envelope>`.
+"""
+import asyncio
+import logging
+import os
+from typing import Dict, List, Optional, Set, Tuple
+
+from . import metrics
+from .backplane import Backplane, lost, published
+from .history import add_seq
+from .resp import RespConnection, RespError, encode_command, open_stream, read_reply
+
+logger = logging.getLogger(__name__)
+
+gaps = metrics.counter(
+    "chatspot_backplane_gaps_total", "Seqs a node gave up waiting for, or found trimmed from the Redis backlog"
+)
+
+_SEQ = b"chatspot:seq:"
+_CHANNEL = b"chatspot:msg:"
+_BACKLOG = b"chatspot:log:"
+
+# envelopes numbered per pipelined round trip
+_MAX_BATCH = 1024
+
+
+class _Watch:
+    """
+    Reorder state of one watched conversation.
+    """
+
+    __slots__ = ("expected", "pending", "ready", "timer", "caught_up")
+
+    def __init__(self, expected: int, caught_up: asyncio.Future):
+        # next seq to deliver
+        self.expected = expected
+        # seq -> (encoded, origin), for seqs after `expected`
+        self.pending: Dict[int, Tuple[bytes, bool]] = {}
+        # False while catching up from the backlog: events are only collected
+        self.ready = False
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.caught_up = caught_up
+
+
+class RedisBackplane(Backplane):
+    # every node has a store of its own
+    shared_store = False
+
+    def __init__(self, url: str, backlog: int = 1000, gap: float = 1.0, retry: float = 0.5):
+        super().__init__()
+        self.url = url
+        self.backlog = backlog
+        self.gap = gap
+        self.retry = retry
+        self.node = os.urandom(8).hex().encode("ascii")
+        self._commands: Optional[RespConnection] = None
+        self._subscriber: Optional[asyncio.StreamWriter] = None
+        # (conv, encoded, last_seq) waiting for the next batch
+        self._outgoing: List[Tuple[str, bytes, int]] = []
+        self._outgoing_ready = asyncio.Event()
+        # conversations whose counter has been floored on this connection
+        self._floored: Set[str] = set()
+        self._watched: Dict[str, _Watch] = {}
+        # channel -> future resolved when Redis confirms the subscription
+        self._confirming: Dict[bytes, asyncio.Future] = {}
+        # channel -> confirmations still to come for SUBSCRIBEs unwatched since
+        self._stale: Dict[bytes, int] = {}
+        self._catching_up: Set[asyncio.Task] = set()
+        self._connection: Optional[asyncio.Task] = None
+        self._connected = asyncio.Event()
+
+    async def start(self, handler, timeout: float = 5.0) -> None:
+        await super().start(handler)
+        if self._connection is None:
+            self._connection = asyncio.create_task(self._connect_loop())
+        try:
+            await asyncio.wait_for(self._connected.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("no Redis at %s yet; still trying", self.url)
+
+    def publish(self, conv: str, encoded: bytes, last_seq: int) -> None:
+        if self._commands is None:
+            lost.inc()
+            return
+        published.inc()
+        self._outgoing.append((conv, encoded, last_seq))
+        self._outgoing_ready.set()
+
+    async def watch(self, conv: str, last_seq: int) -> None:
+        watch = self._watched.get(conv)
+        if watch is None:
+            watch = self._watched[conv] = _Watch(last_seq + 1, asyncio.get_running_loop().create_future())
+            if self._connected.is_set():
+                task = asyncio.create_task(self._catch_up(conv, watch))
+                self._catching_up.add(task)
+                task.add_done_callback(self._catching_up.discard)
+            else:
+                # caught up once connected; until then there is nothing to wait for
+                watch.caught_up.set_result(None)
+        await asyncio.shield(watch.caught_up)
+
+    def unwatch(self, conv: str) -> None:
+        watch = self._watched.pop(conv, None)
+        if watch is None:
+            return
+        if watch.timer is not None:
+            watch.timer.cancel()
+        if not watch.caught_up.done():
+            watch.caught_up.set_result(None)
+        if self._subscriber is not None:
+            channel = _CHANNEL + conv.encode("utf-8")
+            waiter = self._confirming.pop(channel, None)
+            if waiter is not None:
+                # the SUBSCRIBE this undoes is unconfirmed; a new watch must
+                # send its own and not take that confirmation for it
+                waiter.cancel()
+                self._stale[channel] = self._stale.get(channel, 0) + 1
+            self._subscriber.write(encode_command(("UNSUBSCRIBE", channel)))
+
+    async def close(self) -> None:
+        if self._connection is not None:
+            self._connection.cancel()
+            try:
+                await self._connection
+            except asyncio.CancelledError:
+                pass
+            self._connection = None
+        await super().close()
+
+    # -- connection -------------------------------------------------------
+
+    async def _connect_loop(self) -> None:
+        while True:
+            commands = None
+            try:
+                # commands and replies on one connection, pub/sub on the other
+                commands = await RespConnection.open(self.url)
+                reader, writer = await open_stream(self.url)
+            except (OSError, RespError) as e:
+                logger.debug("cannot reach Redis at %s: %s", self.url, e)
+                if commands is not None:
+                    commands.close()
+                await asyncio.sleep(self.retry)
+                continue
+            logger.info("connected to Redis at %s", self.url)
+            commands.on_error = lambda e: logger.warning("Redis error: %s", e)
+            self._commands, self._subscriber = commands, writer
+            self._floored.clear()
+            self._connected.set()
+            tasks = [
+                asyncio.create_task(self._send_loop(commands)),
+                asyncio.create_task(self._receive_loop(reader)),
+            ]
+            for conv, watch in list(self._watched.items()):
+                tasks.append(asyncio.create_task(self._catch_up(conv, watch)))
+            try:
+                await asyncio.wait(tasks[:2] + [commands.closed], return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                self._commands = self._subscriber = None
+                self._connected.clear()
+                for task in tasks + list(self._catching_up):
+                    task.cancel()
+                commands.close()
+                writer.close()
+                for waiter in self._confirming.values():
+                    waiter.cancel()
+                self._confirming.clear()
+                self._stale.clear()
+                if self._outgoing:
+                    lost.inc(len(self._outgoing))
+                    self._outgoing.clear()
+            logger.warning("lost Redis at %s; reconnecting", self.url)
+            await asyncio.sleep(self.retry)
+
+    async def _send_loop(self, commands: RespConnection) -> None:
+        while True:
+            if not self._outgoing:
+                self._outgoing_ready.clear()
+                await self._outgoing_ready.wait()
+                continue
+            batch = self._outgoing[:_MAX_BATCH]
+            del self._outgoing[:_MAX_BATCH]
+            try:
+                await self._send_batch(commands, batch)
+            except ConnectionError:
+                lost.inc(len(batch))
+                raise
+
+    async def _send_batch(self, commands: RespConnection, batch: List[Tuple[str, bytes, int]]) -> None:
+        numbering = []
+        for conv, _, last_seq in batch:
+            key = _SEQ + conv.encode("utf-8")
+            if conv not in self._floored:
+                # numbering continues after the publisher's history even if
+                # Redis lost the counter
+                self._floored.add(conv)
+                numbering.append(("SET", key, last_seq, "NX"))
+            numbering.append(("INCR", key))
+        replies = await asyncio.gather(*commands.send(numbering))
+        seqs = [r for r in replies if type(r) is int]
+        if len(seqs) != len(batch):
+            errors = [r for r in replies if isinstance(r, RespError)]
+            logger.warning("numbering %d envelopes failed: %s", len(batch), errors[:1])
+            lost.inc(len(batch))
+            return
+        out = []
+        trimmed = set()
+        for (conv, encoded, _), seq in zip(batch, seqs):
+            encoded = add_seq(encoded, seq)
+            message = b"%s %d %s" % (self.node, seq, encoded)
+            conv_key = conv.encode("utf-8")
+            if self.backlog > 0:
+                out.append(("ZADD", _BACKLOG + conv_key, seq, message))
+                trimmed.add(conv_key)
+            out.append(("PUBLISH", _CHANNEL + conv_key, message))
+            self._receive(conv, seq, encoded, True)
+        for conv_key in trimmed:
+            out.append(("ZREMRANGEBYRANK", _BACKLOG + conv_key, 0, -self.backlog - 1))
+        commands.send(out, replies=False)
+
+    async def _receive_loop(self, reader: asyncio.StreamReader) -> None:
+        while True:
+            reply = await read_reply(reader)
+            if type(reply) is not list or len(reply) < 3:
+                continue
+            kind, channel = reply[0], reply[1]
+            if kind == b"message":
+                node, seq, encoded = reply[2].split(b" ", 2)
+                if node != self.node:
+                    self._receive(channel[len(_CHANNEL):].decode("utf-8"), int(seq), encoded, False)
+            elif kind == b"subscribe":
+                stale = self._stale.get(channel)
+                if stale:
+                    # confirms a SUBSCRIBE an unwatch has undone since
+                    if stale > 1:
+                        self._stale[channel] = stale - 1
+                    else:
+                        del self._stale[channel]
+                    continue
+                waiter = self._confirming.pop(channel, None)
+                if waiter is not None and not waiter.done():
+                    waiter.set_result(None)
+
+    # -- ordering ---------------------------------------------------------
+
+    async def _catch_up(self, conv: str, watch: _Watch) -> None:
+        watch.ready = False
+        conv_key = conv.encode("utf-8")
+        try:
+            if self._subscriber is None:
+                return
+            channel = _CHANNEL + conv_key
+            confirmed = self._confirming.get(channel)
+            if confirmed is None:
+                confirmed = self._confirming[channel] = asyncio.get_running_loop().create_future()
+                self._subscriber.write(encode_command(("SUBSCRIBE", channel)))
+            await confirmed
+            entries = []
+            if self.backlog > 0:
+                entries = await self._commands.call("ZRANGEBYSCORE", _BACKLOG + conv_key, "(%d" % (watch.expected - 1), "+inf")
+            if self._watched.get(conv) is not watch:
+                return
+            if entries:
+                first = int(entries[0].split(b" ", 2)[1])
+                if first > watch.expected:
+                    # the ones in between are no longer in the backlog
+                    gaps.inc(first - watch.expected)
+                    watch.expected = first
+                    for seq in [seq for seq in watch.pending if seq < first]:
+                        del watch.pending[seq]
+            for entry in entries:
+                _, seq, encoded = entry.split(b" ", 2)
+                self._offer(conv, watch, int(seq), encoded, False)
+            watch.ready = True
+            self._drain(conv, watch)
+            await self._barrier()
+        except (ConnectionError, RespError) as e:
+            # caught up again after reconnecting
+            logger.warning("catching up on %r failed: %s", conv, e)
+        finally:
+            if not watch.caught_up.done():
+                watch.caught_up.set_result(None)
+
+    def _receive(self, conv: str, seq: int, encoded: bytes, origin: bool) -> None:
+        watch = self._watched.get(conv)
+        if watch is None:
+            if origin:
+                # persisted by this node, but nobody here is watching
+                self._deliver(conv, seq, encoded, True, False)
+            return
+        self._offer(conv, watch, seq, encoded, origin)
+
+    def _offer(self, conv: str, watch: _Watch, seq: int, encoded: bytes, origin: bool) -> None:
+        if seq < watch.expected:
+            return
+        # the first copy wins: a node's own events come before their backlog copies
+        watch.pending.setdefault(seq, (encoded, origin))
+        if watch.ready:
+            self._drain(conv, watch)
+
+    def _drain(self, conv: str, watch: _Watch) -> None:
+        pending = watch.pending
+        while watch.expected in pending:
+            encoded, origin = pending.pop(watch.expected)
+            self._deliver(conv, watch.expected, encoded, origin)
+            watch.expected += 1
+        if pending and watch.timer is None:
+            watch.timer = asyncio.get_running_loop().call_later(self.gap, self._skip_gap, conv, watch)
+        elif not pending and watch.timer is not None:
+            watch.timer.cancel()
+            watch.timer = None
+
+    def _skip_gap(self, conv: str, watch: _Watch) -> None:
+        watch.timer = None
+        if self._watched.get(conv) is not watch or not watch.pending or not watch.ready:
+            return
+        first = min(watch.pending)
+        logger.warning("gave up on seqs %d-%d of %r", watch.expected, first - 1, conv)
+        gaps.inc(first - watch.expected)
+        watch.expected = first
+        self._drain(conv, watch)
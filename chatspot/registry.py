@@ -0,0 +1,98 @@
+# chatspot/registry.py
+"""
+Bidirectional subscription index.
+
+Keeps conversation -> connections and connection -> conversations in step,
+so dropping a connection only touches the rooms it actually joined, and a
+room disappears from the index as soon as its last subscriber leaves.
+"""
+from typing import Dict, Iterator, Set
+
+from .connection import Connection
+
+_EMPTY: frozenset = frozenset()
+
+
+class SubscriptionRegistry:
+    def __init__(self):
+        self._by_conv: Dict[str, Set[Connection]] = {}
+        self._by_conn: Dict[Connection, Set[str]] = {}
+        self._count = 0
+
+    def subscribe(self, conv: str, conn: Connection) -> bool:
+        """
+        Add `conn` to `conv`. Returns False if it was already subscribed.
+        """
+        subs = self._by_conv.get(conv)
+        if subs is None:
+            subs = self._by_conv[conv] = set()
+        elif conn in subs:
+            return False
+        subs.add(conn)
+        self._by_conn.setdefault(conn, set()).add(conv)
+        self._count += 1
+        return True
+
+    def unsubscribe(self, conv: str, conn: Connection) -> bool:
+        """
+        Remove `conn` from `conv`. Returns False if it was not subscribed.
+        """
+        subs = self._by_conv.get(conv)
+        if subs is None or conn not in subs:
+            return False
+        subs.discard(conn)
+        self._count -= 1
+        if not subs:
+            del self._by_conv[conv]
+        convs = self._by_conn.get(conn)
+        if convs is not None:
+            convs.discard(conv)
+            if not convs:
+                del self._by_conn[conn]
+        return True
+
+    def remove(self, conn: Connection) -> Set[str]:
+        """
+        Drop `conn` from every conversation it joined; cost is proportional
+        to that number only. Returns the conversations it left.
+        """
+        convs = self._by_conn.pop(conn, None)
+        if not convs:
+            return set()
+        self._count -= len(convs)
+        for conv in convs:
+            subs = self._by_conv.get(conv)
+            if subs is None:
+                continue
+            subs.discard(conn)
+            if not subs:
+                del self._by_conv[conv]
+        return convs
+
+    def subscribers(self, conv: str) -> Set[Connection]:
+        """
+        The live subscriber set of `conv` (empty if none). Do not mutate it,
+        and copy it before awaiting while iterating.
+        """
+        return self._by_conv.get(conv, _EMPTY)
+
+    def conversations_of(self, conn: Connection) -> Set[str]:
+        return self._by_conn.get(conn, _EMPTY)
+
+    def is_subscribed(self, conv: str, conn: Connection) -> bool:
+        return conn in self._by_conv.get(conv, _EMPTY)
+
+    def __contains__(self, conv: str) -> bool:
+        return conv in self._by_conv
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._by_conv)
+
+    def __len__(self) -> int:
+        return len(self._by_conv)
+
+    def subscription_count(self) -> int:
+        """
+        Total (conversation, connection) pairs.
+        """
+        return self._count
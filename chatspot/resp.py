@@ -0,0 +1,179 @@
+# chatspot/resp.py
+"""
+The Redis protocol (RESP2): just enough of a client for the Redis backplane
+(redis_backplane.py), and reply encoding for the stand-in server
+(resp_server.py).
+
+Replies are returned as Python values -- simple strings and bulk strings
+as bytes, integers as int, arrays as lists, nil as None -- and error
+replies as RespError instances rather than raised, so one failed command in
+a pipeline does not hide the replies of the others.
+"""
+import asyncio
+from collections import deque
+from typing import Any, Callable, Deque, List, Optional, Sequence, Tuple
+from urllib.parse import urlsplit
+
+
+class RespError(Exception):
+    pass
+
+
+def encode_command(args: Sequence[Any]) -> bytes:
+    """
+    One command as a RESP array of bulk strings; str and int arguments are
+    sent as their UTF-8 / decimal text.
+    """
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if type(arg) is str:
+            arg = arg.encode("utf-8")
+        elif type(arg) is int:
+            arg = b"%d" % arg
+        parts.append(b"$%d\r\n" % len(arg))
+        parts.append(arg)
+        parts.append(b"\r\n")
+    return b"".join(parts)
+
+
+def encode_reply(value: Any) -> bytes:
+    """
+    A reply: str is a simple string, bytes a bulk string.
+    """
+    if value is None:
+        return b"$-1\r\n"
+    if type(value) is int:
+        return b":%d\r\n" % value
+    if type(value) is bytes:
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+    if type(value) is str:
+        return b"+%s\r\n" % value.encode("utf-8")
+    if isinstance(value, RespError):
+        return b"-%s\r\n" % str(value).encode("utf-8")
+    return b"".join([b"*%d\r\n" % len(value)] + [encode_reply(item) for item in value])
+
+
+async def read_reply(reader: asyncio.StreamReader) -> Any:
+    """
+    The next reply (or command: commands are arrays of bulk strings).
+    Raises ConnectionError at end of stream.
+    """
+    line = await reader.readline()
+    if not line.endswith(b"\r\n"):
+        raise ConnectionError("connection closed")
+    kind, rest = line[:1], line[1:-2]
+    if kind == b"$":
+        length = int(rest)
+        if length < 0:
+            return None
+        try:
+            data = await reader.readexactly(length + 2)
+        except asyncio.IncompleteReadError:
+            raise ConnectionError("connection closed") from None
+        return data[:-2]
+    if kind == b"*":
+        length = int(rest)
+        if length < 0:
+            return None
+        return [await read_reply(reader) for _ in range(length)]
+    if kind == b":":
+        return int(rest)
+    if kind == b"+":
+        return rest
+    if kind == b"-":
+        return RespError(rest.decode("utf-8", "replace"))
+    raise ConnectionError("protocol error: unexpected %r" % line[:32])
+
+
+async def open_stream(url: str) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    """
+    Connect to `url`: redis://host:port/db or unix:///path/to/socket?db=N.
+    A nonzero db is selected before returning.
+    """
+    parts = urlsplit(url)
+    if parts.scheme == "unix":
+        reader, writer = await asyncio.open_unix_connection(parts.path)
+        db = dict(p.split("=", 1) for p in parts.query.split("&") if "=" in p).get("db", "0")
+    elif parts.scheme == "redis":
+        reader, writer = await asyncio.open_connection(parts.hostname or "127.0.0.1", parts.port or 6379)
+        db = parts.path.strip("/") or "0"
+    else:
+        raise ValueError("unsupported Redis URL %r (expected redis:// or unix://)" % url)
+    if db != "0":
+        writer.write(encode_command(("SELECT", db)))
+        reply = await read_reply(reader)
+        if isinstance(reply, RespError):
+            writer.close()
+            raise reply
+    return reader, writer
+
+
+class RespConnection:
+    """
+    A pipelining client connection: `send` writes any number of commands in
+    one write, and their replies are matched up in order by a reader task.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._reader = reader
+        self._writer = writer
+        # one entry per command sent: the future awaiting its reply, or None
+        # if the reply is to be discarded
+        self._waiting: Deque[Optional[asyncio.Future]] = deque()
+        # called with the error replies of commands sent with replies=False
+        self.on_error: Optional[Callable[[RespError], None]] = None
+        self.closed = asyncio.get_running_loop().create_future()
+        self._task = asyncio.create_task(self._read())
+
+    @classmethod
+    async def open(cls, url: str) -> "RespConnection":
+        return cls(*await open_stream(url))
+
+    def send(self, commands: List[Sequence[Any]], replies: bool = True) -> List[asyncio.Future]:
+        """
+        Pipeline `commands`; returns a future per command resolving to its
+        reply, or none at all with replies=False (error replies then go to
+        `on_error`).
+        """
+        if self.closed.done():
+            raise ConnectionError("connection closed")
+        loop = asyncio.get_running_loop()
+        futures = [loop.create_future() for _ in commands] if replies else []
+        self._waiting.extend(futures if replies else [None] * len(commands))
+        self._writer.write(b"".join(encode_command(c) for c in commands))
+        return futures
+
+    async def call(self, *args: Any) -> Any:
+        """
+        Send one command and return its reply; an error reply is raised.
+        """
+        reply = await self.send([args])[0]
+        if isinstance(reply, RespError):
+            raise reply
+        return reply
+
+    def close(self) -> None:
+        self._task.cancel()
+        self._writer.close()
+
+    async def _read(self) -> None:
+        error: BaseException = ConnectionError("connection closed")
+        try:
+            while True:
+                reply = await read_reply(self._reader)
+                waiter = self._waiting.popleft()
+                if waiter is None:
+                    if isinstance(reply, RespError) and self.on_error is not None:
+                        self.on_error(reply)
+                elif not waiter.done():
+                    waiter.set_result(reply)
+        except (ConnectionError, OSError) as e:
+            error = e
+        finally:
+            while self._waiting:
+                waiter = self._waiting.popleft()
+                if waiter is not None and not waiter.done():
+                    waiter.set_exception(ConnectionError(str(error)))
+            if not self.closed.done():
+                self.closed.set_result(None)
+            self._writer.close()
@@ -0,0 +1,212 @@
+# chatspot/resp_server.py
+"""
+A stand-in Redis server: the commands the Redis backplane uses, kept in
+memory, so multi-node setups can be run and tested without Redis.
+
+    python -m chatspot.resp_server --path /tmp/chatspot-redis.sock
+    CHATSPOT_BACKPLANE=redis CHATSPOT_REDIS_URL=unix:///tmp/chatspot-redis.sock ...
+
+Supported: PING, SELECT (one keyspace whatever the db), GET, SET [NX],
+INCR, DEL, FLUSHALL, ZADD, ZRANGEBYSCORE, ZREMRANGEBYRANK, ZCARD, PUBLISH,
+SUBSCRIBE, UNSUBSCRIBE. Sorted-set scores must be integers.
+"""
+import argparse
+import asyncio
+import logging
+import os
+from bisect import bisect_left, insort
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from .backplane import Outbox
+from .resp import RespError, encode_reply, read_reply
+
+logger = logging.getLogger(__name__)
+
+_WRONGTYPE = RespError("WRONGTYPE Operation against a key holding the wrong kind of value")
+
+
+class RespServer:
+    def __init__(self) -> None:
+        self._strings: Dict[bytes, bytes] = {}
+        self._zsets: Dict[bytes, _ZSet] = {}
+        self._channels: Dict[bytes, Set[Outbox]] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self, path: Optional[str] = None, port: Optional[int] = None) -> None:
+        if path is not None:
+            if os.path.exists(path):
+                os.unlink(path)
+            self._server = await asyncio.start_unix_server(self._serve, path)
+        else:
+            self._server = await asyncio.start_server(self._serve, "127.0.0.1", port)
+        logger.info("stand-in Redis listening on %s", path or "127.0.0.1:%d" % port)
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        client = Outbox(writer)
+        subscribed: Set[bytes] = set()
+        try:
+            while True:
+                command = await read_reply(reader)
+                if type(command) is not list or not command:
+                    break
+                name = bytes(command[0]).upper()
+                args = command[1:]
+                if name in (b"SUBSCRIBE", b"UNSUBSCRIBE"):
+                    # subscription changes answer once per channel
+                    for channel in args or list(subscribed):
+                        if name == b"SUBSCRIBE":
+                            subscribed.add(channel)
+                            self._channels.setdefault(channel, set()).add(client)
+                        else:
+                            subscribed.discard(channel)
+                            self._unsubscribe(channel, client)
+                        client.write(encode_reply([name.lower(), channel, len(subscribed)]))
+                    continue
+                try:
+                    reply = self._execute(name, args)
+                except (ValueError, IndexError):
+                    reply = RespError("ERR syntax error or wrong number of arguments for %r" % name.decode())
+                client.write(encode_reply(reply))
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            for channel in subscribed:
+                self._unsubscribe(channel, client)
+            writer.close()
+
+    def _unsubscribe(self, channel: bytes, client: Outbox) -> None:
+        members = self._channels.get(channel)
+        if members is not None:
+            members.discard(client)
+            if not members:
+                del self._channels[channel]
+
+    def _execute(self, name: bytes, args: List[bytes]) -> Any:
+        if name == b"PING":
+            return "PONG"
+        if name == b"SELECT":
+            return "OK"
+        if name == b"GET":
+            return self._strings.get(args[0])
+        if name == b"SET":
+            key, value = args[0], args[1]
+            if b"NX" in (a.upper() for a in args[2:]) and key in self._strings:
+                return None
+            self._strings[key] = value
+            return "OK"
+        if name == b"INCR":
+            value = int(self._strings.get(args[0], b"0")) + 1
+            self._strings[args[0]] = b"%d" % value
+            return value
+        if name == b"DEL":
+            removed = 0
+            for key in args:
+                removed += (self._strings.pop(key, None) is not None) + (self._zsets.pop(key, None) is not None)
+            return removed
+        if name == b"FLUSHALL":
+            self._strings.clear()
+            self._zsets.clear()
+            return "OK"
+        if name == b"PUBLISH":
+            members = self._channels.get(args[0], ())
+            message = encode_reply([b"message", args[0], args[1]])
+            for client in members:
+                client.write(message)
+            return len(members)
+        if name.startswith(b"Z"):
+            if args[0] in self._strings:
+                return _WRONGTYPE
+            zset = self._zsets.get(args[0])
+            if zset is None:
+                zset = self._zsets[args[0]] = _ZSet()
+            return self._zset(name, zset, args)
+        return RespError("ERR unknown command %r" % name.decode("utf-8", "replace"))
+
+    def _zset(self, name: bytes, zset: "_ZSet", args: List[bytes]) -> Any:
+        key = args[0]
+        try:
+            if name == b"ZADD":
+                pairs = args[1:]
+                if not pairs or len(pairs) % 2:
+                    raise ValueError
+                return sum(zset.add(int(pairs[i]), pairs[i + 1]) for i in range(0, len(pairs), 2))
+            if name == b"ZRANGEBYSCORE":
+                entries = zset.entries
+                start = bisect_left(entries, (_bound(args[1]),))
+                end = bisect_left(entries, (_bound(args[2], upper=True) + 1,))
+                return [member for _, member in entries[start:end]]
+            if name == b"ZREMRANGEBYRANK":
+                n = len(zset.entries)
+                start, stop = int(args[1]), int(args[2])
+                start = max(start + n if start < 0 else start, 0)
+                stop = min(stop + n if stop < 0 else stop, n - 1)
+                if start > stop:
+                    return 0
+                for _, member in zset.entries[start:stop + 1]:
+                    del zset.scores[member]
+                del zset.entries[start:stop + 1]
+                return stop - start + 1
+            if name == b"ZCARD":
+                return len(zset.entries)
+        finally:
+            if not zset.entries:
+                self._zsets.pop(key, None)
+        return RespError("ERR unknown command %r" % name.decode("utf-8", "replace"))
+
+
+class _ZSet:
+    __slots__ = ("entries", "scores")
+
+    def __init__(self) -> None:
+        # sorted (score, member)
+        self.entries: List[Tuple[int, bytes]] = []
+        self.scores: Dict[bytes, int] = {}
+
+    def add(self, score: int, member: bytes) -> bool:
+        old = self.scores.get(member)
+        if old is not None:
+            del self.entries[bisect_left(self.entries, (old, member))]
+        self.scores[member] = score
+        insort(self.entries, (score, member))
+        return old is None
+
+
+def _bound(arg: bytes, upper: bool = False) -> int:
+    # integer score bounds: "(n" is exclusive
+    if arg in (b"-inf", b"+inf", b"inf"):
+        return -(2 ** 63) if arg == b"-inf" else 2 ** 63
+    if arg.startswith(b"("):
+        value = int(arg[1:])
+        return value - 1 if upper else value + 1
+    return int(arg)
+
+
+async def serve(path: Optional[str], port: Optional[int]) -> None:
+    server = RespServer()
+    await server.start(path, port)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Stand-in Redis for the Chatspot Redis backplane")
+    parser.add_argument("--path", help="Unix socket to listen on")
+    parser.add_argument("--port", type=int, default=6379, help="TCP port on 127.0.0.1 when no --path is given")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    try:
+        asyncio.run(serve(args.path, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,443 @@
+# chatspot/segment_log.py
+"""
+Append-only, segmented on-disk log of envelopes.
+
+Conversations are spread over a fixed number of shards (crc32 of the
+conversation id), each shard being a directory of numbered segment files.
+A segment is a sequence of records:
+
+    <u32 body length> <u32 crc32 of body> <body>
+    body = <u64 seq> <u16 conversation id length> <conversation id> <encoded envelope>
+
+Appends only go to an in-memory buffer; `flush` writes everything buffered
+with one write per segment (on a worker thread) and fsyncs according to the
+policy:
+
+- always:   every flush is fsynced
+- interval: fsync at most every `fsync_interval` seconds
+- os:       never fsync explicitly, leave it to the OS
+
+When to flush is up to the caller (see write_behind.py).
+
+On open every segment is scanned and checked; a torn or corrupt tail is
+truncated. The recent records of each conversation are returned so they can
+be served from memory, and a compact seq -> file position index is kept so
+older ones can still be read back.
+"""
+import asyncio
+import fcntl
+import logging
+import os
+import struct
+import time
+import zlib
+from array import array
+from collections import deque
+from typing import Awaitable, Deque, Dict, List, Optional, Tuple
+
+from .store import MessageStore, Record
+
+logger = logging.getLogger(__name__)
+
+FSYNC_POLICIES = ("always", "interval", "os")
+
+_HEADER = struct.Struct("<II")
+_BODY = struct.Struct("<QH")
+_SEGMENT_SUFFIX = ".seg"
+_META = "LOG_META"
+# held (flock) by the one process that may use the log
+_LOCK = "LOCK"
+# positions are packed as segment number << 40 | offset within the segment
+_OFFSET_BITS = 40
+_OFFSET_MASK = (1 << _OFFSET_BITS) - 1
+
+
+def shard_of(conv: str, shards: int) -> int:
+    # stable across processes, unlike hash()
+    return zlib.crc32(conv.encode("utf-8")) % shards
+
+
+def encode_record(conv: str, seq: int, payload: bytes) -> bytes:
+    conv_bytes = conv.encode("utf-8")
+    body = _BODY.pack(seq, len(conv_bytes)) + conv_bytes + payload
+    return _HEADER.pack(len(body), zlib.crc32(body)) + body
+
+
+def decode_body(body: bytes) -> Tuple[str, int, bytes]:
+    seq, conv_len = _BODY.unpack_from(body)
+    start = _BODY.size
+    conv = body[start:start + conv_len].decode("utf-8")
+    return conv, seq, body[start + conv_len:]
+
+
+class CorruptRecord(Exception):
+    pass
+
+
+class _ConversationIndex:
+    """
+    Position of every logged record of one conversation, by seq.
+    """
+    __slots__ = ("first_seq", "positions")
+
+    def __init__(self, first_seq: int):
+        self.first_seq = first_seq
+        self.positions = array("Q")
+
+    @property
+    def last_seq(self) -> int:
+        return self.first_seq + len(self.positions) - 1
+
+    def add(self, seq: int, position: int) -> None:
+        if seq != self.last_seq + 1:
+            # seqs are contiguous per conversation; anything else means an
+            # earlier run was lost, so only the new run stays addressable
+            logger.warning("seq %d does not follow %d; dropping older index", seq, self.last_seq)
+            self.first_seq = seq
+            self.positions = array("Q")
+        self.positions.append(position)
+
+
+class _Segment:
+    __slots__ = ("number", "path", "size", "written")
+
+    def __init__(self, number: int, path: str, size: int):
+        self.number = number
+        self.path = path
+        # bytes appended, buffered ones included
+        self.size = size
+        # bytes in the file; what a failed write left past this is cut off
+        self.written = size
+
+
+class _Shard:
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.segments: Dict[int, _Segment] = {}
+        self.active: Optional[_Segment] = None
+        # (segment, bytes) chunks appended but not yet written
+        self.pending: List[Tuple[_Segment, bytearray]] = []
+        self.file = None  # open handle on the active segment (writer thread only)
+        self.file_segment: Optional[_Segment] = None
+        self.dirty = False  # written but not fsynced
+
+    def new_segment(self) -> _Segment:
+        number = self.active.number + 1 if self.active is not None else 0
+        segment = _Segment(number, os.path.join(self.directory, "%010d%s" % (number, _SEGMENT_SUFFIX)), 0)
+        self.segments[number] = segment
+        self.active = segment
+        return segment
+
+
+class SegmentLog(MessageStore):
+    def __init__(
+        self,
+        directory: str,
+        shards: int = 16,
+        segment_bytes: int = 64 * 1024 * 1024,
+        fsync: str = "interval",
+        fsync_interval: float = 0.1,
+    ):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError("unknown fsync policy %r (expected one of %s)" % (fsync, ", ".join(FSYNC_POLICIES)))
+        self.directory = directory
+        self.shard_count = shards
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self._shards = [_Shard(os.path.join(directory, "shard-%03d" % i)) for i in range(shards)]
+        self._index: Dict[str, _ConversationIndex] = {}
+        self._lock = asyncio.Lock()
+        self._last_fsync = time.monotonic()
+        self._lock_file = None
+
+    # -- startup / shutdown ---------------------------------------------
+
+    async def open(self, recent: int) -> Dict[str, Tuple[List[Record], int]]:
+        """
+        Scan and verify every segment. Returns up to `recent` of the newest
+        records of every conversation (oldest first) and its last seq.
+        """
+        tails = await asyncio.to_thread(self._recover, recent)
+        return {conv: (list(records), self._index[conv].last_seq) for conv, records in tails.items()}
+
+    def _recover(self, recent: int) -> Dict[str, Deque[Record]]:
+        tails: Dict[str, Deque[Record]] = {}
+        self._check_meta()
+        for shard in self._shards:
+            os.makedirs(shard.directory, exist_ok=True)
+            numbers = sorted(
+                int(name[:-len(_SEGMENT_SUFFIX)])
+                for name in os.listdir(shard.directory)
+                if name.endswith(_SEGMENT_SUFFIX)
+            )
+            for number in numbers:
+                path = os.path.join(shard.directory, "%010d%s" % (number, _SEGMENT_SUFFIX))
+                size = self._recover_segment(number, path, tails, recent)
+                segment = _Segment(number, path, size)
+                shard.segments[number] = segment
+                shard.active = segment
+            if shard.active is None:
+                shard.new_segment()
+        return tails
+
+    def _check_meta(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        # appends are buffered per process, so two processes would
+        # interleave and corrupt records
+        self._lock_file = open(os.path.join(self.directory, _LOCK), "a")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock_file.close()
+            self._lock_file = None
+            raise RuntimeError(
+                "log in %s is in use by another process (several workers need CHATSPOT_STORE=sqlite)" % self.directory
+            ) from None
+        # conversations are placed by shard count, so it cannot change under
+        # an existing log
+        path = os.path.join(self.directory, _META)
+        expected = "shards=%d\n" % self.shard_count
+        if os.path.exists(path):
+            with open(path) as f:
+                found = f.read()
+            if found != expected:
+                raise ValueError("log in %s was written with %r, not %r" % (self.directory, found.strip(), expected.strip()))
+            return
+        with open(path, "w") as f:
+            f.write(expected)
+            f.flush()
+            os.fsync(f.fileno())
+        _fsync_directory(self.directory)
+
+    def _recover_segment(self, number: int, path: str, tails: Dict[str, Deque], recent: int) -> int:
+        with open(path, "rb") as f:
+            data = f.read()
+        offset = 0
+        while offset < len(data):
+            try:
+                conv, seq, payload, end = self._parse(data, offset)
+            except CorruptRecord as exc:
+                logger.warning("truncating %s at offset %d: %s", path, offset, exc)
+                with open(path, "r+b") as f:
+                    f.truncate(offset)
+                    os.fsync(f.fileno())
+                break
+            index = self._index.get(conv)
+            if index is None:
+                index = self._index[conv] = _ConversationIndex(seq)
+            index.add(seq, (number << _OFFSET_BITS) | offset)
+            tail = tails.get(conv)
+            if tail is None:
+                tail = tails[conv] = deque(maxlen=recent)
+            if recent:
+                tail.append((seq, payload))
+            offset = end
+        return offset
+
+    @staticmethod
+    def _parse(data: bytes, offset: int) -> Tuple[str, int, bytes, int]:
+        if offset + _HEADER.size > len(data):
+            raise CorruptRecord("truncated header")
+        length, crc = _HEADER.unpack_from(data, offset)
+        start = offset + _HEADER.size
+        end = start + length
+        if length < _BODY.size or end > len(data):
+            raise CorruptRecord("truncated body")
+        body = data[start:end]
+        if zlib.crc32(body) != crc:
+            raise CorruptRecord("checksum mismatch")
+        conv, seq, payload = decode_body(body)
+        return conv, seq, payload, end
+
+    async def close(self) -> None:
+        await self.flush(sync=True)
+        await asyncio.to_thread(self._close_files)
+
+    # -- writing ----------------------------------------------------------
+
+    def append(self, conv: str, seq: int, payload: bytes) -> None:
+        """
+        Buffer one record. It reaches the disk on the next flush.
+        """
+        record = encode_record(conv, seq, payload)
+        shard = self._shards[shard_of(conv, self.shard_count)]
+        segment = shard.active
+        if segment.size > 0 and segment.size + len(record) > self.segment_bytes:
+            segment = shard.new_segment()
+        if shard.pending and shard.pending[-1][0] is segment:
+            shard.pending[-1][1].extend(record)
+        else:
+            shard.pending.append((segment, bytearray(record)))
+        position = (segment.number << _OFFSET_BITS) | segment.size
+        segment.size += len(record)
+        index = self._index.get(conv)
+        if index is None:
+            index = self._index[conv] = _ConversationIndex(seq)
+        index.add(seq, position)
+
+    async def flush(self, sync: Optional[bool] = None) -> None:
+        """
+        Write every buffered record. fsyncs when `sync` is true, or when the
+        policy asks for it if `sync` is None.
+        """
+        async with self._lock:
+            if sync is None:
+                now = time.monotonic()
+                sync = self.fsync == "always" or (
+                    self.fsync == "interval" and now - self._last_fsync >= self.fsync_interval
+                )
+            work = []
+            for shard in self._shards:
+                if shard.pending:
+                    work.append((shard, shard.pending))
+                    shard.pending = []
+            if not work and not (sync and any(s.dirty for s in self._shards)):
+                return
+            try:
+                # seen through even if the caller is cancelled: the thread
+                # would go on writing after the lock is released
+                await _uninterrupted(asyncio.to_thread(self._write, work, sync))
+            except BaseException:
+                # what was not written goes out with the next flush, ahead
+                # of anything appended since
+                for shard, chunks in work:
+                    shard.pending[:0] = chunks
+                raise
+            if sync:
+                self._last_fsync = time.monotonic()
+
+    def _write(self, work: List[Tuple[_Shard, List[Tuple[_Segment, bytearray]]]], sync: bool) -> None:
+        # chunks are removed from `work` once they are in their file
+        for shard, chunks in work:
+            while chunks:
+                segment, data = chunks[0]
+                if shard.file_segment is not segment:
+                    self._open_for_append(shard, segment)
+                fd = shard.file.fileno()
+                if os.fstat(fd).st_size != segment.written:
+                    # a failed write left part of a chunk behind; indexed
+                    # positions assume it is written again from the start
+                    os.ftruncate(fd, segment.written)
+                try:
+                    shard.file.write(data)
+                    shard.file.flush()
+                except BaseException:
+                    # don't keep a handle whose buffer may still hold part of it
+                    self._drop_file(shard)
+                    raise
+                shard.dirty = True
+                segment.written += len(data)
+                del chunks[0]
+        if sync:
+            for shard in self._shards:
+                if shard.dirty:
+                    os.fsync(shard.file.fileno())
+                    shard.dirty = False
+
+    def _open_for_append(self, shard: _Shard, segment: _Segment) -> None:
+        if shard.file is not None:
+            if shard.dirty:
+                # the segment being left behind is complete; make it durable
+                os.fsync(shard.file.fileno())
+                shard.dirty = False
+            shard.file.close()
+        created = not os.path.exists(segment.path)
+        shard.file = open(segment.path, "ab")
+        shard.file_segment = segment
+        if created:
+            _fsync_directory(shard.directory)
+
+    @staticmethod
+    def _drop_file(shard: _Shard) -> None:
+        file, shard.file, shard.file_segment = shard.file, None, None
+        try:
+            file.close()
+        except OSError:
+            pass
+
+    def _close_files(self) -> None:
+        for shard in self._shards:
+            if shard.file is not None:
+                shard.file.close()
+                shard.file = None
+                shard.file_segment = None
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    # -- reading ----------------------------------------------------------
+
+    def seq_range(self, conv: str) -> Optional[Tuple[int, int]]:
+        index = self._index.get(conv)
+        if index is None or not index.positions:
+            return None
+        return index.first_seq, index.last_seq
+
+    async def read(self, conv: str, first_seq: int, last_seq: int) -> List[Record]:
+        index = self._index.get(conv)
+        if index is None:
+            return []
+        first_seq = max(first_seq, index.first_seq)
+        last_seq = min(last_seq, index.last_seq)
+        if first_seq > last_seq:
+            return []
+        positions = index.positions[first_seq - index.first_seq:last_seq - index.first_seq + 1]
+        shard = self._shards[shard_of(conv, self.shard_count)]
+        if shard.pending:
+            # some of the records may still be buffered rather than on disk
+            await self.flush(sync=False)
+        return await asyncio.to_thread(self._read, shard, positions, first_seq)
+
+    def _read(self, shard: _Shard, positions: array, first_seq: int) -> List[Record]:
+        records = []
+        files: Dict[int, int] = {}
+        try:
+            for i, position in enumerate(positions):
+                number = position >> _OFFSET_BITS
+                offset = position & _OFFSET_MASK
+                fd = files.get(number)
+                if fd is None:
+                    fd = files[number] = os.open(shard.segments[number].path, os.O_RDONLY)
+                header = os.pread(fd, _HEADER.size, offset)
+                length, crc = _HEADER.unpack(header)
+                body = os.pread(fd, length, offset + _HEADER.size)
+                if len(body) != length or zlib.crc32(body) != crc:
+                    raise CorruptRecord("bad record for seq %d in %s" % (first_seq + i, shard.segments[number].path))
+                _, seq, payload = decode_body(body)
+                records.append((seq, payload))
+        finally:
+            for fd in files.values():
+                os.close(fd)
+        return records
+
+
+async def _uninterrupted(aw: Awaitable[None]) -> None:
+    """
+    Await `aw` to the end; a cancellation meanwhile is raised afterwards.
+    """
+    task = asyncio.ensure_future(aw)
+    cancelled = False
+    while not task.done():
+        try:
+            await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if task.cancelled():
+                raise
+            cancelled = True
+    task.result()
+    if cancelled:
+        raise asyncio.CancelledError
+
+
+def _fsync_directory(path: str) -> None:
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
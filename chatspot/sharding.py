@@ -0,0 +1,497 @@
+# chatspot/sharding.py
+"""
+Conversation sharding across the worker processes of one host: the
+alternative to a backplane (backplane.py) that partitions history memory
+instead of duplicating it in every worker.
+
+Each conversation is owned by one worker, picked by a consistent-hash ring
+over the ids of the live workers (SHARD_VNODES points each), so a worker
+joining or leaving moves only about 1/N of the conversations. The owner
+holds the conversation's history and numbers its messages. Any other worker
+forwards `message`, `subscribe` and `history` to the owner as calls over
+the owner's Unix socket, and a worker with subscribers to a conversation
+it does not own gets the conversation's new messages from the owner as
+events on the same connection, which it fans out to them.
+
+Workers find each other in SHARD_DIR. At startup a worker claims the
+lowest free slot `<n>` by taking an flock on `<n>.lock` and listens on
+`<n>.sock`; a slot is live for as long as its lock is held, so a worker
+that exits, however it exits, frees it. Every SHARD_REFRESH_MS each worker
+rescans the slots and rebuilds its ring when they changed.
+
+When ownership moves, the new owner asks the previous one to `release`
+the conversation, which commits its pending store writes and drops the
+history, and then loads it from the store. The store must therefore be
+shared by all workers (sqlite); with the memory store only the seq
+numbering carries over.
+
+Frames are backplane frames (<u32 length><u8 kind><body>):
+
+    CALL  <u32 id><u8 hops><u8 name length><u16 conv length> name conv args
+    REPLY <u32 id><u8 ok> result
+    EVENT <u64 seq><u16 conv length> conv encoded-envelope
+
+args and result are JSON. A call with id 0 gets no reply. A call that
+reaches a worker that does not own the conversation by its own ring
+(during a membership change) is passed on, at most twice.
+"""
+import asyncio
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import struct
+from bisect import bisect
+from itertools import count
+from typing import Any, Awaitable, Callable, Dict, FrozenSet, Iterable, Optional, Set
+
+from . import codec, config, metrics
+from .backplane import Outbox, pack_frame, read_frames
+
+logger = logging.getLogger(__name__)
+
+forwarded = metrics.counter("chatspot_shard_calls_total", "Calls forwarded to the worker owning a conversation")
+failed_calls = metrics.counter(
+    "chatspot_shard_call_failures_total", "Forwarded calls that failed (owner unreachable, timed out or errored)"
+)
+events_sent = metrics.counter("chatspot_shard_events_total", "Messages sent to workers watching a conversation")
+
+CALL = 11
+REPLY = 12
+EVENT = 13
+
+_CALL = struct.Struct("<IBBH")
+_REPLY = struct.Struct("<IB")
+_EVENT = struct.Struct("<QH")
+
+# a call passed on this many times is answered wherever it is
+_MAX_HOPS = 2
+_CALL_TIMEOUT = 10.0
+
+# (conversation id, args) -> JSON-serializable result
+PeerHandler = Callable[[str, Any], Awaitable[Any]]
+# (conversation id, seq, encoded envelope)
+EventHandler = Callable[[str, int, bytes], Awaitable[None]]
+
+
+class ShardError(RuntimeError):
+    pass
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """
+    Consistent hashing: every member gets `vnodes` points on a ring of
+    64-bit hashes, and a key belongs to the member of the first point at or
+    after its own hash.
+    """
+
+    def __init__(self, members: Iterable[str] = (), vnodes: int = config.SHARD_VNODES):
+        self.members: FrozenSet[str] = frozenset(members)
+        points = sorted((_hash("%s#%d" % (member, i)), member) for member in self.members for i in range(vnodes))
+        self._hashes = [h for h, _ in points]
+        self._owners = [member for _, member in points]
+
+    def owner(self, key: str) -> Optional[str]:
+        if not self._owners:
+            return None
+        i = bisect(self._hashes, _hash(key))
+        return self._owners[i if i < len(self._owners) else 0]
+
+
+class Membership:
+    """
+    Worker slots in `directory`; see the module docstring.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._lock_file = None
+        self.id = ""
+
+    def claim(self) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        for n in count():
+            f = open(os.path.join(self.directory, "%d.lock" % n), "a")
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                f.close()
+                continue
+            self._lock_file = f
+            self.id = str(n)
+            return self.id
+
+    def socket_path(self, worker: str) -> str:
+        return os.path.join(self.directory, "%s.sock" % worker)
+
+    def live(self) -> Set[str]:
+        """
+        Ids of the slots whose lock is held, this worker's included.
+        """
+        live = {self.id}
+        for name in os.listdir(self.directory):
+            worker, ext = os.path.splitext(name)
+            if ext != ".lock" or worker == self.id:
+                continue
+            try:
+                with open(os.path.join(self.directory, name), "a") as f:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                live.add(worker)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        return live
+
+    def release(self) -> None:
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+
+class _Peer:
+    """
+    This worker's connection to another worker: calls go out on it, and
+    their replies and the events for conversations watched there come back.
+    """
+
+    __slots__ = ("worker", "outbox", "replies", "task")
+
+    def __init__(self, worker: str, outbox: Outbox):
+        self.worker = worker
+        self.outbox = outbox
+        self.replies: Dict[int, asyncio.Future] = {}
+        self.task: Optional[asyncio.Task] = None
+
+
+class Shard:
+    def __init__(
+        self,
+        directory: str,
+        vnodes: int = config.SHARD_VNODES,
+        refresh: float = config.SHARD_REFRESH_MS / 1000,
+    ):
+        self.membership = Membership(directory)
+        self.vnodes = vnodes
+        self.refresh = refresh
+        self.id = ""
+        self.ring = HashRing((), vnodes)
+        # the ring before the last change, to find whom to take over from
+        self.previous = self.ring
+        # conversations released to a worker before this one's ring says so
+        self._moved: Dict[str, str] = {}
+        # last seq fanned out here of each conversation watched at its owner
+        self.delivered: Dict[str, int] = {}
+        self._handlers: Dict[str, PeerHandler] = {}
+        self._on_event: Optional[EventHandler] = None
+        self._on_change: Optional[Callable[[], Awaitable[None]]] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._peers: Dict[str, _Peer] = {}
+        self._connecting: Dict[str, asyncio.Future] = {}
+        self._ids = count(1)
+        # conversation -> connections of the workers watching it here
+        self._watchers: Dict[str, Set[Outbox]] = {}
+        self._refresher: Optional[asyncio.Task] = None
+        self._background: Set[asyncio.Task] = set()
+
+    async def start(
+        self,
+        handlers: Dict[str, PeerHandler],
+        on_event: EventHandler,
+        on_change: Callable[[], Awaitable[None]],
+    ) -> None:
+        """
+        Claim a slot and start serving `handlers` (call name -> handler).
+        `on_event` receives the messages of conversations watched at their
+        owner; `on_change` runs after the ring changes or a peer is lost.
+        """
+        self._handlers = handlers
+        self._on_event = on_event
+        self._on_change = on_change
+        self.id = self.membership.claim()
+        path = self.membership.socket_path(self.id)
+        if os.path.exists(path):
+            os.unlink(path)
+        self._server = await asyncio.start_unix_server(self._serve, path)
+        # let workers started alongside this one claim their slots
+        await asyncio.sleep(self.refresh)
+        self.ring = HashRing(self.membership.live(), self.vnodes)
+        logger.info("shard worker %s of %s", self.id, sorted(self.ring.members, key=int))
+        self._refresher = asyncio.create_task(self._refresh_loop())
+
+    async def close(self) -> None:
+        if self._refresher is not None:
+            self._refresher.cancel()
+            self._refresher = None
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        for peer in list(self._peers.values()):
+            peer.task.cancel()
+            peer.outbox.writer.close()
+        self._peers.clear()
+        self.membership.release()
+
+    # -- ownership --------------------------------------------------------
+
+    def owner(self, conv: str) -> str:
+        return self._moved.get(conv) or self.ring.owner(conv) or self.id
+
+    def owns(self, conv: str) -> bool:
+        return self.owner(conv) == self.id
+
+    def hand_over(self, conv: str, worker: str) -> None:
+        """
+        `conv` now belongs to `worker`, whatever this worker's ring says
+        until it next changes.
+        """
+        self._moved[conv] = worker
+
+    async def take_over(self, conv: str) -> int:
+        """
+        Have the previous owner of `conv`, if it is still around, release
+        it. Returns its last seq there (0 if it held none).
+        """
+        previous = self.previous.owner(conv)
+        if previous is None or previous == self.id or previous not in self.ring.members:
+            return 0
+        try:
+            return await self.call(conv, "release", {"to": self.id}, worker=previous) or 0
+        except (ConnectionError, ShardError, asyncio.TimeoutError) as e:
+            logger.warning("worker %s did not release %r: %s", previous, conv, e)
+            return 0
+
+    # -- calls ------------------------------------------------------------
+
+    async def call(self, conv: str, name: str, args: Any = None, worker: Optional[str] = None, hops: int = 0) -> Any:
+        """
+        Call `name` on the owner of `conv` (or on `worker`) and return its
+        result. Raises ConnectionError, ShardError or asyncio.TimeoutError.
+        """
+        forwarded.inc()
+        try:
+            peer = await self._peer(worker or self.owner(conv))
+            call_id = next(self._ids) % 0xFFFFFFFF + 1
+            reply = peer.replies[call_id] = asyncio.get_running_loop().create_future()
+            peer.outbox.write(_pack_call(call_id, hops, name, conv, args))
+            try:
+                return await asyncio.wait_for(reply, _CALL_TIMEOUT)
+            finally:
+                peer.replies.pop(call_id, None)
+        except Exception:
+            failed_calls.inc()
+            raise
+
+    async def send(self, conv: str, name: str, args: Any = None, hops: int = 0) -> bool:
+        """
+        Call `name` on the owner of `conv` without waiting for a result.
+        Calls sent to one worker are handled in order. False if the owner
+        is unreachable.
+        """
+        forwarded.inc()
+        try:
+            peer = await self._peer(self.owner(conv))
+        except ConnectionError as e:
+            failed_calls.inc()
+            logger.warning("cannot reach the owner of %r: %s", conv, e)
+            return False
+        peer.outbox.write(_pack_call(0, hops, name, conv, args))
+        return True
+
+    async def _peer(self, worker: str) -> _Peer:
+        peer = self._peers.get(worker)
+        if peer is not None:
+            return peer
+        pending = self._connecting.get(worker)
+        if pending is None:
+            pending = self._connecting[worker] = asyncio.ensure_future(self._connect(worker))
+        try:
+            return await asyncio.shield(pending)
+        except OSError as e:
+            raise ConnectionError("worker %s: %s" % (worker, e)) from None
+
+    async def _connect(self, worker: str) -> _Peer:
+        try:
+            reader, writer = await asyncio.open_unix_connection(self.membership.socket_path(worker))
+        finally:
+            del self._connecting[worker]
+        peer = self._peers[worker] = _Peer(worker, Outbox(writer))
+        peer.task = asyncio.create_task(self._read_peer(peer, reader))
+        return peer
+
+    async def _read_peer(self, peer: _Peer, reader: asyncio.StreamReader) -> None:
+        try:
+            async for kind, body in read_frames(reader):
+                if kind == REPLY:
+                    call_id, ok = _REPLY.unpack_from(body)
+                    reply = peer.replies.get(call_id)
+                    if reply is None or reply.done():
+                        continue
+                    result = codec.decode(body[_REPLY.size:])
+                    if ok:
+                        reply.set_result(result)
+                    else:
+                        reply.set_exception(ShardError("worker %s: %s" % (peer.worker, result)))
+                elif kind == EVENT:
+                    seq, conv_len = _EVENT.unpack_from(body)
+                    start = _EVENT.size
+                    conv = body[start:start + conv_len].decode("utf-8")
+                    # handled in order, before any reply that follows it
+                    try:
+                        await self._on_event(conv, seq, body[start + conv_len:])
+                    except Exception:
+                        logger.exception("handling an event of %r failed", conv)
+        finally:
+            if self._peers.get(peer.worker) is peer:
+                del self._peers[peer.worker]
+            for reply in peer.replies.values():
+                if not reply.done():
+                    reply.set_exception(ConnectionError("worker %s went away" % peer.worker))
+            peer.outbox.writer.close()
+            if self._refresher is not None:
+                # the conversations watched there have to be watched again
+                logger.warning("lost connection to worker %s", peer.worker)
+                self._spawn(self._changed())
+
+    # -- serving ----------------------------------------------------------
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        outbox = Outbox(writer)
+        watching: Set[str] = set()
+        try:
+            async for kind, body in read_frames(reader):
+                if kind != CALL:
+                    continue
+                call_id, hops, name_len, conv_len = _CALL.unpack_from(body)
+                start = _CALL.size
+                name = body[start:start + name_len].decode("ascii")
+                start += name_len
+                conv = body[start:start + conv_len].decode("utf-8")
+                args = codec.decode(body[start + conv_len:])
+                if name in ("subscribe", "watch"):
+                    # events for conv go to the caller from now on
+                    self._watchers.setdefault(conv, set()).add(outbox)
+                    watching.add(conv)
+                elif name == "unwatch":
+                    self._unwatch(conv, outbox)
+                    watching.discard(conv)
+                    continue
+                if call_id:
+                    self._spawn(self._answer(outbox, call_id, hops, name, conv, args))
+                else:
+                    # one-way calls (messages) are handled in the order sent
+                    await self._answer(outbox, 0, hops, name, conv, args)
+        finally:
+            for conv in watching:
+                self._unwatch(conv, outbox)
+            writer.close()
+
+    async def _answer(self, outbox: Outbox, call_id: int, hops: int, name: str, conv: str, args: Any) -> None:
+        ok = True
+        try:
+            if not self.owns(conv) and hops < _MAX_HOPS and name != "release":
+                if call_id:
+                    result = await self.call(conv, name, args, hops=hops + 1)
+                else:
+                    await self.send(conv, name, args, hops=hops + 1)
+                    return
+            else:
+                handler = self._handlers.get(name)
+                if handler is None:
+                    raise ShardError("unknown call %r" % name)
+                result = await handler(conv, args)
+        except Exception as e:
+            if not call_id:
+                logger.exception("call %r on %r failed", name, conv)
+                return
+            ok, result = False, str(e) or type(e).__name__
+        if call_id:
+            outbox.write(pack_frame(REPLY, _REPLY.pack(call_id, ok), codec.encode(result)))
+
+    def _unwatch(self, conv: str, outbox: Outbox) -> None:
+        watchers = self._watchers.get(conv)
+        if watchers is not None:
+            watchers.discard(outbox)
+            if not watchers:
+                del self._watchers[conv]
+
+    def publish(self, conv: str, seq: int, encoded: bytes) -> None:
+        """
+        Send a message of `conv`, owned here, to the workers watching it.
+        """
+        watchers = self._watchers.get(conv)
+        if not watchers:
+            return
+        conv_bytes = conv.encode("utf-8")
+        event = pack_frame(EVENT, _EVENT.pack(seq, len(conv_bytes)), conv_bytes, encoded)
+        for outbox in list(watchers):
+            if outbox.buffered > config.BACKPLANE_MAX_BUFFER:
+                logger.warning("disconnecting a worker that is %d bytes behind", outbox.buffered)
+                outbox.writer.close()
+                self._unwatch(conv, outbox)
+                continue
+            outbox.write(event)
+            events_sent.inc()
+
+    def unwatch(self, conv: str) -> None:
+        """
+        The last local subscriber of `conv` has left.
+        """
+        self.delivered.pop(conv, None)
+        # only a connection to the owner can have registered this worker
+        peer = self._peers.get(self.owner(conv))
+        if peer is not None:
+            peer.outbox.write(_pack_call(0, 0, "unwatch", conv, None))
+
+    # -- membership -------------------------------------------------------
+
+    async def _refresh_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.refresh)
+            try:
+                live = self.membership.live()
+            except OSError:
+                logger.exception("scanning %s failed", self.membership.directory)
+                continue
+            if live == self.ring.members:
+                continue
+            logger.info(
+                "shard workers changed: %s -> %s", sorted(self.ring.members, key=int), sorted(live, key=int)
+            )
+            self.previous, self.ring = self.ring, HashRing(live, self.vnodes)
+            self._moved.clear()
+            await self._changed()
+
+    async def _changed(self) -> None:
+        try:
+            await self._on_change()
+        except Exception:
+            logger.exception("resharding failed")
+
+    def _spawn(self, coro) -> None:
+        task = asyncio.create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+
+def _pack_call(call_id: int, hops: int, name: str, conv: str, args: Any) -> bytes:
+    name_bytes = name.encode("ascii")
+    conv_bytes = conv.encode("utf-8")
+    return pack_frame(CALL, _CALL.pack(call_id, hops, len(name_bytes), len(conv_bytes)), name_bytes, conv_bytes, codec.encode(args))
+
+
+def open_shard() -> Optional[Shard]:
+    """
+    The shard selected by CHATSPOT_SHARD_DIR, or None.
+    """
+    if not config.SHARD_DIR:
+        return None
+    if config.BACKPLANE != "none":
+        raise ValueError("CHATSPOT_SHARD_DIR and CHATSPOT_BACKPLANE are alternatives; set only one")
+    return Shard(config.SHARD_DIR)
@@ -0,0 +1,204 @@
+# chatspot/sqlite_store.py
+"""
+SQLite storage backend.
+
+The database runs in WAL mode so readers never wait for the writer. All
+writes go through one dedicated thread that owns the write connection and
+commits each flushed batch in a single transaction with `executemany`;
+reads run on a small pool of threads with one connection each. Statements
+are fixed strings, so sqlite3's statement cache prepares each of them once
+per connection. The event loop never touches SQLite directly.
+
+Reads do not wait for a commit: records appended but not committed yet are
+served from the batches in memory, merged with what the database returns.
+
+The (conversation_id, seq) primary key of the WITHOUT ROWID table is the
+index every read uses.
+
+Several worker processes may share one database: SQLite serializes their
+writers, and each process learns of the others' records through `observe`.
+"""
+import asyncio
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from .store import MessageStore, Record
+
+# PRAGMA synchronous for each fsync policy
+_SYNCHRONOUS = {"always": "FULL", "interval": "NORMAL", "os": "OFF"}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS envelopes (
+    conversation_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    payload BLOB NOT NULL,
+    PRIMARY KEY (conversation_id, seq)
+) WITHOUT ROWID
+"""
+_INSERT = "INSERT OR REPLACE INTO envelopes (conversation_id, seq, payload) VALUES (?, ?, ?)"
+_RANGES = "SELECT conversation_id, MIN(seq), MAX(seq) FROM envelopes GROUP BY conversation_id"
+_RANGE = "SELECT MIN(seq), MAX(seq) FROM envelopes WHERE conversation_id = ?"
+_SELECT = "SELECT seq, payload FROM envelopes WHERE conversation_id = ? AND seq BETWEEN ? AND ? ORDER BY seq"
+
+
+class SQLiteStore(MessageStore):
+    def __init__(self, path: str, fsync: str = "interval", readers: int = 2):
+        if fsync not in _SYNCHRONOUS:
+            raise ValueError("unknown fsync policy %r (expected one of %s)" % (fsync, ", ".join(_SYNCHRONOUS)))
+        self.path = path
+        self.fsync = fsync
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-writer")
+        self._readers = ThreadPoolExecutor(max_workers=max(1, readers), thread_name_prefix="sqlite-reader")
+        self._local = threading.local()
+        self._write_conn: Optional[sqlite3.Connection] = None
+        # one per reader thread, closed with the store
+        self._reader_conns: List[sqlite3.Connection] = []
+        self._pending: List[Tuple[str, int, bytes]] = []
+        # the batch being committed
+        self._writing: List[Tuple[str, int, bytes]] = []
+        self._ranges: Dict[str, List[int]] = {}
+        self._lock = asyncio.Lock()
+
+    def _connect(self, check_same_thread: bool = True) -> sqlite3.Connection:
+        # the timeout covers waiting for other processes' write transactions
+        conn = sqlite3.connect(
+            self.path, timeout=10.0, isolation_level=None, cached_statements=64, check_same_thread=check_same_thread,
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=%s" % _SYNCHRONOUS[self.fsync])
+        return conn
+
+    async def _on_writer(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._writer, fn, *args)
+
+    async def _on_reader(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._readers, fn, *args)
+
+    # -- startup / shutdown ---------------------------------------------
+
+    async def open(self, recent: int) -> Dict[str, Tuple[List[Record], int]]:
+        ranges, tails = await self._on_writer(self._open, recent)
+        self._ranges = ranges
+        return {conv: (tails[conv], last) for conv, (_, last) in ranges.items()}
+
+    def _open(self, recent: int):
+        conn = self._write_conn = self._connect()
+        conn.execute(_SCHEMA)
+        ranges = {conv: [first, last] for conv, first, last in conn.execute(_RANGES)}
+        tails = {}
+        for conv, (first, last) in ranges.items():
+            if recent <= 0:
+                tails[conv] = []
+                continue
+            start = max(first, last - recent + 1)
+            tails[conv] = [(seq, bytes(payload)) for seq, payload in conn.execute(_SELECT, (conv, start, last))]
+        return ranges, tails
+
+    async def close(self) -> None:
+        await self.flush()
+        if self._write_conn is not None:
+            await self._on_writer(self._write_conn.close)
+            self._write_conn = None
+        # waiting for the threads must not block the event loop
+        await asyncio.to_thread(self._writer.shutdown, True)
+        await asyncio.to_thread(self._readers.shutdown, True)
+        for conn in self._reader_conns:
+            conn.close()
+        self._reader_conns.clear()
+
+    # -- writing ----------------------------------------------------------
+
+    def append(self, conv: str, seq: int, payload: bytes) -> None:
+        self._pending.append((conv, seq, payload))
+        self.observe(conv, seq)
+
+    def observe(self, conv: str, seq: int) -> None:
+        span = self._ranges.get(conv)
+        if span is None:
+            self._ranges[conv] = [seq, seq]
+        elif seq > span[1]:
+            span[1] = seq
+
+    async def flush(self) -> None:
+        async with self._lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, []
+            self._writing = batch
+            try:
+                await self._on_writer(self._insert, batch)
+            except BaseException:
+                # rolled back; it goes out with the next flush
+                self._pending[:0] = batch
+                raise
+            finally:
+                self._writing = []
+
+    def _insert(self, batch: List[Tuple[str, int, bytes]]) -> None:
+        conn = self._write_conn
+        conn.execute("BEGIN")
+        try:
+            conn.executemany(_INSERT, batch)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    # -- reading ----------------------------------------------------------
+
+    def seq_range(self, conv: str) -> Optional[Tuple[int, int]]:
+        span = self._ranges.get(conv)
+        return (span[0], span[1]) if span is not None else None
+
+    async def recover(self, conv: str, recent: int) -> Tuple[List[Record], int]:
+        unwritten = self._unwritten(conv)
+        span = await self._on_reader(self._range, conv)
+        if unwritten:
+            seqs = list(unwritten) + (span or [])
+            span = [min(seqs), max(seqs)]
+        if span is None:
+            self._ranges.pop(conv, None)
+            return [], 0
+        # another process may have written it since `open`
+        self._ranges[conv] = span
+        first, last = span
+        if recent <= 0:
+            return [], last
+        return await self.read(conv, max(first, last - recent + 1), last), last
+
+    def _range(self, conv: str) -> Optional[List[int]]:
+        first, last = self._reader_conn().execute(_RANGE, (conv,)).fetchone()
+        return [first, last] if first is not None else None
+
+    async def read(self, conv: str, first_seq: int, last_seq: int) -> List[Record]:
+        # taken before the select: a batch committed meanwhile is in both
+        unwritten = self._unwritten(conv, first_seq, last_seq)
+        records = await self._on_reader(self._select, conv, first_seq, last_seq)
+        if not unwritten:
+            return records
+        merged = dict(records)
+        merged.update(unwritten)
+        return sorted(merged.items())
+
+    def _unwritten(self, conv: str, first_seq: int = 1, last_seq: Optional[int] = None) -> Dict[int, bytes]:
+        # later appends of a seq win, as with INSERT OR REPLACE
+        return {
+            seq: payload
+            for batch in (self._writing, self._pending)
+            for c, seq, payload in batch
+            if c == conv and seq >= first_seq and (last_seq is None or seq <= last_seq)
+        }
+
+    def _select(self, conv: str, first_seq: int, last_seq: int) -> List[Record]:
+        conn = self._reader_conn()
+        return [(seq, bytes(payload)) for seq, payload in conn.execute(_SELECT, (conv, first_seq, last_seq))]
+
+    def _reader_conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # closed by `close` once the reader threads are gone
+            conn = self._local.conn = self._connect(check_same_thread=False)
+            self._reader_conns.append(conn)
+        return conn
@@ -0,0 +1,129 @@
+# chatspot/store.py
+"""
+Durable storage behind the in-memory conversation history.
+
+The in-memory `ConversationHistory` objects stay the hot path; a store keeps
+the copy that survives restarts and serves the envelopes memory no longer
+holds. Implementations:
+
+- MemoryStore:   keeps nothing beyond the in-memory history (the original
+                 behaviour; everything is lost on restart)
+- SegmentLog:    append-only segment files (segment_log.py)
+- SQLiteStore:   a SQLite database in WAL mode (sqlite_store.py)
+
+Writes are two-phase so they can be group-committed (see write_behind.py):
+`append` only buffers, `flush` makes everything buffered durable. Nothing
+here may block the event loop; implementations do their I/O on threads.
+"""
+from typing import Dict, List, Optional, Tuple
+
+from . import config
+
+# (seq, encoded envelope)
+Record = Tuple[int, bytes]
+
+
+class MessageStore:
+    # False for stores that lose everything on restart
+    durable = True
+
+    async def open(self, recent: int) -> Dict[str, Tuple[List[Record], int]]:
+        """
+        Prepare the store. Returns, for every stored conversation, up to
+        `recent` of its newest records (oldest first) and its last seq.
+        """
+        raise NotImplementedError
+
+    def append(self, conv: str, seq: int, payload: bytes) -> None:
+        """
+        Buffer one record; no I/O. It is durable after the next `flush`.
+        """
+        raise NotImplementedError
+
+    async def flush(self) -> None:
+        """
+        Write out everything buffered, syncing per the store's policy. If it
+        raises, whatever was not written stays buffered for the next flush.
+        """
+        raise NotImplementedError
+
+    async def recover(self, conv: str, recent: int) -> Tuple[List[Record], int]:
+        """
+        What `open` returns for one conversation, read now: up to `recent`
+        of its newest records and its last seq (0 if none). For taking over
+        a conversation another process was writing (see sharding.py).
+        """
+        span = self.seq_range(conv)
+        if span is None:
+            return [], 0
+        if recent <= 0:
+            return [], span[1]
+        return await self.read(conv, max(span[0], span[1] - recent + 1), span[1]), span[1]
+
+    def observe(self, conv: str, seq: int) -> None:
+        """
+        Another process sharing the store (see backplane.py) has stored
+        record `seq` of `conv`.
+        """
+
+    def seq_range(self, conv: str) -> Optional[Tuple[int, int]]:
+        """
+        (first, last) seq of `conv` held by the store, or None.
+        """
+        raise NotImplementedError
+
+    async def read(self, conv: str, first_seq: int, last_seq: int) -> List[Record]:
+        """
+        Records of `conv` with first_seq <= seq <= last_seq, oldest first.
+        """
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        raise NotImplementedError
+
+
+class MemoryStore(MessageStore):
+    durable = False
+
+    async def open(self, recent: int) -> Dict[str, Tuple[List[Record], int]]:
+        return {}
+
+    def append(self, conv: str, seq: int, payload: bytes) -> None:
+        pass
+
+    async def flush(self) -> None:
+        pass
+
+    def seq_range(self, conv: str) -> Optional[Tuple[int, int]]:
+        return None
+
+    async def read(self, conv: str, first_seq: int, last_seq: int) -> List[Record]:
+        return []
+
+    async def close(self) -> None:
+        pass
+
+
+def open_store(kind: str = config.STORE) -> MessageStore:
+    """
+    Build the store selected by CHATSPOT_STORE (not yet opened).
+    """
+    if kind == "memory":
+        return MemoryStore()
+    if kind == "log":
+        from .segment_log import SegmentLog
+
+        if not config.LOG_DIR:
+            raise ValueError("CHATSPOT_STORE=log needs CHATSPOT_LOG_DIR")
+        return SegmentLog(
+            config.LOG_DIR,
+            shards=config.LOG_SHARDS,
+            segment_bytes=config.LOG_SEGMENT_BYTES,
+            fsync=config.STORE_FSYNC,
+            fsync_interval=config.LOG_FSYNC_INTERVAL_MS / 1000,
+        )
+    if kind == "sqlite":
+        from .sqlite_store import SQLiteStore
+
+        return SQLiteStore(config.SQLITE_PATH, fsync=config.STORE_FSYNC, readers=config.SQLITE_READERS)
+    raise ValueError("unknown store %r (expected memory, log or sqlite)" % kind)
@@ -0,0 +1,149 @@
+# chatspot/write_behind.py
+"""
+Group-commit, write-behind stage in front of a durable store.
+
+`submit` only hands the record to the store's in-memory buffer, so the
+message path fans out without waiting on the disk. A background task
+commits everything submitted -- from every connection -- in one batch when
+either the oldest uncommitted record is `window` seconds old or the batch
+has reached `max_records` / `max_bytes`. `window` is therefore the
+durability window: the most a crash can lose.
+
+A commit that fails leaves the batch in the store's buffer; it is retried,
+together with whatever was submitted since, after `retry` seconds, doubling
+up to `retry_max` while the store keeps failing.
+
+The store needs two methods: `append(conv, seq, payload)` (buffer, no I/O)
+and `async flush()` (write the buffer out, fsyncing per its own policy).
+"""
+import asyncio
+import logging
+import time
+from typing import Optional
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+commit_latency = metrics.histogram(
+    "chatspot_store_commit_seconds", "Time to write (and fsync) one batch of envelopes"
+)
+commit_batch = metrics.histogram(
+    "chatspot_store_commit_batch_records", "Envelopes written per commit", metrics.SIZE_BUCKETS
+)
+commit_lag = metrics.histogram(
+    "chatspot_store_commit_lag_seconds", "Age of the oldest envelope in a batch when it was committed"
+)
+commit_errors = metrics.counter("chatspot_store_commit_errors_total", "Commits that raised")
+uncommitted = metrics.gauge("chatspot_store_uncommitted_records", "Envelopes submitted but not yet committed")
+
+
+class WriteBehind:
+    def __init__(
+        self, store, window: float, max_records: int, max_bytes: int, retry: float = 0.05, retry_max: float = 5.0,
+    ):
+        self.store = store
+        self.window = window
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.retry = retry
+        self.retry_max = retry_max
+        # commits failed in a row
+        self._failures = 0
+        self._records = 0
+        self._bytes = 0
+        self._oldest: Optional[float] = None
+        self._wakeup = asyncio.Event()
+        self._stopping = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def submit(self, conv: str, seq: int, payload: bytes) -> None:
+        self.store.append(conv, seq, payload)
+        if self._oldest is None:
+            self._oldest = time.monotonic()
+            # the committer may be idle with no deadline; give it one
+            self._wakeup.set()
+        self._records += 1
+        self._bytes += len(payload)
+        uncommitted.set(self._records)
+        if self._records >= self.max_records or self._bytes >= self.max_bytes:
+            self._wakeup.set()
+
+    @property
+    def pending(self) -> int:
+        return self._records
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        """
+        Stop the committer and commit whatever is still pending.
+        """
+        if self._task is not None:
+            # not cancelled: a commit in progress runs to its end, so the
+            # last one below never overlaps it
+            self._stopping.set()
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.commit()
+
+    async def commit(self) -> bool:
+        """
+        Commit everything submitted so far, now. False if the store failed;
+        the envelopes are then still pending.
+        """
+        if self._oldest is None:
+            return True
+        records, nbytes, oldest = self._records, self._bytes, self._oldest
+        self._records = 0
+        self._bytes = 0
+        self._oldest = None
+        uncommitted.set(0)
+        started = time.monotonic()
+        try:
+            await self.store.flush()
+        except BaseException as exc:
+            # the store still holds them, ahead of anything submitted since
+            self._records += records
+            self._bytes += nbytes
+            self._oldest = oldest
+            uncommitted.set(self._records)
+            if not isinstance(exc, Exception):
+                raise
+            self._failures += 1
+            commit_errors.inc()
+            logger.exception("commit of %d envelopes failed (%d in a row); retrying", records, self._failures)
+            return False
+        self._failures = 0
+        finished = time.monotonic()
+        commit_latency.observe(finished - started)
+        commit_batch.observe(records)
+        commit_lag.observe(finished - oldest)
+        return True
+
+    async def _run(self) -> None:
+        while not self._stopping.is_set():
+            if self._oldest is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            full = self._records >= self.max_records or self._bytes >= self.max_bytes
+            remaining = self._oldest + self.window - time.monotonic()
+            if not full and remaining > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            if not await self.commit():
+                # give a failing store time before trying again
+                try:
+                    await asyncio.wait_for(
+                        self._stopping.wait(), min(self.retry * 2 ** (self._failures - 1), self.retry_max),
+                    )
+                except asyncio.TimeoutError:
+                    pass
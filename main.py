@@ -1,12 +1,41 @@
 # main.py
-import json
+import asyncio
+import logging
 from pathlib import Path
-from typing import Dict, List, Set
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
 
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse, PlainTextResponse
 
+from chatspot import binary, codec, config, metrics, protocol
+from chatspot.actor import ActorPool
+from chatspot.backplane import Backplane, open_backplane
+from chatspot.connection import Connection
+from chatspot.fanout import FanoutEngine, close_quietly
+from chatspot.frame import Frame
+from chatspot.history import (
+    ConversationHistory,
+    HistoryBudget,
+    StoredEnvelope,
+    empty_history_frame,
+    intern_id,
+    message_frame,
+    paginate,
+    records_frame,
+    reset_frame,
+    resumable,
+    subscribe_frames,
+)
+from chatspot.overload import TRY_AGAIN_LATER, LagMonitor
+from chatspot.protocol import BinaryMessage, History, Identify, Message, Subscribe
+from chatspot.registry import SubscriptionRegistry
+from chatspot.sharding import PeerHandler, Shard, ShardError, open_shard
+from chatspot.store import MemoryStore, MessageStore, open_store
+from chatspot.write_behind import WriteBehind
+
+logger = logging.getLogger("chatspot")
+
 app = FastAPI(title="Chat Prototype (Python Backend)")
 
 
@@ -20,9 +49,215 @@ if not STATIC_DIR.exists():
 app.mount("/static", StaticFiles(directory=str(STATIC_DIR)), name="static")
 
 
-conversations: Dict[str, List[dict]] = {}
-subscriptions: Dict[str, Set[WebSocket]] = {}
-connections: Set[WebSocket] = set()
+conversations: Dict[str, ConversationHistory] = {}
+# bytes held by all of `conversations` (CHATSPOT_HISTORY_MEMORY_BUDGET)
+history_budget = HistoryBudget()
+subscriptions = SubscriptionRegistry()
+connections: Set[Connection] = set()
+metrics.gauge("chatspot_connections", "Open WebSocket connections", lambda: len(connections))
+metrics.gauge("chatspot_subscriptions", "(conversation, connection) subscription pairs", subscriptions.subscription_count)
+metrics.gauge("chatspot_subscribed_conversations", "Conversations with at least one subscriber", lambda: len(subscriptions))
+
+fanout = FanoutEngine()
+# numbers, stores and fans out the messages of each conversation in order
+actors = ActorPool()
+# sheds load when the event loop falls behind (CHATSPOT_LAG_*)
+lag_monitor = LagMonitor()
+# durable copy of every envelope (CHATSPOT_STORE), replaced at startup
+store: MessageStore = MemoryStore()
+# group-commits appends to `store` off the message path; None if not durable
+store_writer: Optional[WriteBehind] = None
+# shares messages with the other workers (CHATSPOT_BACKPLANE); None if this
+# is the only one
+backplane: Optional[Backplane] = open_backplane()
+# splits conversations between the workers (CHATSPOT_SHARD_DIR); None if
+# this worker holds them all
+shard: Optional[Shard] = open_shard()
+# conversations being taken over from their previous owner
+_adopting: Dict[str, asyncio.Future] = {}
+# connections that negotiated binary `message` frames; none means there is
+# no binary frame to build
+binary_connections = 0
+# strong references to fire-and-forget close tasks for evicted sockets
+_background: Set[asyncio.Task] = set()
+
+
+def leave(conn: Connection) -> None:
+    """
+    Drop `conn` from every conversation it joined.
+    """
+    left = subscriptions.remove(conn)
+    if backplane is not None or shard is not None:
+        for conv in left:
+            if conv not in subscriptions:
+                (backplane or shard).unwatch(conv)
+
+
+def unsubscribe(conn: Connection, conv: str) -> None:
+    """
+    Drop `conn` from `conv` alone.
+    """
+    subscriptions.unsubscribe(conv, conn)
+    if (backplane is not None or shard is not None) and conv not in subscriptions:
+        (backplane or shard).unwatch(conv)
+
+
+def evict(dead: List[Connection]) -> None:
+    """
+    Drop connections that failed a fan-out send from every conversation and
+    close them in the background so the caller is not held up.
+    """
+    for s in dead:
+        leave(s)
+        if s.closed:
+            # already closing itself (outbound queue policy)
+            continue
+        s.closed = True
+        task = asyncio.create_task(close_quietly(s.ws))
+        _background.add(task)
+        task.add_done_callback(_background.discard)
+
+
+@app.on_event("startup")
+async def start_lag_monitor():
+    lag_monitor.start()
+
+
+@app.on_event("shutdown")
+async def stop_lag_monitor():
+    await lag_monitor.close()
+
+
+@app.on_event("startup")
+async def open_storage():
+    """
+    Open the durable store (CHATSPOT_STORE) and recover conversations from
+    it, keeping the newest STORE_RECOVER_RECENT envelopes of each in memory.
+    """
+    global store, store_writer
+    actors.start(accept_message)
+    store = open_store()
+    # sharded workers load the conversations they own when first used
+    recovered = await store.open(config.STORE_RECOVER_RECENT if shard is None else 0)
+    for conv, (records, last_seq) in recovered.items() if shard is None else ():
+        history = conversations[conv] = ConversationHistory(conv, budget=history_budget)
+        history.restore(records)
+        # numbering continues after the newest stored envelope
+        history.last_seq = last_seq
+    if store.durable:
+        store_writer = WriteBehind(
+            store,
+            window=config.STORE_COMMIT_WINDOW_MS / 1000,
+            max_records=config.STORE_COMMIT_MAX_RECORDS,
+            max_bytes=config.STORE_COMMIT_MAX_BYTES,
+        )
+        store_writer.start()
+    if backplane is not None:
+        await backplane.start(on_backplane_event)
+    if shard is not None:
+        await shard.start(peer_handlers, on_shard_event, reshard)
+
+
+@app.on_event("shutdown")
+async def close_storage():
+    await actors.close()
+    if backplane is not None:
+        await backplane.close()
+    if shard is not None:
+        await shard.close()
+    if store_writer is not None:
+        await store_writer.close()
+    await store.close()
+
+
+async def history_page(conv: str, before: Optional[int], after: Optional[int], limit: int) -> str:
+    """
+    Answer a `history` request from memory, or from the store for envelopes
+    older than what memory holds.
+    """
+    history = conversations.get(conv)
+    if history is None:
+        return empty_history_frame(conv)
+    span = store.seq_range(conv)
+    if before is not None:
+        first = max(before - limit, 1)
+        if span is None or first >= history.first_seq:
+            return history.before_frame(before, limit)
+        first = max(first, span[0])
+        records = await store.read(conv, first, min(before - 1, history.last_seq))
+        return records_frame(conv, [e for _, e in records], has_more=first > span[0])
+    if after is not None:
+        if span is None or after + 1 >= history.first_seq:
+            return history.after_frame(after, limit)
+        first = max(after + 1, span[0])
+        last = min(first + limit - 1, history.last_seq)
+        records = await store.read(conv, first, last)
+        return records_frame(conv, [e for _, e in records], has_more=last < history.last_seq)
+    stored = await tail_from_store(conv, history, limit)
+    return stored[0] if stored is not None else history.tail_frame(limit)
+
+
+async def tail_from_store(conv: str, history: ConversationHistory, limit: int):
+    """
+    The newest `limit` envelopes as a `history` frame, with the first and
+    last seq available, when memory holds fewer of them than the store
+    (retention dropped them, or they were not recovered); None otherwise.
+    """
+    if len(history) >= limit:
+        return None
+    span = store.seq_range(conv)
+    if span is None or span[0] >= history.first_seq:
+        return None
+    # take the in-memory part before awaiting, so the snapshot stays consistent
+    held = history.held()
+    first_held = history.first_seq
+    last_seq = history.last_seq
+    first = max(span[0], last_seq - limit + 1)
+    older = await store.read(conv, first, first_held - 1)
+    frame = records_frame(conv, [e for _, e in older] + [e for _, e in held], has_more=first > span[0])
+    return frame, span[0], last_seq
+
+
+async def resume_from_store(conv: str, history: ConversationHistory, since: int):
+    """
+    Catch-up frames for a resume whose gap begins before the in-memory
+    history but is still in the store, and the last seq they cover; None if
+    the store cannot fill the gap either.
+    """
+    span = store.seq_range(conv)
+    if span is None or not span[0] - 1 <= since < history.first_seq - 1:
+        return None
+    if history.last_seq - since > config.HISTORY_RESUME_MAX:
+        return None
+    # take the in-memory part before awaiting, so the snapshot stays consistent
+    newer = history.resume_frames(history.first_seq - 1, config.HISTORY_PAGE_MAX) if len(history) else []
+    last_seq = history.last_seq
+    older = await store.read(conv, since + 1, history.first_seq - 1)
+    if len(older) != history.first_seq - 1 - since:
+        return None
+    return paginate(conv, older, config.HISTORY_PAGE_MAX, more_after=bool(newer)) + newer, last_seq
+
+
+async def subscribe_snapshot(conv: str, history: Optional[ConversationHistory], since: Optional[int]):
+    """
+    The frames that answer a `subscribe` and the last seq they cover: the
+    missed envelopes for a resume, otherwise the tail (after a `reset` if
+    `since` was given), from memory where it holds them and from the store
+    where it does not.
+    """
+    if history is None or (since is not None and resumable(history, since)):
+        return subscribe_frames(conv, history, since)
+    if since is not None and not history.covers(since):
+        resumed = await resume_from_store(conv, history, since)
+        if resumed is not None:
+            return resumed
+    stored = await tail_from_store(conv, history, config.HISTORY_INITIAL_TAIL)
+    if stored is None:
+        return subscribe_frames(conv, history, since)
+    frame, first_seq, last_seq = stored
+    if since is not None:
+        return [reset_frame(conv, first_seq, last_seq), frame], last_seq
+    return [frame], last_seq
 
 
 @app.get("/")
@@ -40,75 +275,454 @@ async def index():
     return FileResponse(index_path, media_type="text/html")
 
 
+@app.get("/metrics")
+async def prometheus_metrics():
+    """
+    Server metrics in the Prometheus text format, for scraping.
+    """
+    return PlainTextResponse(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+@app.get("/stats")
+async def stats():
+    """
+    Per-connection outbound queue depth and drop counts, plus server metrics.
+    """
+    return {
+        "fanoutMode": fanout.mode,
+        "conversations": len(subscriptions),
+        "subscriptions": subscriptions.subscription_count(),
+        "historyBytes": history_budget.total,
+        "actors": len(actors),
+        "loopLagMs": round(lag_monitor.lag * 1000, 3),
+        "shedStage": lag_monitor.stage,
+        "store": config.STORE,
+        "storeUncommitted": store_writer.pending if store_writer is not None else None,
+        "shard": shard.id if shard is not None else None,
+        "metrics": metrics.snapshot(),
+        "connections": [c.stats() for c in connections],
+    }
+
+
+Handler = Callable[[Connection, Any], Awaitable[None]]
+# action -> coroutine answering a decoded request (see chatspot/protocol.py)
+handlers: Dict[str, Handler] = {}
+
+
+def handles(action: str) -> Callable[[Handler], Handler]:
+    def register(handler: Handler) -> Handler:
+        handlers[action] = handler
+        return handler
+
+    return register
+
+
+@handles(Identify.ACTION)
+async def on_identify(conn: Connection, msg: Identify) -> None:
+    global binary_connections
+    conn.user_id = msg.user_id
+    wants_binary = bool(msg.binary)
+    if wants_binary != conn.binary:
+        binary_connections += 1 if wants_binary else -1
+        conn.binary = wants_binary
+    conn.batch = bool(msg.batch)
+    await conn.send(codec.encode_text({
+        "action": "identified",
+        "userId": conn.user_id,
+        "binary": conn.binary,
+        "batch": conn.batch,
+    }))
+
+
+@handles(Subscribe.ACTION)
+async def on_subscribe(conn: Connection, msg: Subscribe) -> None:
+    conv = intern_id(msg.conversation_id)
+    if lag_monitor.rejects_subscribe():
+        await conn.send(lag_monitor.overloaded_frame("subscribe", conv))
+        return
+    # held back while the event loop is overloaded, before the connection
+    # joins conv: nothing is buffered for it in the meantime
+    await lag_monitor.defer_history()
+    # hold back live frames for conv until the history is out, so nothing
+    # overtakes or duplicates the snapshot
+    conn.begin_handoff(conv)
+    joined = subscriptions.subscribe(conv, conn)
+    if backplane is not None:
+        # brings the history up to date if no one here was watching conv
+        history = conversations.get(conv)
+        await backplane.watch(conv, history.last_seq if history is not None else 0)
+    since = msg.since_seq
+    while True:
+        if shard is not None and not shard.owns(conv):
+            # the owner answers, and sends this worker conv's messages from now on
+            try:
+                frames, last_seq = await shard.call(conv, "subscribe", {"since": since})
+            except (ConnectionError, ShardError, asyncio.TimeoutError) as e:
+                # the owner is gone or stuck; the client retries once the ring
+                # has settled
+                logger.warning("subscribing to %r through its owner failed: %r", conv, e)
+                if joined:
+                    conn.abort_handoff(conv)
+                    unsubscribe(conn, conv)
+                else:
+                    # still subscribed from before: release what was held back
+                    await conn.finish_handoff(conv, 0)
+                await conn.send(lag_monitor.overloaded_frame("subscribe", conv))
+                return
+            shard.delivered[conv] = max(shard.delivered.get(conv, 0), last_seq)
+        else:
+            # send history (pre-serialized, see chatspot/history.py)
+            history = await owned_history(conv) if shard is not None else conversations.get(conv)
+            frames, last_seq = await subscribe_snapshot(conv, history, since)
+        for frame in frames:
+            await conn.send(frame, "history")
+        if await conn.finish_handoff(conv, last_seq) or conn.closed:
+            return
+        # more live frames came in while the history was sent than the
+        # connection may hold, and were dropped: catch the client up from
+        # where the history ended, like a resume (a `reset` and the tail if
+        # they are gone from the history too)
+        conn.begin_handoff(conv)
+        since = last_seq
+
+
+@handles(History.ACTION)
+async def on_history(conn: Connection, msg: History) -> None:
+    limit = msg.limit
+    if limit is None or limit <= 0:
+        limit = config.HISTORY_INITIAL_TAIL
+    limit = min(limit, config.HISTORY_PAGE_MAX)
+    conv = msg.conversation_id
+    # held back while the event loop is overloaded
+    await lag_monitor.defer_history()
+    if shard is None:
+        frame = await history_page(conv, msg.before, msg.after, limit)
+    elif shard.owns(conv):
+        await owned_history(conv)
+        frame = await history_page(conv, msg.before, msg.after, limit)
+    else:
+        try:
+            frame = await shard.call(conv, "history", {"before": msg.before, "after": msg.after, "limit": limit})
+        except (ConnectionError, ShardError, asyncio.TimeoutError) as e:
+            logger.warning("fetching history of %r from its owner failed: %r", conv, e)
+            await conn.send(lag_monitor.overloaded_frame("history", conv))
+            return
+    await conn.send(frame, "history")
+
+
+@handles(Message.ACTION)
+async def on_message(conn: Connection, msg: Message) -> None:
+    envelope = msg.envelope
+    conv = envelope.get("conversationId")
+    if type(conv) is not str or not conv:
+        return
+    conv = intern_id(conv)
+    history = conversations.get(conv)
+    if backplane is not None:
+        # numbered and delivered, here too, by the backplane
+        envelope.pop("seq", None)
+        backplane.publish(conv, codec.encode(envelope), history.last_seq if history else 0)
+        return
+    if shard is not None and not shard.owns(conv):
+        # numbered by the owner, which re-encodes binary frames
+        await shard.send(conv, "message", envelope)
+        return
+    # numbered and delivered by the conversation's actor, one at a time
+    await actors.post(conv, (envelope, msg.frame if isinstance(msg, BinaryMessage) else None))
+
+
+async def accept_message(conv: str, item: Tuple[dict, Optional[bytes]]) -> None:
+    """
+    Number, store and fan out a message; run by the actor of `conv`.
+    `item` is the envelope and, if it arrived as one, its binary frame.
+    """
+    envelope, received = item
+    if shard is not None and not shard.owns(conv):
+        # released while it waited in the mailbox
+        await shard.send(conv, "message", envelope)
+        return
+    history = await owned_history(conv)
+    # store envelope (opaque payload), encoded once
+    record = history.append(envelope)
+    if store_writer is not None:
+        # committed in the background, within STORE_COMMIT_WINDOW_MS
+        store_writer.submit(conv, record.seq, record.encoded)
+    if shard is not None:
+        shard.publish(conv, record.seq, record.encoded)
+    frame = None
+    if binary_connections:
+        if received is not None:
+            # forwarded as received, with the seq filled in
+            frame = binary.with_seq(received, record.seq)
+        else:
+            frame = binary.encode_message(record.seq, conv, record.sender_id, record.iv, record.ciphertext, envelope)
+    await deliver(record, frame)
+
+
+async def on_backplane_event(conv: str, seq: int, encoded: bytes, origin: bool, keep: bool) -> None:
+    """
+    A message numbered by the backplane, from any worker: keep it in this
+    worker's history and deliver it to this worker's subscribers.
+    """
+    conv = intern_id(conv)
+    if not keep:
+        # published here to a conversation no one here watches
+        if store_writer is not None:
+            store_writer.submit(conv, seq, encoded)
+        return
+    history = conversations.get(conv)
+    if history is None:
+        history = conversations[conv] = ConversationHistory(conv, budget=history_budget)
+    elif seq <= history.last_seq:
+        # already held, e.g. recovered from the store after it was sent
+        return
+    record = history.append_numbered(seq, encoded)
+    if origin or not backplane.shared_store:
+        # in a shared store only the publishing worker persists it; a store
+        # of this node's own needs everything it holds
+        if store_writer is not None:
+            store_writer.submit(conv, seq, encoded)
+    else:
+        store.observe(conv, seq)
+    await deliver(record, binary_frame(record))
+
+
+def binary_frame(record: StoredEnvelope) -> Optional[bytes]:
+    """
+    The binary `message` frame for a record that carries only its encoding,
+    or None if no connection wants one.
+    """
+    if not binary_connections:
+        return None
+    envelope = codec.decode(record.encoded)
+    full = StoredEnvelope.from_envelope(record.seq, envelope, record.encoded)
+    return binary.encode_message(record.seq, full.conversation_id, full.sender_id, full.iv, full.ciphertext, envelope)
+
+
+async def deliver(record: StoredEnvelope, frame: Optional[bytes]) -> None:
+    """
+    Fan a stored message out to the subscribers of its conversation, binary
+    ones as `frame` if there is one.
+    """
+    conv = record.conversation_id
+    subs = subscriptions.subscribers(conv)
+    if frame is not None:
+        # encoded once for all binary subscribers, like the text frame
+        frame = Frame(frame, binary=True)
+    dead = await fanout.broadcast(subs, message_frame(record), conv=conv, seq=record.seq, binary=frame)
+    if dead:
+        evict(dead)
+
+
+# -- sharding (chatspot/sharding.py) ------------------------------------------
+
+# call name -> coroutine answering it for another worker
+peer_handlers: Dict[str, PeerHandler] = {}
+
+
+def answers(name: str) -> Callable[[PeerHandler], PeerHandler]:
+    def register(handler: PeerHandler) -> PeerHandler:
+        peer_handlers[name] = handler
+        return handler
+
+    return register
+
+
+async def owned_history(conv: str) -> ConversationHistory:
+    """
+    The history of `conv`, which this worker owns; taken over from its
+    previous owner, through the store, the first time it is needed.
+    """
+    history = conversations.get(conv)
+    if history is not None:
+        return history
+    if shard is None:
+        history = conversations[conv] = ConversationHistory(conv, budget=history_budget)
+        return history
+    pending = _adopting.get(conv)
+    if pending is None:
+        pending = _adopting[conv] = asyncio.ensure_future(adopt(conv))
+        pending.add_done_callback(lambda _: _adopting.pop(conv, None))
+    return await asyncio.shield(pending)
+
+
+async def adopt(conv: str) -> ConversationHistory:
+    released = await shard.take_over(conv)
+    records, last_seq = await store.recover(conv, config.STORE_RECOVER_RECENT)
+    history = conversations.get(conv)
+    if history is None:
+        history = conversations[conv] = ConversationHistory(conv, budget=history_budget)
+        if released <= last_seq:
+            history.restore(records)
+        # numbering continues after the previous owner's last seq even if
+        # the store lost its tail
+        history.last_seq = max(last_seq, released)
+    return history
+
+
+def release_history(conv: str) -> None:
+    # this worker no longer owns conv; its subscribers here follow the owner
+    history = conversations.pop(conv)
+    if conv in subscriptions:
+        shard.delivered[conv] = max(shard.delivered.get(conv, 0), history.last_seq)
+    history.clear()
+
+
+async def reshard() -> None:
+    """
+    The ring changed, or a connection to another worker was lost: let go of
+    the conversations this worker no longer owns, and bring the ones its
+    subscribers follow up to date from their owners.
+    """
+    moved = [conv for conv in conversations if not shard.owns(conv)]
+    if moved:
+        # what the new owners will read back from the store
+        if store_writer is not None:
+            await store_writer.commit()
+        for conv in moved:
+            if conv in conversations and not shard.owns(conv):
+                release_history(conv)
+    for conv in list(subscriptions):
+        await resync(conv)
+
+
+async def resync(conv: str) -> None:
+    # deliver what this worker's subscribers of conv missed while its owner
+    # changed, and have the owner send them the rest
+    since = shard.delivered.get(conv)
+    try:
+        if shard.owns(conv):
+            history = await owned_history(conv)
+            missed = [(seq, encoded) for seq, encoded in history.held() if since is not None and seq > since]
+        else:
+            missed = [(seq, encoded.encode("utf-8")) for seq, encoded in await shard.call(conv, "watch", {"since": since})]
+    except (ConnectionError, ShardError, asyncio.TimeoutError) as e:
+        logger.warning("resyncing %r failed: %s", conv, e)
+        return
+    for seq, encoded in missed:
+        await on_shard_event(conv, seq, encoded)
+    if shard.owns(conv):
+        # delivered as they are appended from now on
+        shard.delivered.pop(conv, None)
+
+
+async def on_shard_event(conv: str, seq: int, encoded: bytes) -> None:
+    """
+    A message of a conversation owned by another worker, for the
+    subscribers here.
+    """
+    conv = intern_id(conv)
+    if seq <= shard.delivered.get(conv, 0) or conv not in subscriptions:
+        return
+    shard.delivered[conv] = seq
+    record = StoredEnvelope(seq, conv, None, None, None, encoded)
+    await deliver(record, binary_frame(record))
+
+
+@answers("message")
+async def serve_message(conv: str, envelope: Any) -> None:
+    # owned here, or passed on as far as it may go
+    if type(envelope) is dict:
+        await actors.post(conv, (envelope, None))
+
+
+@answers("subscribe")
+async def serve_subscribe(conv: str, args: Any):
+    return await subscribe_snapshot(conv, await owned_history(conv), args.get("since"))
+
+
+@answers("history")
+async def serve_history(conv: str, args: Any) -> str:
+    await owned_history(conv)
+    return await history_page(conv, args.get("before"), args.get("after"), args["limit"])
+
+
+@answers("watch")
+async def serve_watch(conv: str, args: Any) -> List[Tuple[int, str]]:
+    # what a worker that follows conv has not seen yet
+    since = args.get("since")
+    history = await owned_history(conv)
+    if since is None or since >= history.last_seq:
+        return []
+    since = max(since, history.last_seq - config.HISTORY_RESUME_MAX)
+    held = history.held()
+    older = []
+    if since + 1 < history.first_seq:
+        older = await store.read(conv, since + 1, history.first_seq - 1)
+    return [(seq, encoded.decode("utf-8")) for seq, encoded in older + held if seq > since]
+
+
+@answers("release")
+async def serve_release(conv: str, args: Any) -> int:
+    # another worker takes conv over; everything stored here must be in the
+    # store before it reads it
+    shard.hand_over(conv, args["to"])
+    history = conversations.get(conv)
+    if history is None:
+        return 0
+    if store_writer is not None:
+        await store_writer.commit()
+    last_seq = history.last_seq
+    if conversations.get(conv) is history:
+        release_history(conv)
+    if conv in subscriptions:
+        task = asyncio.create_task(resync(conv))
+        _background.add(task)
+        task.add_done_callback(_background.discard)
+    return last_seq
+
+
 @app.websocket("/ws")
 async def websocket_endpoint(ws: WebSocket):
     """
-    Expected WebSocket messages are JSON objects:
-    - identify: { action: "identify", userId: "user-1" }
-    - subscribe: { action: "subscribe", conversationId: "room1" }
+    Expected WebSocket messages are JSON objects (schemas in chatspot/protocol.py):
+    - identify: { action: "identify", userId: "user-1", binary?: true, batch?: true }
+    - subscribe: { action: "subscribe", conversationId: "room1", sinceSeq?: seq }
+    - history: { action: "history", conversationId: "room1", before?: seq, after?: seq, limit?: n }
     - message: { action: "message", envelope: { conversationId, senderId, iv, ciphertext, ... } }
-    The server stores envelopes (opaque) and fans out to subscribers of that conversation.
+    The server stores envelopes (opaque apart from the `seq` it assigns) and fans out
+    to subscribers of that conversation. `subscribe` replies with the newest
+    HISTORY_INITIAL_TAIL envelopes; older or newer pages are fetched with `history`.
+    A reconnecting client passes the last `seq` it saw as `sinceSeq` and gets only
+    the envelopes after it, or a `reset` frame followed by the tail if those are gone.
+    A client that identifies with `binary: true` gets `message` frames in the binary
+    format of chatspot/binary.py; any client may send `message` frames in it.
+    A client that identifies with `batch: true` may get several envelopes in one
+    `{ action: "batch", envelopes: [...] }` frame.
+    While the event loop is overloaded `subscribe` may be answered with an
+    `overloaded` frame and new connections closed with 1013 (chatspot/overload.py).
     """
+    global binary_connections
     await ws.accept()
-    connections.add(ws)
+    if lag_monitor.refuses_connect():
+        await ws.close(code=TRY_AGAIN_LATER, reason=lag_monitor.refusal())
+        return
+    conn = Connection(ws, queued=fanout.queued)
+    conn.start()
+    connections.add(conn)
     try:
-        while True:
-            raw = await ws.receive_text()
-            try:
-                msg = json.loads(raw)
-            except Exception:
-                # ignore malformed messages
+        # `closed` is set when the server drops the client (slow consumer)
+        while not conn.closed:
+            message = await ws.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            # oversized, malformed and unknown frames come back as None
+            text = message.get("text")
+            if text is not None:
+                msg = protocol.decode(text)
+            else:
+                msg = protocol.decode_binary(message.get("bytes") or b"")
+            if msg is None:
                 continue
-
-            action = msg.get("action")
-            if action == "identify":
-                ws._user_id = msg.get("userId")
-                await ws.send_text(json.dumps({"action": "identified", "userId": ws._user_id}))
-                continue
-
-            if action == "subscribe":
-                conv = msg.get("conversationId")
-                if conv is None:
-                    continue
-                if conv not in subscriptions:
-                    subscriptions[conv] = set()
-                subscriptions[conv].add(ws)
-                # send history
-                history = conversations.get(conv, [])
-                await ws.send_text(json.dumps({"action": "history", "conversationId": conv, "history": history}))
-                continue
-
-            if action == "message":
-                envelope = msg.get("envelope")
-                if not envelope:
-                    continue
-                conv = envelope.get("conversationId")
-                if not conv:
-                    continue
-                # store envelope (opaque payload)
-                conversations.setdefault(conv, []).append(envelope)
-                # fan-out to subscribers of conversation
-                subs = subscriptions.get(conv, set()).copy()
-                payload = json.dumps({"action": "message", "envelope": envelope})
-                to_remove = []
-                for s in subs:
-                    try:
-                        await s.send_text(payload)
-                    except Exception:
-                        # connection likely dead; mark for removal
-                        to_remove.append(s)
-                for s in to_remove:
-                    subscriptions[conv].discard(s)
-                continue
-
-            # unknown action -> ignore
+            handler = handlers.get(msg.ACTION)
+            if handler is not None:
+                await handler(conn, msg)
     except WebSocketDisconnect:
-        # cleanup: remove from any subscriptions
-        connections.discard(ws)
-        for conv_set in subscriptions.values():
-            conv_set.discard(ws)
+        pass
     finally:
-        # best effort cleanup
-        connections.discard(ws)
-        for conv_set in subscriptions.values():
-            conv_set.discard(ws)
+        # cleanup: remove from the conversations this connection joined
+        if conn.binary:
+            binary_connections -= 1
+        connections.discard(conn)
+        leave(conn)
+        await conn.close()
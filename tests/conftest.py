@@ -0,0 +1,9 @@
+# tests/conftest.py
+"""
+Run from the repository root: `python -m pytest`. Coroutines are driven
+with asyncio.run in each test; no plugin is needed.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,126 @@
+# tests/test_backplane.py
+import asyncio
+import json
+
+from chatspot.backplane import LocalBackplane, LocalHub, Outbox
+
+
+def _envelope(conv: str, text: str) -> bytes:
+    return json.dumps({"conversationId": conv, "ciphertext": text}, separators=(",", ":")).encode()
+
+
+async def _two_members():
+    hub = LocalHub()
+    events = {"a": [], "b": []}
+
+    def recorder(name):
+        async def handler(conv, seq, encoded, origin, keep):
+            events[name].append((conv, seq, json.loads(encoded), origin, keep))
+        return handler
+
+    a, b = LocalBackplane(hub), LocalBackplane(hub)
+    await a.start(recorder("a"))
+    await b.start(recorder("b"))
+    return hub, a, b, events
+
+
+def test_every_member_gets_events_in_seq_order():
+    async def run():
+        _, a, b, events = await _two_members()
+        for i in range(5):
+            (a if i % 2 else b).publish("room", _envelope("room", "m%d" % i), 0)
+        await a._barrier()
+        await b._barrier()
+        await a.close()
+        await b.close()
+        return events
+
+    events = asyncio.run(run())
+    for name in ("a", "b"):
+        assert [seq for _, seq, _, _, _ in events[name]] == [1, 2, 3, 4, 5]
+        assert [env["ciphertext"] for _, _, env, _, _ in events[name]] == ["m0", "m1", "m2", "m3", "m4"]
+        # the seq is added to the envelope
+        assert [env["seq"] for _, _, env, _, _ in events[name]] == [1, 2, 3, 4, 5]
+
+
+def test_only_the_publisher_gets_origin():
+    async def run():
+        _, a, b, events = await _two_members()
+        a.publish("room", _envelope("room", "x"), 0)
+        await a._barrier()
+        await b._barrier()
+        await a.close()
+        await b.close()
+        return events
+
+    events = asyncio.run(run())
+    assert [(origin, keep) for _, _, _, origin, keep in events["a"]] == [(True, True)]
+    assert [(origin, keep) for _, _, _, origin, keep in events["b"]] == [(False, True)]
+
+
+def test_numbering_continues_after_the_publishers_last_seq():
+    async def run():
+        _, a, b, events = await _two_members()
+        a.publish("room", _envelope("room", "x"), 41)
+        b.publish("room", _envelope("room", "y"), 0)
+        await a._barrier()
+        await a.close()
+        await b.close()
+        return events
+
+    events = asyncio.run(run())
+    assert [seq for _, seq, _, _, _ in events["a"]] == [42, 43]
+
+
+def test_closed_member_gets_nothing_more():
+    async def run():
+        hub, a, b, events = await _two_members()
+        await b.close()
+        a.publish("room", _envelope("room", "x"), 0)
+        await a._barrier()
+        await a.close()
+        return hub, events
+
+    hub, events = asyncio.run(run())
+    assert hub.members == []
+    assert len(events["a"]) == 1
+    assert events["b"] == []
+
+
+class _Transport:
+    def __init__(self):
+        self.size = 0
+
+    def get_write_buffer_size(self) -> int:
+        return self.size
+
+
+class _Writer:
+    def __init__(self):
+        self.transport = _Transport()
+        self.writes = []
+
+    def is_closing(self) -> bool:
+        return False
+
+    def write(self, data: bytes) -> None:
+        self.writes.append(data)
+        self.transport.size += len(data)
+
+
+def test_outbox_coalesces_a_loop_pass_and_counts_what_is_buffered():
+    async def run():
+        writer = _Writer()
+        outbox = Outbox(writer)
+        sizes = []
+        for chunk in (b"ab", b"cde", b"f"):
+            outbox.write(chunk)
+            sizes.append(outbox.buffered)
+        await asyncio.sleep(0)
+        return writer.writes, sizes, outbox.buffered
+
+    writes, sizes, after = asyncio.run(run())
+    assert writes == [b"abcdef"]
+    assert sizes == [2, 5, 6]
+    # now in the transport's buffer instead
+    assert after == 6
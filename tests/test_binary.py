@@ -0,0 +1,83 @@
+# tests/test_binary.py
+import base64
+
+import pytest
+
+from chatspot import binary, protocol
+from chatspot.protocol import BinaryMessage
+
+
+def _frame(envelope: dict, seq: int = 0) -> bytes:
+    def raw(key):
+        value = envelope.get(key)
+        return base64.b64decode(value) if value is not None else None
+
+    return binary.encode_message(
+        seq, envelope["conversationId"], envelope.get("senderId"), raw("iv"), raw("ciphertext"), envelope
+    )
+
+
+def test_round_trip_carries_every_field():
+    envelope = {
+        "conversationId": "room",
+        "senderId": "u1",
+        "iv": base64.b64encode(b"\x00" * 12).decode(),
+        "ciphertext": base64.b64encode(b"secret bytes").decode(),
+        "sentAt": 1700000000,
+    }
+    frame = _frame(envelope)
+    # iv and ciphertext travel as raw bytes
+    assert b"secret bytes" in frame
+    assert binary.decode_message(frame) == envelope
+
+
+def test_values_that_are_not_base64_travel_in_extra():
+    envelope = {"conversationId": "room", "senderId": 42, "iv": "not base64!", "ciphertext": "plain"}
+    frame = binary.encode_message(1, "room", 42, None, None, envelope)
+    decoded = binary.decode_message(frame)
+    assert decoded == envelope
+
+
+def test_with_seq_patches_only_the_seq():
+    frame = _frame({"conversationId": "room", "senderId": "u1", "ciphertext": "AAAA"})
+    patched = binary.with_seq(frame, 77)
+    assert len(patched) == len(frame)
+    assert binary.HEADER.unpack_from(patched)[2] == 77
+    assert patched[: binary.SEQ_OFFSET] == frame[: binary.SEQ_OFFSET]
+    assert patched[binary.SEQ_OFFSET + 8:] == frame[binary.SEQ_OFFSET + 8:]
+
+
+def _malformed():
+    good = _frame({"conversationId": "room", "senderId": "u1", "ciphertext": "AAAA"})
+    header = list(binary.HEADER.unpack_from(good))
+    yield good[: binary.HEADER.size - 1]
+    yield bytes([2]) + good[1:]
+    yield good + b"x"
+    yield good[:-1]
+    # no conversation id
+    yield binary.HEADER.pack(binary.KIND_MESSAGE, 0, 0, 0, 0, 0, 0, 0)
+    yield binary.HEADER.pack(binary.KIND_MESSAGE, 0, 0, 2, 0, 0, 0, 0) + b"\xff\xfe"
+    header[-1] = 3
+    yield binary.HEADER.pack(*header) + good[binary.HEADER.size:] + b"{{{"
+    yield binary.HEADER.pack(*header) + good[binary.HEADER.size:] + b"[1]"
+
+
+def test_malformed_frames_raise():
+    for frame in _malformed():
+        with pytest.raises(binary.MalformedFrame):
+            binary.decode_message(frame)
+        assert protocol.decode_binary(frame) is None
+
+
+def test_decode_binary_keeps_the_frame_to_forward():
+    frame = _frame({"conversationId": "room", "senderId": "u1", "ciphertext": "AAAA"})
+    msg = protocol.decode_binary(frame)
+    assert type(msg) is BinaryMessage and msg.ACTION == "message"
+    assert msg.frame is frame
+    assert msg.envelope == {"conversationId": "room", "senderId": "u1", "ciphertext": "AAAA"}
+
+
+def test_parts_too_long_for_their_header_field_are_not_encoded():
+    # the conversation id length is a u16
+    long_id = "x" * 0x10000
+    assert binary.encode_message(1, long_id, "u1", None, None, {"conversationId": long_id}) is None
@@ -0,0 +1,262 @@
+# tests/test_connection.py
+import asyncio
+import json
+
+from chatspot.connection import DISCONNECT, DROP_NEWEST, DROP_OLDEST, SLOW_CONSUMER_CLOSE_CODE, Connection
+from chatspot.frame import Frame
+from chatspot.history import ConversationHistory, message_frame
+
+
+class Socket:
+    """
+    Records what is sent; `stalled` sockets never complete a send.
+    """
+
+    def __init__(self, stalled: bool = False):
+        self.stalled = stalled
+        self.sent = []
+        self.closed_with = None
+
+    async def send_text(self, text: str) -> None:
+        if self.stalled:
+            await asyncio.Event().wait()
+        self.sent.append(json.loads(text))
+
+    async def send_bytes(self, data: bytes) -> None:
+        if self.stalled:
+            await asyncio.Event().wait()
+        self.sent.append(data)
+
+    async def close(self, code: int = 1000) -> None:
+        self.closed_with = code
+
+
+def _messages(conv: str, count: int):
+    history = ConversationHistory(conv, max_records=0, max_bytes=0)
+    return [
+        message_frame(history.append({"conversationId": conv, "senderId": "u", "ciphertext": "m%d" % i}))
+        for i in range(count)
+    ]
+
+
+def _seqs(sent):
+    seqs = []
+    for frame in sent:
+        if frame["action"] == "message":
+            seqs.append(frame["envelope"]["seq"])
+        elif frame["action"] == "batch":
+            seqs.extend(e["seq"] for e in frame["envelopes"])
+    return seqs
+
+
+async def _drain(conn: Connection) -> None:
+    while conn.depth:
+        await asyncio.sleep(0)
+    await asyncio.sleep(0)
+
+
+def test_handoff_releases_held_frames_after_the_history():
+    async def run():
+        ws = Socket()
+        conn = Connection(ws)
+        conn.start()
+        frames = _messages("room", 4)
+        conn.begin_handoff("room")
+        for seq, frame in enumerate(frames, 1):
+            assert conn.hold("room", seq, frame)
+        # the history snapshot ended at seq 2
+        conn.enqueue(Frame.of('{"action":"history"}', "history"))
+        released = await conn.finish_handoff("room", 2)
+        await _drain(conn)
+        await conn.close()
+        return released, ws.sent
+
+    released, sent = asyncio.run(run())
+    assert released
+    assert sent[0] == {"action": "history"}
+    assert _seqs(sent) == [3, 4]
+
+
+def test_handoff_overflow_drops_held_frames_and_reports_it():
+    async def run():
+        ws = Socket()
+        conn = Connection(ws, max_frames=3)
+        conn.start()
+        frames = _messages("room", 6)
+        conn.begin_handoff("room")
+        held = [conn.hold("room", seq, frame) for seq, frame in enumerate(frames, 1)]
+        released = await conn.finish_handoff("room", 0)
+        # no longer mid-handoff: live frames go out again
+        after = conn.hold("room", 7, frames[0])
+        await _drain(conn)
+        await conn.close()
+        return held, released, after, conn.stats(), ws.sent
+
+    held, released, after, stats, sent = asyncio.run(run())
+    assert all(held)
+    assert not released and not after
+    assert stats["dropped"] == {"handoff": 1}
+    assert sent == []
+
+
+def test_held_frames_count_against_the_queue():
+    async def run():
+        conn = Connection(Socket(stalled=True), max_frames=3)
+        conn.start()
+        frames = _messages("room", 3)
+        # the writer takes the first frame and stalls on it; two stay queued
+        for frame in frames:
+            conn.enqueue(frame)
+        await asyncio.sleep(0)
+        conn.begin_handoff("room")
+        conn.hold("room", 4, frames[0])
+        fits = conn.stats()["dropped"]
+        conn.hold("room", 5, frames[1])
+        overflowed = conn.stats()["dropped"]
+        conn.abort_handoff("room")
+        await conn.close()
+        return fits, overflowed
+
+    fits, overflowed = asyncio.run(run())
+    assert fits == {}
+    assert overflowed == {"handoff": 1}
+
+
+def _fill(conn: Connection, frames):
+    # the writer is not started, so everything stays queued
+    return [conn.enqueue(frame) for frame in frames]
+
+
+def test_full_queue_drops_the_oldest_frames_of_the_class():
+    async def run():
+        ws = Socket()
+        conn = Connection(ws, max_frames=3, policies={"message": DROP_OLDEST})
+        conn.enqueue(Frame.of('{"action":"ack"}', "control"))
+        accepted = _fill(conn, _messages("room", 5))
+        depth = conn.depth
+        conn.start()
+        await _drain(conn)
+        await conn.close()
+        return accepted, depth, conn.stats()["dropped"], ws.sent
+
+    accepted, depth, dropped, sent = asyncio.run(run())
+    assert accepted == [True] * 5
+    assert depth == 3
+    assert dropped == {"message": 3}
+    # the control frame is not made room with
+    assert sent[0] == {"action": "ack"}
+    assert _seqs(sent) == [4, 5]
+
+
+def test_drop_oldest_without_frames_of_the_class_drops_the_new_one():
+    async def run():
+        conn = Connection(Socket(), max_frames=2, policies={"message": DROP_OLDEST})
+        conn.enqueue(Frame.of('{"action":"ack"}', "control"))
+        conn.enqueue(Frame.of('{"action":"ack"}', "control"))
+        accepted = _fill(conn, _messages("room", 1))
+        await conn.close()
+        return accepted, conn.stats()["dropped"]
+
+    assert asyncio.run(run()) == ([False], {"message": 1})
+
+
+def test_full_queue_drops_the_newest_frames():
+    async def run():
+        ws = Socket()
+        conn = Connection(ws, max_frames=3, policies={"message": DROP_NEWEST})
+        accepted = _fill(conn, _messages("room", 5))
+        conn.start()
+        await _drain(conn)
+        await conn.close()
+        return accepted, conn.stats()["dropped"], ws.sent
+
+    accepted, dropped, sent = asyncio.run(run())
+    assert accepted == [True, True, True, False, False]
+    assert dropped == {"message": 2}
+    assert _seqs(sent) == [1, 2, 3]
+
+
+def test_full_queue_disconnects_the_slow_consumer():
+    async def run():
+        ws = Socket()
+        conn = Connection(ws, max_frames=3, policies={"message": DISCONNECT})
+        accepted = _fill(conn, _messages("room", 5))
+        closed, depth = conn.closed, conn.depth
+        # the socket is closed from a task of its own
+        await asyncio.sleep(0.01)
+        await conn.close()
+        return accepted, closed, depth, conn.stats()["dropped"], ws.closed_with
+
+    accepted, closed, depth, dropped, code = asyncio.run(run())
+    assert accepted == [True, True, True, False, False]
+    # what was queued is discarded with the connection
+    assert closed and depth == 0
+    assert dropped == {"disconnect": 1}
+    assert code == SLOW_CONSUMER_CLOSE_CODE
+
+
+def test_byte_cap_applies_like_the_frame_cap():
+    async def run():
+        frames = _messages("room", 4)
+        conn = Connection(Socket(), max_frames=100, max_bytes=2 * len(frames[0]), policies={"message": DROP_NEWEST})
+        accepted = _fill(conn, frames)
+        await conn.close()
+        return accepted
+
+    assert asyncio.run(run()) == [True, True, False, False]
+
+
+def test_send_past_the_timeout_evicts_the_connection():
+    async def run():
+        ws = Socket(stalled=True)
+        conn = Connection(ws, send_timeout=0.05)
+        conn.start()
+        conn.enqueue(_messages("room", 1)[0])
+        for _ in range(100):
+            if ws.closed_with is not None:
+                break
+            await asyncio.sleep(0.01)
+        accepted = conn.enqueue(_messages("room", 1)[0])
+        await conn.close()
+        return conn.closed, ws.closed_with, accepted
+
+    assert asyncio.run(run()) == (True, SLOW_CONSUMER_CLOSE_CODE, False)
+
+
+def test_batching_merges_consecutive_messages_in_order():
+    async def run():
+        ws = Socket()
+        conn = Connection(ws, batch_max_frames=3, batch_window=0)
+        conn.batch = True
+        frames = _messages("room", 6)
+        _fill(conn, frames[:4])
+        conn.enqueue(Frame.of('{"action":"ack"}', "control"))
+        _fill(conn, frames[4:])
+        conn.start()
+        await _drain(conn)
+        await conn.close()
+        return ws.sent, conn.stats()
+
+    sent, stats = asyncio.run(run())
+    assert [frame["action"] for frame in sent] == ["batch", "message", "ack", "batch"]
+    assert [len(frame["envelopes"]) for frame in sent if frame["action"] == "batch"] == [3, 2]
+    # nothing overtakes what was queued before it
+    assert _seqs(sent) == [1, 2, 3, 4, 5, 6]
+    assert stats["sent"] == 4 and stats["batched"] == 5
+
+
+def test_batching_respects_the_byte_cap():
+    async def run():
+        ws = Socket()
+        frames = _messages("room", 5)
+        conn = Connection(ws, batch_max_bytes=2 * len(frames[0].envelope), batch_window=0)
+        conn.batch = True
+        _fill(conn, frames)
+        conn.start()
+        await _drain(conn)
+        await conn.close()
+        return ws.sent
+
+    sent = asyncio.run(run())
+    assert [frame["action"] for frame in sent] == ["batch", "batch", "message"]
+    assert _seqs(sent) == [1, 2, 3, 4, 5]
@@ -0,0 +1,128 @@
+# tests/test_history.py
+import json
+
+from chatspot.history import ConversationHistory, HistoryBudget
+
+
+def _envelope(conv: str, text: str) -> dict:
+    return {"conversationId": conv, "senderId": "u", "ciphertext": text}
+
+
+def _seqs(frame: str):
+    decoded = json.loads(frame)
+    return [e["seq"] for e in decoded["history"]], decoded["hasMore"]
+
+
+def _held_bytes(histories) -> int:
+    return sum(h.encoded_size for h in histories)
+
+
+def test_encoded_size_matches_the_held_records():
+    history = ConversationHistory("room", max_records=0, max_bytes=0)
+    for i in range(5):
+        history.append(_envelope("room", "m%d" % i))
+    assert history.encoded_size == len(b",".join(encoded for _, encoded in history.held()))
+
+
+def test_budget_counts_what_is_held_under_record_cap():
+    budget = HistoryBudget(max_bytes=0)
+    history = ConversationHistory("room", max_records=3, max_bytes=0, budget=budget)
+    for i in range(10):
+        history.append(_envelope("room", "m%d" % i))
+        assert budget.total == history.encoded_size
+    assert [seq for seq, _ in history.held()] == [8, 9, 10]
+
+
+def test_budget_counts_what_is_held_under_byte_cap():
+    budget = HistoryBudget(max_bytes=0)
+    history = ConversationHistory("room", max_records=0, max_bytes=300, budget=budget)
+    for i in range(50):
+        history.append(_envelope("room", "x" * (i % 7 * 10)))
+        assert budget.total == history.encoded_size
+        assert history.encoded_size <= 300 or len(history) == 1
+    assert history.last_seq == 50
+
+
+def test_budget_evicts_least_recently_active_conversations():
+    budget = HistoryBudget(max_bytes=1000)
+    rooms = {name: ConversationHistory(name, max_records=0, max_bytes=0, budget=budget) for name in "abc"}
+    for i in range(30):
+        name = "abc"[i % 3] if i < 15 else "c"
+        rooms[name].append(_envelope(name, "y" * 40))
+        assert budget.total == _held_bytes(rooms.values())
+        # past the cap only when a single conversation holds it all
+        assert budget.total <= 1000 or len(budget) == 1
+    # only the conversation still being appended to holds records
+    assert len(rooms["a"]) == 0 and len(rooms["b"]) == 0
+    assert len(budget) == 1
+    # an evicted conversation keeps numbering where it left off
+    assert rooms["a"].append(_envelope("a", "z")).seq == rooms["a"].last_seq == 6
+
+
+def test_clear_releases_everything():
+    budget = HistoryBudget(max_bytes=0)
+    a = ConversationHistory("a", max_records=0, max_bytes=0, budget=budget)
+    b = ConversationHistory("b", max_records=0, max_bytes=0, budget=budget)
+    for i in range(4):
+        a.append(_envelope("a", "m%d" % i))
+        b.append(_envelope("b", "m%d" % i))
+    a.drop_oldest(2)
+    assert budget.total == _held_bytes((a, b))
+    a.clear()
+    assert budget.total == b.encoded_size
+    assert len(budget) == 1
+    b.clear()
+    assert budget.total == 0 and len(budget) == 0
+
+
+def test_paging_by_seq():
+    history = ConversationHistory("room", max_records=0, max_bytes=0)
+    for i in range(10):
+        history.append(_envelope("room", "m%d" % i))
+    assert _seqs(history.tail_frame(3)) == ([8, 9, 10], True)
+    assert _seqs(history.tail_frame(20)) == (list(range(1, 11)), False)
+    assert _seqs(history.before_frame(8, 3)) == ([5, 6, 7], True)
+    assert _seqs(history.before_frame(3, 5)) == ([1, 2], False)
+    assert _seqs(history.after_frame(2, 3)) == ([3, 4, 5], True)
+    assert _seqs(history.after_frame(7, 5)) == ([8, 9, 10], False)
+    assert _seqs(history.after_frame(10, 5)) == ([], False)
+
+
+def test_paging_after_records_were_dropped():
+    history = ConversationHistory("room", max_records=4, max_bytes=0)
+    for i in range(10):
+        history.append(_envelope("room", "m%d" % i))
+    assert history.first_seq == 7
+    assert _seqs(history.before_frame(9, 10)) == ([7, 8], False)
+    assert _seqs(history.after_frame(2, 2)) == ([7, 8], True)
+    assert history.covers(6) and not history.covers(5)
+
+
+def test_resume_frames_split_by_limit():
+    history = ConversationHistory("room", max_records=0, max_bytes=0)
+    for i in range(7):
+        history.append(_envelope("room", "m%d" % i))
+    frames = [_seqs(f) for f in history.resume_frames(2, 2)]
+    assert frames == [([3, 4], True), ([5, 6], True), ([7], False)]
+    assert [_seqs(f) for f in history.resume_frames(7, 2)] == [([], False)]
+
+
+def test_restore_keeps_only_the_newest_consecutive_records():
+    history = ConversationHistory("room", max_records=0, max_bytes=0)
+    history.restore([(seq, b'{"seq":%d}' % seq) for seq in (1, 3, 4, 6, 7, 8)])
+    assert [seq for seq, _ in history.held()] == [6, 7, 8]
+    assert history.last_seq == 8
+    # what was skipped is not claimed to be held
+    assert not history.covers(4)
+    assert [_seqs(f) for f in history.resume_frames(5, 10)] == [([6, 7, 8], False)]
+
+
+def test_restore_after_a_gap_starts_over():
+    budget = HistoryBudget(max_bytes=0)
+    history = ConversationHistory("room", max_records=0, max_bytes=0, budget=budget)
+    history.restore([(1, b'{"seq":1}'), (2, b'{"seq":2}')])
+    history.restore([(5, b'{"seq":5}')])
+    assert [seq for seq, _ in history.held()] == [5]
+    assert budget.total == history.encoded_size
+    history.restore([(6, b'{"seq":6}')])
+    assert [seq for seq, _ in history.held()] == [5, 6]
@@ -0,0 +1,114 @@
+# tests/test_overload.py
+import asyncio
+import json
+import time
+
+from chatspot.overload import DEFER_HISTORY, NORMAL, REFUSE_CONNECT, REJECT_SUBSCRIBE, LagMonitor
+
+
+def _monitor(**kwargs) -> LagMonitor:
+    # every sample replaces the average, so one sample sets the stage
+    kwargs.setdefault("thresholds", (0.05, 0.1, 0.2))
+    kwargs.setdefault("defer_max", 0.05)
+    return LagMonitor(interval=0.01, retry_after=2.0, smoothing=1.0, **kwargs)
+
+
+def test_stages_follow_the_lag_both_ways():
+    async def run():
+        monitor = _monitor()
+        stages = []
+        for lag in (0.0, 0.06, 0.15, 0.3, 0.12, 0.0):
+            monitor.observe(lag)
+            stages.append((monitor.stage, monitor.rejects_subscribe(), monitor.refuses_connect()))
+        return stages
+
+    assert asyncio.run(run()) == [
+        (NORMAL, False, False),
+        (DEFER_HISTORY, False, False),
+        (REJECT_SUBSCRIBE, True, False),
+        (REFUSE_CONNECT, True, True),
+        (REJECT_SUBSCRIBE, True, False),
+        (NORMAL, False, False),
+    ]
+
+
+def test_a_zero_threshold_disables_its_stage():
+    async def run():
+        monitor = _monitor(thresholds=(0.05, 0, 0.2))
+        monitor.observe(0.15)
+        middle = monitor.stage
+        monitor.observe(0.3)
+        return middle, monitor.stage
+
+    assert asyncio.run(run()) == (DEFER_HISTORY, REFUSE_CONNECT)
+
+
+def test_the_average_smooths_single_spikes():
+    async def run():
+        monitor = LagMonitor(interval=0.01, thresholds=(0.05, 0.1, 0.2), smoothing=0.3)
+        monitor.observe(0.1)
+        return monitor.stage, round(monitor.lag, 3)
+
+    assert asyncio.run(run()) == (NORMAL, 0.03)
+
+
+def test_deferred_history_waits_for_the_lag_to_drop():
+    async def run():
+        monitor = _monitor(defer_max=10.0)
+        # not deferred at all in the normal stage
+        await asyncio.wait_for(monitor.defer_history(), 0.01)
+        monitor.observe(0.06)
+        waiting = asyncio.create_task(monitor.defer_history())
+        await asyncio.sleep(0.02)
+        held = not waiting.done()
+        monitor.observe(0.0)
+        await asyncio.wait_for(waiting, 0.1)
+        return held
+
+    assert asyncio.run(run())
+
+
+def test_deferred_history_goes_ahead_after_defer_max():
+    async def run():
+        monitor = _monitor(defer_max=0.05)
+        monitor.observe(0.3)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        await monitor.defer_history()
+        return loop.time() - started
+
+    assert 0.04 < asyncio.run(run()) < 0.5
+
+
+def test_monitor_measures_a_blocked_loop():
+    async def run():
+        monitor = _monitor()
+        stages = []
+        observe = monitor.observe
+
+        def record(lag):
+            observe(lag)
+            stages.append(monitor.stage)
+
+        monitor.observe = record
+        monitor.start()
+        await asyncio.sleep(0.005)
+        time.sleep(0.25)
+        await asyncio.sleep(0.05)
+        await monitor.close()
+        return stages
+
+    stages = asyncio.run(run())
+    assert REFUSE_CONNECT in stages
+    # and back once the loop runs freely again
+    assert stages[-1] == NORMAL
+
+
+def test_shed_clients_are_told_when_to_retry():
+    async def run():
+        monitor = _monitor()
+        return json.loads(monitor.overloaded_frame("subscribe", "room")), monitor.refusal()
+
+    frame, reason = asyncio.run(run())
+    assert frame == {"action": "overloaded", "request": "subscribe", "conversationId": "room", "retryAfterMs": 2000}
+    assert reason == "overloaded; retry after 2000ms"
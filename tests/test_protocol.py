@@ -0,0 +1,53 @@
+# tests/test_protocol.py
+import json
+
+from chatspot import config, protocol
+from chatspot.protocol import History, Identify, Message, Subscribe
+
+
+def _decode(obj):
+    return protocol.decode(json.dumps(obj))
+
+
+def test_each_action_decodes_to_its_request():
+    identify = _decode({"action": "identify", "userId": "u1", "binary": True})
+    assert type(identify) is Identify
+    assert (identify.user_id, identify.binary, identify.batch) == ("u1", True, None)
+
+    subscribe = _decode({"action": "subscribe", "conversationId": "room", "sinceSeq": 4, "extra": [1]})
+    assert type(subscribe) is Subscribe
+    assert (subscribe.conversation_id, subscribe.since_seq) == ("room", 4)
+
+    history = protocol.decode(b'{"action":"history","conversationId":"room","before":10,"limit":5}')
+    assert type(history) is History
+    assert (history.conversation_id, history.before, history.after, history.limit) == ("room", 10, None, 5)
+
+    message = _decode({"action": "message", "envelope": {"conversationId": "room", "ciphertext": "x"}})
+    assert type(message) is Message
+    assert message.envelope == {"conversationId": "room", "ciphertext": "x"}
+    assert message.ACTION == "message"
+
+
+def test_frames_that_do_not_fit_are_ignored():
+    for frame in (
+        "not json",
+        "[1, 2]",
+        '{"conversationId": "room"}',
+        '{"action": "leave", "conversationId": "room"}',
+        '{"action": 3}',
+        # required field missing or of the wrong type
+        '{"action": "subscribe"}',
+        '{"action": "subscribe", "conversationId": 7}',
+        '{"action": "message", "envelope": "x"}',
+        # JSON true is not an int
+        '{"action": "subscribe", "conversationId": "room", "sinceSeq": true}',
+        '{"action": "history", "conversationId": "room", "limit": "5"}',
+    ):
+        assert protocol.decode(frame) is None, frame
+
+
+def test_oversized_frames_are_ignored_before_parsing(monkeypatch):
+    frame = json.dumps({"action": "subscribe", "conversationId": "room"})
+    monkeypatch.setattr(config, "MAX_FRAME_BYTES", len(frame))
+    assert protocol.decode(frame) is not None
+    assert protocol.decode(frame + " ") is None
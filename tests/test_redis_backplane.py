@@ -0,0 +1,141 @@
+# tests/test_redis_backplane.py
+"""
+RedisBackplane against the in-process stand-in (resp_server.py) on a
+Unix socket.
+"""
+import asyncio
+import json
+
+from chatspot import redis_backplane
+from chatspot.redis_backplane import RedisBackplane
+from chatspot.resp import RespConnection, RespError
+from chatspot.resp_server import RespServer
+
+
+def _envelope(conv: str, text: str) -> bytes:
+    return json.dumps({"conversationId": conv, "ciphertext": text}, separators=(",", ":")).encode()
+
+
+async def _wait_for(condition, timeout: float = 5.0) -> None:
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+
+class Node:
+    def __init__(self, url: str, **options):
+        self.backplane = RedisBackplane(url, **options)
+        self.events = []
+
+    async def handler(self, conv, seq, encoded, origin, keep):
+        self.events.append((conv, seq, json.loads(encoded)["ciphertext"], origin, keep))
+
+    async def __aenter__(self) -> "Node":
+        await self.backplane.start(self.handler)
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.backplane.close()
+
+
+def _run(tmp_path, test):
+    async def run():
+        path = str(tmp_path / "redis.sock")
+        server = RespServer()
+        await server.start(path=path)
+        try:
+            await test("unix://" + path)
+        finally:
+            await server.close()
+
+    asyncio.run(run())
+
+
+def test_replies_are_matched_to_pipelined_commands(tmp_path):
+    async def test(url):
+        conn = await RespConnection.open(url)
+        replies = await asyncio.gather(*conn.send([
+            ("SET", "k", "v"),
+            ("INCR", "n"),
+            ("ZADD", "k", 1, "m"),
+            ("INCR", "n"),
+            ("GET", "k"),
+        ]))
+        assert replies[:2] == [b"OK", 1]
+        assert isinstance(replies[2], RespError)
+        assert replies[3:] == [2, b"v"]
+        conn.close()
+
+    _run(tmp_path, test)
+
+
+def test_watching_node_gets_the_other_nodes_messages(tmp_path):
+    async def test(url):
+        async with Node(url) as a, Node(url) as b:
+            await b.backplane.watch("room", 0)
+            for i in range(3):
+                a.backplane.publish("room", _envelope("room", "m%d" % i), 0)
+            await _wait_for(lambda: len(b.events) == 3 and len(a.events) == 3)
+        assert b.events == [("room", i + 1, "m%d" % i, False, True) for i in range(3)]
+        # a does not watch the room: it only persists its own messages
+        assert a.events == [("room", i + 1, "m%d" % i, True, False) for i in range(3)]
+
+    _run(tmp_path, test)
+
+
+def test_watch_catches_up_from_the_backlog(tmp_path):
+    async def test(url):
+        async with Node(url) as a:
+            for i in range(4):
+                a.backplane.publish("room", _envelope("room", "m%d" % i), 0)
+            await _wait_for(lambda: len(a.events) == 4)
+            async with Node(url) as b, Node(url) as c:
+                # watch returns once the backlog after last_seq is handled
+                await b.backplane.watch("room", 0)
+                await c.backplane.watch("room", 2)
+                assert [seq for _, seq, _, _, _ in b.events] == [1, 2, 3, 4]
+                assert [seq for _, seq, _, _, _ in c.events] == [3, 4]
+                a.backplane.publish("room", _envelope("room", "live"), 0)
+                await _wait_for(lambda: len(b.events) == 5 and len(c.events) == 3)
+                assert b.events[-1] == ("room", 5, "live", False, True)
+
+    _run(tmp_path, test)
+
+
+def test_gap_left_by_a_dead_publisher_is_skipped(tmp_path):
+    async def test(url):
+        # a publisher that numbered a message and died before publishing it
+        conn = await RespConnection.open(url)
+        assert await conn.call("INCR", "chatspot:seq:room") == 1
+        conn.close()
+        skipped = redis_backplane.gaps.value
+        async with Node(url) as a, Node(url, gap=0.1) as b:
+            await b.backplane.watch("room", 0)
+            a.backplane.publish("room", _envelope("room", "after"), 0)
+            a.backplane.publish("room", _envelope("room", "later"), 0)
+            await asyncio.sleep(0.05)
+            # held back while seq 1 may still come
+            assert b.events == []
+            await _wait_for(lambda: len(b.events) == 2)
+        assert b.events == [("room", 2, "after", False, True), ("room", 3, "later", False, True)]
+        assert redis_backplane.gaps.value == skipped + 1
+
+    _run(tmp_path, test)
+
+
+def test_rewatch_before_the_subscription_is_confirmed(tmp_path):
+    async def test(url):
+        async with Node(url) as a, Node(url) as b:
+            first = asyncio.create_task(b.backplane.watch("room", 0))
+            # its SUBSCRIBE is written but not confirmed yet
+            while not b.backplane._confirming:
+                await asyncio.sleep(0)
+            b.backplane.unwatch("room")
+            await b.backplane.watch("room", 0)
+            await first
+            a.backplane.publish("room", _envelope("room", "live"), 0)
+            await _wait_for(lambda: len(b.events) == 1)
+        assert b.events == [("room", 1, "live", False, True)]
+
+    _run(tmp_path, test)
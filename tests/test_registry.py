@@ -0,0 +1,52 @@
+# tests/test_registry.py
+from chatspot.registry import SubscriptionRegistry
+
+
+class Conn:
+    """
+    Stands in for a Connection; the registry only hashes it.
+    """
+
+
+def test_both_directions_stay_in_step():
+    registry = SubscriptionRegistry()
+    a, b = Conn(), Conn()
+    assert registry.subscribe("room", a)
+    assert not registry.subscribe("room", a)
+    assert registry.subscribe("room", b)
+    assert registry.subscribe("lobby", a)
+    assert registry.subscribers("room") == {a, b}
+    assert registry.conversations_of(a) == {"room", "lobby"}
+    assert registry.is_subscribed("lobby", a) and not registry.is_subscribed("lobby", b)
+    assert registry.subscription_count() == 3
+    assert sorted(registry) == ["lobby", "room"] and len(registry) == 2
+
+
+def test_last_subscriber_leaving_drops_the_room():
+    registry = SubscriptionRegistry()
+    a, b = Conn(), Conn()
+    registry.subscribe("room", a)
+    registry.subscribe("room", b)
+    assert registry.unsubscribe("room", a)
+    assert not registry.unsubscribe("room", a)
+    assert "room" in registry
+    assert registry.unsubscribe("room", b)
+    assert "room" not in registry and len(registry) == 0
+    assert registry.conversations_of(a) == set() and registry.conversations_of(b) == set()
+    assert registry.subscription_count() == 0
+
+
+def test_remove_leaves_only_the_rooms_joined():
+    registry = SubscriptionRegistry()
+    a, b = Conn(), Conn()
+    for i in range(5):
+        registry.subscribe("room-%d" % i, b)
+    registry.subscribe("room-0", a)
+    registry.subscribe("room-9", a)
+    assert registry.remove(a) == {"room-0", "room-9"}
+    assert registry.remove(a) == set()
+    assert "room-9" not in registry
+    assert registry.subscribers("room-0") == {b}
+    assert registry.subscription_count() == 5
+    assert registry.remove(b) == {"room-%d" % i for i in range(5)}
+    assert len(registry) == 0 and registry.subscription_count() == 0
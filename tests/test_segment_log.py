@@ -0,0 +1,156 @@
+# tests/test_segment_log.py
+import asyncio
+import errno
+import glob
+import os
+import struct
+import time
+
+import pytest
+
+from chatspot.segment_log import SegmentLog, encode_record
+
+
+def _write(directory: str, records) -> str:
+    async def run():
+        log = SegmentLog(directory, shards=1)
+        await log.open(0)
+        for conv, seq, payload in records:
+            log.append(conv, seq, payload)
+        await log.close()
+
+    asyncio.run(run())
+    (path,) = glob.glob(os.path.join(directory, "shard-000", "*.seg"))
+    return path
+
+
+def _reopen(directory: str, recent: int = 10, then=None):
+    async def run():
+        log = SegmentLog(directory, shards=1)
+        tails = await log.open(recent)
+        extra = await then(log) if then is not None else None
+        await log.close()
+        return tails, extra
+
+    return asyncio.run(run())
+
+
+def test_reopen_returns_recent_records_and_last_seq(tmp_path):
+    _write(str(tmp_path), [("a", 1, b"a1"), ("b", 1, b"b1"), ("a", 2, b"a2"), ("a", 3, b"a3")])
+    tails, _ = _reopen(str(tmp_path), recent=2)
+    assert tails["a"] == ([(2, b"a2"), (3, b"a3")], 3)
+    assert tails["b"] == ([(1, b"b1")], 1)
+
+
+def test_torn_tail_is_truncated_on_reopen(tmp_path):
+    path = _write(str(tmp_path), [("a", 1, b"one"), ("a", 2, b"two")])
+    intact = os.path.getsize(path)
+    torn = encode_record("a", 3, b"three")
+    with open(path, "ab") as f:
+        f.write(torn[: len(torn) // 2])
+
+    tails, _ = _reopen(str(tmp_path))
+    assert tails["a"] == ([(1, b"one"), (2, b"two")], 2)
+    assert os.path.getsize(path) == intact
+
+
+def test_checksum_mismatch_is_truncated_on_reopen(tmp_path):
+    path = _write(str(tmp_path), [("a", 1, b"one"), ("a", 2, b"two")])
+    first = len(encode_record("a", 1, b"one"))
+    with open(path, "r+b") as f:
+        f.seek(first + struct.calcsize("<II") + 2)
+        f.write(b"\xff")
+
+    tails, _ = _reopen(str(tmp_path))
+    assert tails["a"] == ([(1, b"one")], 1)
+    assert os.path.getsize(path) == first
+
+
+def test_appends_after_recovery_follow_the_kept_records(tmp_path):
+    path = _write(str(tmp_path), [("a", 1, b"one"), ("a", 2, b"two")])
+    with open(path, "ab") as f:
+        f.write(b"\x00\x01\x02")
+
+    async def append_and_read(log):
+        log.append("a", 3, b"three")
+        await log.flush(sync=True)
+        return log.seq_range("a"), await log.read("a", 1, 3)
+
+    _, (seqs, records) = _reopen(str(tmp_path), then=append_and_read)
+    assert seqs == (1, 3)
+    assert records == [(1, b"one"), (2, b"two"), (3, b"three")]
+    tails, _ = _reopen(str(tmp_path))
+    assert tails["a"] == ([(1, b"one"), (2, b"two"), (3, b"three")], 3)
+
+
+class _FailingFile:
+    """
+    Writes half of what it is given, then fails like a full disk.
+    """
+
+    def __init__(self, file):
+        self.file = file
+
+    def write(self, data):
+        self.file.write(data[: len(data) // 2])
+        self.file.flush()
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+
+def test_failed_write_is_written_again_by_the_next_flush(tmp_path):
+    async def run():
+        log = SegmentLog(str(tmp_path), shards=1)
+        await log.open(0)
+        log.append("a", 1, b"one")
+        await log.flush(sync=True)
+        shard = log._shards[0]
+        shard.file = _FailingFile(shard.file)
+        log.append("a", 2, b"two")
+        log.append("a", 3, b"three")
+        with pytest.raises(OSError):
+            await log.flush()
+        log.append("a", 4, b"four")
+        records = await log.read("a", 1, 4)
+        await log.close()
+        return records
+
+    records = asyncio.run(run())
+    assert records == [(1, b"one"), (2, b"two"), (3, b"three"), (4, b"four")]
+    tails, _ = _reopen(str(tmp_path))
+    assert tails["a"] == (records, 4)
+
+
+def test_cancelled_flush_finishes_its_write_before_the_next_one(tmp_path, monkeypatch):
+    writing = []
+    overlapped = []
+    write = SegmentLog._write
+
+    def slow_write(self, work, sync):
+        overlapped.append(bool(writing))
+        writing.append(True)
+        time.sleep(0.05)
+        write(self, work, sync)
+        writing.pop()
+
+    monkeypatch.setattr(SegmentLog, "_write", slow_write)
+
+    async def run():
+        log = SegmentLog(str(tmp_path), shards=1)
+        await log.open(0)
+        log.append("a", 1, b"one")
+        flush = asyncio.create_task(log.flush())
+        await asyncio.sleep(0.01)
+        flush.cancel()
+        log.append("a", 2, b"two")
+        await log.flush()
+        with pytest.raises(asyncio.CancelledError):
+            await flush
+        records = await log.read("a", 1, 2)
+        await log.close()
+        return records
+
+    assert asyncio.run(run()) == [(1, b"one"), (2, b"two")]
+    assert not any(overlapped)
@@ -0,0 +1,241 @@
+# tests/test_sharding.py
+import asyncio
+from itertools import count
+
+import pytest
+
+from chatspot import sharding
+from chatspot.sharding import HashRing, Shard, ShardError
+
+
+class Worker:
+    """
+    A Shard whose calls echo back where they were answered. `held` is the
+    last seq of the conversations it owns, given up by `release`.
+    """
+
+    def __init__(self, directory: str, refresh: float = 0.02):
+        self.shard = Shard(directory, vnodes=16, refresh=refresh)
+        self.answered = []
+        self.events = []
+        self.changes = 0
+        self.held = {}
+
+    async def start(self):
+        async def echo(conv, args):
+            self.answered.append((conv, args))
+            return [self.shard.id, args]
+
+        async def fail(conv, args):
+            raise ValueError("boom")
+
+        async def stall(conv, args):
+            await asyncio.Event().wait()
+
+        async def release(conv, args):
+            self.shard.hand_over(conv, args["to"])
+            return self.held.pop(conv, 0)
+
+        async def on_event(conv, seq, encoded):
+            self.events.append((conv, seq, encoded))
+
+        async def on_change():
+            self.changes += 1
+
+        handlers = {"echo": echo, "watch": echo, "fail": fail, "stall": stall, "release": release}
+        await self.shard.start(handlers, on_event, on_change)
+        return self
+
+
+async def _until(predicate, timeout=2.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not predicate():
+        assert asyncio.get_running_loop().time() < deadline, "timed out"
+        await asyncio.sleep(0.005)
+
+
+async def _two_workers(directory: str):
+    a = await Worker(directory).start()
+    b = await Worker(directory).start()
+    # a learns of b from its next scan
+    await _until(lambda: a.shard.ring.members == b.shard.ring.members == {"0", "1"})
+    return a, b
+
+
+def _owned_by(ring: HashRing, worker: str) -> str:
+    return next(conv for conv in ("room-%d" % i for i in count()) if ring.owner(conv) == worker)
+
+
+def test_ring_moves_about_one_nth_of_the_keys():
+    keys = ["room-%d" % i for i in range(20000)]
+    four = HashRing(["0", "1", "2", "3"])
+    before = {key: four.owner(key) for key in keys}
+
+    five = HashRing(["0", "1", "2", "3", "4"])
+    moved = [key for key in keys if five.owner(key) != before[key]]
+    # a joining worker only takes keys, from everyone
+    assert all(five.owner(key) == "4" for key in moved)
+    assert 0.12 < len(moved) / len(keys) < 0.28
+
+    three = HashRing(["0", "1", "2"])
+    moved = [key for key in keys if three.owner(key) != before[key]]
+    # only the keys of the worker that left move
+    assert all(before[key] == "3" for key in moved)
+    assert 0.15 < len(moved) / len(keys) < 0.35
+
+
+def test_calls_are_answered_by_the_owner(tmp_path):
+    async def run():
+        a, b = await _two_workers(str(tmp_path))
+        at_b = _owned_by(a.shard.ring, "1")
+        at_a = _owned_by(a.shard.ring, "0")
+        results = [
+            await a.shard.call(at_b, "echo", {"n": 1}),
+            await b.shard.call(at_a, "echo", {"n": 2}),
+        ]
+        for n in range(20):
+            assert await a.shard.send(at_b, "echo", n)
+        await _until(lambda: len(b.answered) == 21)
+        await a.shard.close()
+        await b.shard.close()
+        return results, b.answered
+
+    results, answered = asyncio.run(run())
+    assert results == [["1", {"n": 1}], ["0", {"n": 2}]]
+    # one-way calls are handled in the order sent
+    assert [args for _, args in answered[1:]] == list(range(20))
+
+
+def test_owner_sends_new_messages_to_watching_workers(tmp_path):
+    async def run():
+        a, b = await _two_workers(str(tmp_path))
+        conv = _owned_by(a.shard.ring, "0")
+        await b.shard.call(conv, "watch", {"since": None})
+        a.shard.publish(conv, 1, b'{"seq":1}')
+        a.shard.publish(conv, 2, b'{"seq":2}')
+        await _until(lambda: len(b.events) == 2)
+        b.shard.unwatch(conv)
+        await _until(lambda: conv not in a.shard._watchers)
+        await a.shard.close()
+        await b.shard.close()
+        return b.events, conv
+
+    events, conv = asyncio.run(run())
+    assert events == [(conv, 1, b'{"seq":1}'), (conv, 2, b'{"seq":2}')]
+
+
+def test_take_over_has_the_previous_owner_release(tmp_path):
+    async def run():
+        a = await Worker(str(tmp_path)).start()
+        # a does not rescan while b joins, so its ring still has only a
+        a.shard.refresh = 60
+        await asyncio.sleep(0.05)
+        b = await Worker(str(tmp_path)).start()
+        b.shard.previous = a.shard.ring
+        conv = _owned_by(b.shard.ring, "1")
+        a.held[conv] = 7
+        owned_before = a.shard.owns(conv)
+        released = await b.shard.take_over(conv)
+        # calls a gets for conv go to b from now on
+        result = await a.shard.call(conv, "echo", None)
+        # nothing is left to release the second time
+        again = await b.shard.take_over(conv)
+        await a.shard.close()
+        await b.shard.close()
+        return owned_before, released, a.shard.owner(conv), result, again
+
+    owned_before, released, owner, result, again = asyncio.run(run())
+    assert owned_before
+    assert released == 7
+    assert owner == "1"
+    assert result == ["1", None]
+    assert again == 0
+
+
+def test_take_over_from_a_worker_that_fails_to_release(tmp_path):
+    async def run():
+        a, b = await _two_workers(str(tmp_path))
+        conv = _owned_by(b.shard.ring, "1")
+        b.shard.previous = HashRing(["0"])
+        a.shard._handlers.pop("release")
+        released = await b.shard.take_over(conv)
+        await a.shard.close()
+        await b.shard.close()
+        return released
+
+    assert asyncio.run(run()) == 0
+
+
+def test_calls_between_disagreeing_rings_stop_after_two_hops(tmp_path):
+    async def run():
+        a, b = await _two_workers(str(tmp_path))
+        conv = "room"
+        # each believes the other owns conv
+        a.shard.hand_over(conv, "1")
+        b.shard.hand_over(conv, "0")
+        result = await a.shard.call(conv, "echo", "x")
+        await a.shard.close()
+        await b.shard.close()
+        return result, a.answered, b.answered
+
+    result, at_a, at_b = asyncio.run(run())
+    # a -> b -> a -> b, where it is answered
+    assert result == ["1", "x"]
+    assert at_a == [] and at_b == [("room", "x")]
+
+
+def test_failed_calls_raise_shard_error(tmp_path):
+    async def run():
+        a, b = await _two_workers(str(tmp_path))
+        conv = _owned_by(a.shard.ring, "1")
+        errors = []
+        for name in ("fail", "nonexistent"):
+            with pytest.raises(ShardError) as e:
+                await a.shard.call(conv, name)
+            errors.append(str(e.value))
+        # the connection is still usable
+        result = await a.shard.call(conv, "echo", 1)
+        await a.shard.close()
+        await b.shard.close()
+        return errors, result
+
+    errors, result = asyncio.run(run())
+    assert errors == ["worker 1: boom", "worker 1: unknown call 'nonexistent'"]
+    assert result == ["1", 1]
+
+
+def test_unanswered_call_times_out(tmp_path, monkeypatch):
+    monkeypatch.setattr(sharding, "_CALL_TIMEOUT", 0.05)
+
+    async def run():
+        a, b = await _two_workers(str(tmp_path))
+        conv = _owned_by(a.shard.ring, "1")
+        with pytest.raises(asyncio.TimeoutError):
+            await a.shard.call(conv, "stall")
+        waiting = dict(a.shard._peers["1"].replies)
+        await a.shard.close()
+        await b.shard.close()
+        return waiting
+
+    assert asyncio.run(run()) == {}
+
+
+def test_unreachable_worker(tmp_path):
+    async def run():
+        a, b = await _two_workers(str(tmp_path))
+        conv = _owned_by(a.shard.ring, "1")
+        # b's socket is gone before a ever connected to it
+        await b.shard.close()
+        (tmp_path / "1.sock").unlink(missing_ok=True)
+        with pytest.raises(ConnectionError):
+            await a.shard.call(conv, "echo")
+        sent = await a.shard.send(conv, "echo")
+        await _until(lambda: a.shard.ring.members == {"0"})
+        changes = a.changes
+        await a.shard.close()
+        return sent, changes
+
+    sent, changes = asyncio.run(run())
+    assert sent is False
+    # the ring shrank once b's slot was free
+    assert changes == 2
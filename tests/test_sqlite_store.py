@@ -0,0 +1,111 @@
+# tests/test_sqlite_store.py
+import asyncio
+import sqlite3
+
+import pytest
+
+from chatspot.sqlite_store import SQLiteStore
+
+
+def _committed(path: str):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("SELECT conversation_id, seq FROM envelopes ORDER BY conversation_id, seq").fetchall()
+    finally:
+        conn.close()
+
+
+def test_reopen_returns_recent_records_and_last_seq(tmp_path):
+    path = str(tmp_path / "chat.db")
+
+    async def write():
+        store = SQLiteStore(path)
+        await store.open(0)
+        for conv, seq in (("a", 1), ("b", 1), ("a", 2), ("a", 3)):
+            store.append(conv, seq, b"%s%d" % (conv.encode(), seq))
+        await store.close()
+
+    async def reopen():
+        store = SQLiteStore(path)
+        tails = await store.open(2)
+        await store.close()
+        return tails
+
+    asyncio.run(write())
+    tails = asyncio.run(reopen())
+    assert tails["a"] == ([(2, b"a2"), (3, b"a3")], 3)
+    assert tails["b"] == ([(1, b"b1")], 1)
+
+
+def test_reads_serve_pending_records_without_committing(tmp_path):
+    path = str(tmp_path / "chat.db")
+
+    async def run():
+        store = SQLiteStore(path)
+        await store.open(0)
+        store.append("a", 1, b"one")
+        await store.flush()
+        store.append("a", 2, b"two")
+        store.append("a", 3, b"three")
+        store.append("b", 1, b"other")
+        records = await store.read("a", 1, 3)
+        recovered = await store.recover("a", 2)
+        committed = _committed(path)
+        await store.close()
+        return records, recovered, committed
+
+    records, recovered, committed = asyncio.run(run())
+    assert records == [(1, b"one"), (2, b"two"), (3, b"three")]
+    assert recovered == ([(2, b"two"), (3, b"three")], 3)
+    # the group commit was left to the committer
+    assert committed == [("a", 1)]
+    assert _committed(path) == [("a", 1), ("a", 2), ("a", 3), ("b", 1)]
+
+
+def test_failed_commit_is_committed_by_the_next_flush(tmp_path, monkeypatch):
+    path = str(tmp_path / "chat.db")
+    insert = SQLiteStore._insert
+    failures = [sqlite3.OperationalError("database is locked")]
+
+    def flaky_insert(self, batch):
+        if failures:
+            raise failures.pop()
+        insert(self, batch)
+
+    monkeypatch.setattr(SQLiteStore, "_insert", flaky_insert)
+
+    async def run():
+        store = SQLiteStore(path)
+        await store.open(0)
+        store.append("a", 1, b"one")
+        with pytest.raises(sqlite3.OperationalError):
+            await store.flush()
+        store.append("a", 2, b"two")
+        # still served while it waits for the retry
+        before = await store.read("a", 1, 2)
+        await store.flush()
+        after = await store.read("a", 1, 2)
+        await store.close()
+        return before, after
+
+    before, after = asyncio.run(run())
+    assert before == after == [(1, b"one"), (2, b"two")]
+    assert _committed(path) == [("a", 1), ("a", 2)]
+
+
+def test_close_closes_the_reader_connections(tmp_path):
+    async def run():
+        store = SQLiteStore(str(tmp_path / "chat.db"), readers=2)
+        await store.open(0)
+        store.append("a", 1, b"one")
+        await store.flush()
+        await asyncio.gather(*(store.read("a", 1, 1) for _ in range(8)))
+        conns = list(store._reader_conns)
+        await store.close()
+        return conns
+
+    conns = asyncio.run(run())
+    assert conns
+    for conn in conns:
+        with pytest.raises(sqlite3.ProgrammingError):
+            conn.execute("SELECT 1")
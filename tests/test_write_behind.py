@@ -0,0 +1,108 @@
+# tests/test_write_behind.py
+import asyncio
+
+from chatspot.write_behind import WriteBehind
+
+
+class FlakyStore:
+    """
+    Buffers appends and fails the first `failures` flushes, keeping the
+    buffer as a store must.
+    """
+
+    def __init__(self, failures: int):
+        self.failures = failures
+        self.flushes = 0
+        self.buffered = []
+        self.committed = []
+
+    def append(self, conv, seq, payload):
+        self.buffered.append((conv, seq, payload))
+
+    async def flush(self):
+        self.flushes += 1
+        if self.failures:
+            self.failures -= 1
+            raise OSError("database is locked")
+        self.committed += self.buffered
+        self.buffered = []
+
+
+async def _until(predicate, timeout=2.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not predicate():
+        assert asyncio.get_running_loop().time() < deadline, "timed out"
+        await asyncio.sleep(0.005)
+
+
+def test_failed_commit_is_retried_with_what_came_since():
+    async def run():
+        store = FlakyStore(failures=3)
+        writer = WriteBehind(store, window=0.001, max_records=100, max_bytes=1 << 20, retry=0.001)
+        writer.start()
+        writer.submit("a", 1, b"one")
+        await _until(lambda: store.flushes >= 1)
+        assert writer.pending == 1
+        writer.submit("a", 2, b"two")
+        await _until(lambda: len(store.committed) == 2)
+        assert writer.pending == 0
+        await writer.close()
+        return store
+
+    store = asyncio.run(run())
+    assert [seq for _, seq, _ in store.committed] == [1, 2]
+    assert store.flushes == 4
+
+
+def test_commit_reports_failure_and_keeps_the_envelopes_pending():
+    async def run():
+        store = FlakyStore(failures=1)
+        writer = WriteBehind(store, window=10, max_records=100, max_bytes=1 << 20)
+        writer.submit("a", 1, b"one")
+        first = await writer.commit()
+        pending = writer.pending
+        second = await writer.commit()
+        return first, pending, second, writer.pending, store.committed
+
+    assert asyncio.run(run()) == (False, 1, True, 0, [("a", 1, b"one")])
+
+
+class SlowStore(FlakyStore):
+    """
+    Takes a while to flush, and notes any flush that overlaps another or
+    is cancelled.
+    """
+
+    def __init__(self):
+        super().__init__(failures=0)
+        self.active = 0
+        self.overlapped = False
+        self.cancelled = False
+
+    async def flush(self):
+        self.overlapped |= self.active > 0
+        self.active += 1
+        try:
+            await asyncio.sleep(0.05)
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        finally:
+            self.active -= 1
+        await super().flush()
+
+
+def test_close_lets_the_commit_in_progress_finish():
+    async def run():
+        store = SlowStore()
+        writer = WriteBehind(store, window=0.001, max_records=100, max_bytes=1 << 20)
+        writer.start()
+        writer.submit("a", 1, b"one")
+        await _until(lambda: store.active)
+        writer.submit("a", 2, b"two")
+        await writer.close()
+        return store
+
+    store = asyncio.run(run())
+    assert not store.cancelled and not store.overlapped
+    assert [seq for _, seq, _ in store.committed] == [1, 2]